@@ -0,0 +1,85 @@
+"""
+Benchmark of the Datastore modes.
+
+Puts a HostGuestAssociationReport with 100k guests (spread over 1000
+hypervisors) into the datastore and reads it back a few times (once per
+destination), in the default pickle mode, in the frozen mode and in the
+mmap mode (snapshots are written to a temporary directory).
+
+Run it from the top of the source tree:
+
+    PYTHONPATH=. python tests/benchmark/datastore.py [guests] [hypervisors] [reads]
+"""
+
+import gc
+import sys
+import time
+import uuid
+import shutil
+import tempfile
+
+from virtwho.datastore import Datastore
+from virtwho.virt import Guest, Hypervisor, HostGuestAssociationReport
+
+
+class FakeVirt(object):
+    CONFIG_TYPE = 'esx'
+
+
+class FakeConfig(object):
+    name = 'benchmark'
+    exclude_hosts = None
+    filter_hosts = None
+
+
+def build_report(guest_count, hypervisor_count):
+    virt = FakeVirt()
+    per_host = guest_count // hypervisor_count
+    hypervisors = []
+    for i in range(hypervisor_count):
+        guests = [Guest(str(uuid.uuid4()), virt, Guest.STATE_RUNNING)
+                  for _ in range(per_host)]
+        hypervisors.append(Hypervisor(str(uuid.uuid4()), guests,
+                                      name='host-%d' % i,
+                                      facts={Hypervisor.CPU_SOCKET_FACT: '2'}))
+    report = HostGuestAssociationReport(FakeConfig(), {'hypervisors': hypervisors})
+    # Virt computes the hash before putting the report to the datastore
+    report.hash
+    return report
+
+
+def measure(mode, report, reads, snapshot_dir):
+    datastore = Datastore(mode=mode, snapshot_dir=snapshot_dir)
+    gc.collect()
+    start = time.time()
+    datastore.put('benchmark', report)
+    put_time = time.time() - start
+
+    start = time.time()
+    for _ in range(reads):
+        result = datastore.get('benchmark')
+        result.hash
+    get_time = (time.time() - start) / reads
+    return put_time, get_time
+
+
+def main():
+    guest_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    hypervisor_count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    reads = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+
+    print("Guests: %d, hypervisors: %d, reads: %d" % (guest_count, hypervisor_count, reads))
+    print("%-8s %12s %12s" % ("mode", "put [ms]", "get [ms]"))
+    snapshot_dir = tempfile.mkdtemp()
+    try:
+        for mode in Datastore.MODES:
+            # Frozen mode changes the report, use a new one for each mode
+            report = build_report(guest_count, hypervisor_count)
+            put_time, get_time = measure(mode, report, reads, snapshot_dir)
+            print("%-8s %12.2f %12.2f" % (mode, put_time * 1000, get_time * 1000))
+    finally:
+        shutil.rmtree(snapshot_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Benchmark of report hashing.
+
+Compares the binary hashing (default) with the JSON based compatibility
+mode for reports with 1k, 10k and 100k guests. The cached digests are
+dropped before each round, so the numbers are for the full computation.
+
+Run it from the top of the source tree:
+
+    PYTHONPATH=. python tests/benchmark/report_hash.py [rounds]
+"""
+
+import sys
+import time
+import uuid
+
+from virtwho.virt import Guest, Hypervisor, HostGuestAssociationReport, ReportHasher
+
+
+class FakeVirt(object):
+    CONFIG_TYPE = 'esx'
+
+
+class FakeConfig(object):
+    name = 'benchmark'
+    exclude_hosts = None
+    filter_hosts = None
+
+
+GUESTS_PER_HYPERVISOR = 100
+
+
+def build_report(guest_count):
+    virt = FakeVirt()
+    hypervisors = []
+    for i in range(max(1, guest_count // GUESTS_PER_HYPERVISOR)):
+        guests = [Guest(str(uuid.uuid4()), virt, Guest.STATE_RUNNING)
+                  for _ in range(min(guest_count, GUESTS_PER_HYPERVISOR))]
+        hypervisors.append(Hypervisor(str(uuid.uuid4()), guests,
+                                      name='host-%d' % i,
+                                      facts={Hypervisor.CPU_SOCKET_FACT: '2'}))
+    return HostGuestAssociationReport(FakeConfig(), {'hypervisors': hypervisors})
+
+
+def measure(report, mode, rounds):
+    ReportHasher.mode = mode
+    best = None
+    for _ in range(rounds):
+        for hypervisor in report.association['hypervisors']:
+            hypervisor.name = hypervisor.name  # drops the cached digest
+        report.invalidate()
+        start = time.time()
+        report.hash
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print("%10s %12s %12s %8s" % ("guests", "json [ms]", "binary [ms]", "speedup"))
+    for guest_count in (1000, 10000, 100000):
+        report = build_report(guest_count)
+        json_time = measure(report, ReportHasher.JSON, rounds)
+        binary_time = measure(report, ReportHasher.BINARY, rounds)
+        print("%10d %12.2f %12.2f %7.1fx" % (
+            guest_count, json_time * 1000, binary_time * 1000,
+            json_time / binary_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Memory benchmark for host/guest association reports.
+
+Builds a HostGuestAssociationReport with 100k guests (spread over 1000
+hypervisors, similar to a large vCenter) and prints how much memory the
+report takes.
+
+Run it from the top of the source tree:
+
+    PYTHONPATH=. python tests/benchmark/report_memory.py [guests] [hypervisors]
+"""
+
+import gc
+import resource
+import sys
+import uuid
+
+from virtwho.virt import Guest, Hypervisor, HostGuestAssociationReport
+
+
+class FakeVirt(object):
+    CONFIG_TYPE = 'esx'
+
+
+class FakeConfig(object):
+    name = 'benchmark'
+    exclude_hosts = None
+    filter_hosts = None
+
+
+def rss_kb():
+    with open('/proc/self/statm') as statm:
+        pages = int(statm.read().split()[1])
+    return pages * resource.getpagesize() / 1024
+
+
+def build_report(guest_count, hypervisor_count):
+    virt = FakeVirt()
+    per_host = guest_count // hypervisor_count
+    hypervisors = []
+    for i in range(hypervisor_count):
+        guests = [Guest(str(uuid.uuid4()), virt, Guest.STATE_RUNNING)
+                  for _ in range(per_host)]
+        hypervisors.append(Hypervisor(str(uuid.uuid4()), guests,
+                                      name='host-%d' % i,
+                                      facts={Hypervisor.CPU_SOCKET_FACT: '2'}))
+    return HostGuestAssociationReport(FakeConfig(), {'hypervisors': hypervisors})
+
+
+def object_size(report):
+    total = 0
+    for hypervisor in report.association['hypervisors']:
+        total += sys.getsizeof(hypervisor) + sys.getsizeof(hypervisor.guestIds)
+        for guest in hypervisor.guestIds:
+            total += sys.getsizeof(guest)
+            if hasattr(guest, '__dict__'):
+                total += sys.getsizeof(guest.__dict__)
+    return total
+
+
+def main():
+    guest_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    hypervisor_count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    gc.collect()
+    before = rss_kb()
+    report = build_report(guest_count, hypervisor_count)
+    gc.collect()
+    after = rss_kb()
+
+    print("Guests:                  %d" % guest_count)
+    print("Hypervisors:             %d" % hypervisor_count)
+    print("Guest/Hypervisor objects: %d KiB" % (object_size(report) / 1024))
+    print("RSS growth:              %d KiB" % (after - before))
+    print("RSS per guest:           %d B" % ((after - before) * 1024 / guest_count))
+
+
+if __name__ == '__main__':
+    main()
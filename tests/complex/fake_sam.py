@@ -4,7 +4,9 @@ import sys
 import tempfile
 import ssl
 import json
+import zlib
 import shutil
+from multiprocessing import Value
 
 from fake_virt import FakeVirt, FakeHandler
 
@@ -32,24 +34,46 @@ class SamHandler(FakeHandler):
             self.wfile.write(json.dumps({}))
         elif self.path.startswith('/hypervisors'):
             size = int(self.headers["Content-Length"])
-            data = json.loads(self.rfile.read(size))
+            body = self.rfile.read(size)
+            if self.headers.get("Content-Encoding") == "gzip":
+                if not self.server.accept_gzip:
+                    print "[FakeSam] rejecting compressed body"
+                    self.send_response(415)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+                print "[FakeSam] compressed body: %d bytes on the wire, %d uncompressed (%.1f%% saved)" % (
+                    size, len(body), 100.0 * (len(body) - size) / max(len(body), 1))
+            self.server.sam.wire_bytes += size
+            self.server.sam.raw_bytes += len(body)
+            data = json.loads(body)
             print "[FakeSam] putting in the queue:", data
             self.server.queue.put(data)
-            self.wfile.write(json.dumps({
+            response = json.dumps({
                 "failedUpdate": [],
                 "updated": [],
                 "created": [],
-            }))
+            })
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
 
     def do_PUT(self):
         print "PUT", self.path
 
 
 class FakeSam(FakeVirt):
-    def __init__(self, queue, port=None, code=None, host='localhost'):
+    def __init__(self, queue, port=None, code=None, host='localhost', accept_gzip=True):
         super(FakeSam, self).__init__(SamHandler, port=port, host=host)
         self.daemon = True
         self.server.code = code
+        self.server.accept_gzip = accept_gzip
+        # Sizes of received check-in bodies, to see compression savings
+        self._wire_bytes = Value('d', 0)
+        self._raw_bytes = Value('d', 0)
         base = os.path.dirname(os.path.abspath(__file__))
         certfile = os.path.join(base, 'cert.pem')
         keyfile = os.path.join(base, 'key.pem')
@@ -79,6 +103,22 @@ consumerCertDir = {certdir}
         self.server.sam = self
         self.server.queue = queue
 
+    @property
+    def wire_bytes(self):
+        return self._wire_bytes.value
+
+    @wire_bytes.setter
+    def wire_bytes(self, size):
+        self._wire_bytes.value = size
+
+    @property
+    def raw_bytes(self):
+        return self._raw_bytes.value
+
+    @raw_bytes.setter
+    def raw_bytes(self, size):
+        self._raw_bytes.value = size
+
     def terminate(self):
         shutil.rmtree(self.tempdir)
         super(FakeSam, self).terminate()
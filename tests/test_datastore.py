@@ -1,7 +1,15 @@
+import os
+import json
+import time
+import shutil
+import tempfile
 from base import TestBase
 from mock import sentinel, patch, MagicMock
-from threading import Lock
+from threading import Lock, Thread
+from virtwho.config import Config
 from virtwho.datastore import Datastore
+from virtwho.virt import HostGuestAssociationReport, Hypervisor, Guest, \
+    DomainListReport, SnapshotReport
 
 
 class TestDatastore(TestBase):
@@ -138,3 +146,196 @@ class TestDatastore(TestBase):
         expected_value = self.mock_pickle.dumps.return_value
         mock_internal_ds.__setitem__.assert_called_with(test_key,
                                                         expected_value)
+
+
+class TestFrozenDatastore(TestBase):
+    def create_report(self):
+        virt = type("", (), {'CONFIG_TYPE': 'esx'})()
+        hypervisor = Hypervisor('host-1', [Guest('guest-1', virt, Guest.STATE_RUNNING)])
+        return HostGuestAssociationReport(Config('test', 'esx'),
+                                          {'hypervisors': [hypervisor]})
+
+    def test_default_mode(self):
+        self.assertEqual(Datastore().mode, Datastore.PICKLE)
+        self.assertRaises(ValueError, Datastore, mode='invalid')
+
+    def test_report_is_stored_by_reference(self):
+        datastore = Datastore(mode=Datastore.FROZEN)
+        report = self.create_report()
+        with patch('virtwho.datastore.pickle') as mock_pickle:
+            datastore.put('test', report)
+            result = datastore.get('test')
+            mock_pickle.dumps.assert_not_called()
+            mock_pickle.loads.assert_not_called()
+        self.assertTrue(report.frozen)
+        self.assertTrue(result.frozen)
+        self.assertTrue(result.association['hypervisors'][0] is
+                        report.association['hypervisors'][0])
+        self.assertEqual(result.hash, report.hash)
+
+    def test_state_is_not_shared(self):
+        datastore = Datastore(mode=Datastore.FROZEN)
+        datastore.put('test', self.create_report())
+        datastore.get('test').state = HostGuestAssociationReport.STATE_FINISHED
+        self.assertEqual(datastore.get('test').state,
+                         HostGuestAssociationReport.STATE_CREATED)
+
+    def test_frozen_report_cant_be_changed(self):
+        datastore = Datastore(mode=Datastore.FROZEN)
+        datastore.put('test', self.create_report())
+        result = datastore.get('test')
+        hypervisor = result.association['hypervisors'][0]
+        self.assertRaises(AttributeError, setattr, hypervisor, 'name', 'renamed')
+        self.assertRaises(AttributeError, setattr, result, 'exclude_hosts', ['host-1'])
+        self.assertRaises(AttributeError, getattr, hypervisor.guestIds, 'append')
+
+    def test_other_values_are_pickled(self):
+        datastore = Datastore(mode=Datastore.FROZEN)
+        value = {'key': 'value'}
+        datastore.put('test', value)
+        value['key'] = 'changed'
+        self.assertEqual(datastore.get('test'), {'key': 'value'})
+
+
+class TestSnapshotDatastore(TestBase):
+    def setUp(self):
+        self.snapshot_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.snapshot_dir)
+
+    def create_report(self, name='host-1', partition_reports=False):
+        virt = type("", (), {'CONFIG_TYPE': 'esx'})()
+        config = Config('test', 'esx', partition_reports=partition_reports)
+        hypervisors = [
+            Hypervisor(name, [Guest('guest-1', virt, Guest.STATE_RUNNING),
+                              Guest('guest-2', virt, Guest.STATE_SHUTOFF)],
+                       name='Host 1', facts={'a': '1'}, partition='cluster-1'),
+            Hypervisor('host-2', [], partition=None),
+        ]
+        return HostGuestAssociationReport(config, {'hypervisors': hypervisors})
+
+    def test_snapshot_is_written(self):
+        datastore = Datastore(mode=Datastore.MMAP, snapshot_dir=self.snapshot_dir)
+        report = self.create_report()
+        datastore.put('test/config', report)
+        self.assertEqual(os.listdir(self.snapshot_dir), ['test%2Fconfig.json'])
+        with open(os.path.join(self.snapshot_dir, 'test%2Fconfig.json')) as f:
+            self.assertEqual(json.load(f), json.loads(json.dumps(report.serializedAssociation)))
+
+    def test_snapshot_is_decoded_lazily(self):
+        datastore = Datastore(mode=Datastore.MMAP, snapshot_dir=self.snapshot_dir)
+        report = self.create_report()
+        datastore.put('test', report)
+        with patch('virtwho.datastore.pickle') as mock_pickle:
+            result = datastore.get('test')
+            mock_pickle.loads.assert_not_called()
+        self.assertTrue(isinstance(result, SnapshotReport))
+        self.assertEqual(result.hash, report.hash)
+        self.assertEqual(result.association_computations, 0)
+        self.assertEqual(result.serializedAssociation, report.serializedAssociation)
+        self.assertEqual(result.association_computations, 1)
+        # Decoded hypervisors hash the same
+        self.assertEqual(HostGuestAssociationReport._combine_hashes(
+            result.association['hypervisors']), report.hash)
+
+    def test_partitions(self):
+        datastore = Datastore(mode=Datastore.MMAP, snapshot_dir=self.snapshot_dir)
+        report = self.create_report(partition_reports=True)
+        datastore.put('test', report)
+        result = datastore.get('test')
+        self.assertEqual(result.partition_hashes, report.partition_hashes)
+        self.assertEqual(result.association_computations, 0)
+        self.assertEqual(sorted((partition, [h.hypervisorId for h in hypervisors])
+                                for partition, hypervisors in result.partitions.items()),
+                         [(None, ['host-2']), ('cluster-1', ['host-1'])])
+
+    def test_replaced_snapshot(self):
+        datastore = Datastore(mode=Datastore.MMAP, snapshot_dir=self.snapshot_dir)
+        datastore.put('test', self.create_report('host-1'))
+        old = datastore.get('test')
+        datastore.put('test', self.create_report('host-3'))
+        new = datastore.get('test')
+        self.assertEqual(os.listdir(self.snapshot_dir), ['test.json'])
+        self.assertEqual(sorted(h.hypervisorId for h in old.association['hypervisors']),
+                         ['host-1', 'host-2'])
+        self.assertEqual(sorted(h.hypervisorId for h in new.association['hypervisors']),
+                         ['host-2', 'host-3'])
+
+    def test_state_is_not_shared(self):
+        datastore = Datastore(mode=Datastore.MMAP, snapshot_dir=self.snapshot_dir)
+        datastore.put('test', self.create_report())
+        datastore.get('test').state = HostGuestAssociationReport.STATE_FINISHED
+        self.assertEqual(datastore.get('test').state,
+                         HostGuestAssociationReport.STATE_CREATED)
+
+    def test_delete_removes_snapshot(self):
+        datastore = Datastore(mode=Datastore.MMAP, snapshot_dir=self.snapshot_dir)
+        datastore.put('test', self.create_report())
+        report = datastore.get('test')
+        datastore.delete('test')
+        self.assertEqual(os.listdir(self.snapshot_dir), [])
+        self.assertRaises(KeyError, datastore.get, 'test')
+        # Reports already read stay usable
+        self.assertEqual(sorted(h.hypervisorId for h in report.association['hypervisors']),
+                         ['host-1', 'host-2'])
+        datastore.delete('test')
+
+    def test_other_values_are_pickled(self):
+        datastore = Datastore(mode=Datastore.MMAP, snapshot_dir=self.snapshot_dir)
+        virt = type("", (), {'CONFIG_TYPE': 'esx'})()
+        report = DomainListReport(Config('test', 'esx'),
+                                  [Guest('guest-1', virt, Guest.STATE_RUNNING)])
+        datastore.put('test', report)
+        self.assertEqual(datastore.get('test').hash, report.hash)
+        self.assertEqual(os.listdir(self.snapshot_dir), [])
+
+    def test_unwritable_snapshot_dir(self):
+        filename = os.path.join(self.snapshot_dir, 'file')
+        open(filename, 'w').close()
+        datastore = Datastore(mode=Datastore.MMAP, snapshot_dir=filename)
+        report = self.create_report()
+        datastore.put('test', report)
+        result = datastore.get('test')
+        self.assertFalse(isinstance(result, SnapshotReport))
+        self.assertEqual(result.hash, report.hash)
+
+
+class TestVersionedDatastore(TestBase):
+    def test_get_if_changed(self):
+        datastore = Datastore()
+        self.assertEqual(datastore.version, 0)
+        self.assertEqual(datastore.get_if_changed('test', 0), None)
+        datastore.put('test', 'value1')
+        datastore.put('other', 'other')
+        version, value = datastore.get_if_changed('test', 0)
+        self.assertEqual((version, value), (1, 'value1'))
+        with patch('virtwho.datastore.pickle') as mock_pickle:
+            self.assertEqual(datastore.get_if_changed('test', version), None)
+            mock_pickle.loads.assert_not_called()
+        datastore.put('test', 'value2')
+        self.assertEqual(datastore.get_if_changed('test', version), (3, 'value2'))
+        self.assertEqual(datastore.version, 3)
+
+    def test_wait_for_change_timeout(self):
+        datastore = Datastore()
+        datastore.put('test', 'value')
+        self.assertEqual(datastore.wait_for_change(['test'], timeout=0.01), [])
+        self.assertEqual(datastore.wait_for_change(['test'], timeout=0.01,
+                                                   since_version=0), ['test'])
+
+    def test_wait_for_change_wakes_up(self):
+        datastore = Datastore()
+        since_version = datastore.version
+        result = []
+        thread = Thread(target=lambda: result.append(
+            datastore.wait_for_change(['test'], timeout=10)))
+        thread.start()
+        while not datastore._waiters:
+            time.sleep(0.001)
+        datastore.put('other', 'value')
+        datastore.put('test', 'value')
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(result, [['test']])
+        self.assertEqual(datastore.wait_for_change(['other', 'test'], timeout=0,
+                                                   since_version=since_version),
+                         ['other', 'test'])
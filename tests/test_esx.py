@@ -183,7 +183,7 @@ class TestEsx(TestBase):
 
     @patch('suds.client.Client')
     def test_oneshot(self, mock_client):
-        expected_assoc = '"well formed HostGuestMapping"'
+        expected_assoc = {'hypervisors': []}
         expected_report = HostGuestAssociationReport(self.esx.config, expected_assoc)
         updateSet = Mock()
         updateSet.version = 'some_new_version_string'
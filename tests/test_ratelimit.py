@@ -0,0 +1,51 @@
+from base import TestBase
+from mock import patch
+
+from virtwho import ratelimit
+from virtwho.ratelimit import ThrottleRegistry
+
+
+@patch('virtwho.ratelimit.time.time')
+class TestThrottleRegistry(TestBase):
+    def test_not_throttled(self, now):
+        now.return_value = 1000.0
+        registry = ThrottleRegistry()
+        self.assertEqual(registry.reserve('server'), 0)
+        self.assertEqual(registry.remaining('server'), 0)
+
+    def test_throttle(self, now):
+        now.return_value = 1000.0
+        registry = ThrottleRegistry(spacing=2)
+        self.assertEqual(registry.throttle('server', 30), 30)
+        self.assertEqual(registry.remaining('server'), 30)
+        # Other servers are not affected
+        self.assertEqual(registry.reserve('other'), 0)
+
+        # Callers waiting for the server are spaced out
+        now.return_value = 1010.0
+        self.assertEqual(registry.reserve('server'), 22)
+        self.assertEqual(registry.reserve('server'), 24)
+        self.assertEqual(registry.remaining('server'), 20)
+
+        # Nobody waits after the reserved calls are through
+        now.return_value = 1040.0
+        self.assertEqual(registry.reserve('server'), 0)
+        self.assertEqual(registry.reserve('server'), 0)
+        self.assertEqual(registry.remaining('server'), 0)
+
+    def test_throttle_again(self, now):
+        now.return_value = 1000.0
+        registry = ThrottleRegistry(spacing=1)
+        registry.throttle('server', 30)
+        # Shorter Retry-After doesn't make the throttling end earlier
+        now.return_value = 1010.0
+        self.assertEqual(registry.throttle('server', 5), 21)
+        # Longer one makes it longer
+        self.assertEqual(registry.throttle('server', 60), 60)
+        self.assertEqual(registry.remaining('server'), 60)
+
+    def test_unknown_server(self, now):
+        now.return_value = 1000.0
+        self.assertEqual(ratelimit.throttle(None, 30), 30)
+        self.assertEqual(ratelimit.reserve(None), 0)
+        self.assertEqual(ratelimit.remaining(None), 0)
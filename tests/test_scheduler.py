@@ -0,0 +1,137 @@
+import time
+import shutil
+import tempfile
+import threading
+
+from base import TestBase
+from mock import Mock
+
+from virtwho.config import Config
+from virtwho.datastore import Datastore
+from virtwho.executor import Executor
+from virtwho.scheduler import Scheduler
+from virtwho.virt import Virt, VirtError, Guest
+
+
+class PollingVirt(Virt):
+    CONFIG_TYPE = 'scheduler-test'
+
+    def __init__(self, *args, **kwargs):
+        self.fail = kwargs.pop('fail', False)
+        super(PollingVirt, self).__init__(*args, **kwargs)
+        self.runs = 0
+        self.prepared = 0
+        self.threads = set()
+
+    def prepare(self):
+        self.prepared += 1
+
+    def isHypervisor(self):
+        return False
+
+    def listDomains(self):
+        self.runs += 1
+        self.threads.add(threading.current_thread().name)
+        if self.fail:
+            raise VirtError('failed')
+        return [Guest('guest-%s' % self.config.name, self, Guest.STATE_RUNNING)]
+
+
+class EventVirt(PollingVirt):
+    CONFIG_TYPE = 'scheduler-event-test'
+
+    def _run(self):
+        pass
+
+
+class TestScheduler(TestBase):
+    def create_virt(self, name, datastore, **kwargs):
+        return PollingVirt(self.logger, Config(name, 'esx'), datastore, **kwargs)
+
+    def wait_until(self, predicate, timeout=5):
+        end_time = time.time() + timeout
+        while not predicate() and time.time() < end_time:
+            time.sleep(0.01)
+        self.assertTrue(predicate())
+
+    def test_schedulable(self):
+        datastore = Datastore()
+        self.assertTrue(self.create_virt('test', datastore).schedulable)
+        self.assertFalse(EventVirt(self.logger, Config('test', 'esx'), datastore).schedulable)
+
+    def test_sources_share_workers(self):
+        datastore = Datastore()
+        virts = [self.create_virt('source_%d' % i, datastore, interval=0.05)
+                 for i in range(20)]
+        scheduler = Scheduler(self.logger, 2)
+        for virt in virts:
+            scheduler.add(virt)
+        scheduler.start()
+        try:
+            self.wait_until(lambda: all(virt.runs >= 3 for virt in virts))
+        finally:
+            scheduler.stop()
+        threads = set()
+        for virt in virts:
+            threads.update(virt.threads)
+            self.assertEqual(virt.prepared, 1)
+            self.assertEqual(datastore.get(virt.config.name).guests[0].uuid,
+                             'guest-%s' % virt.config.name)
+        self.assertEqual(threads, set(['virt-who-worker-0', 'virt-who-worker-1']))
+
+    def test_stopped_source_is_not_run(self):
+        datastore = Datastore()
+        virt = self.create_virt('test', datastore, interval=0.05)
+        scheduler = Scheduler(self.logger, 1)
+        scheduler.add(virt)
+        scheduler.start()
+        try:
+            self.wait_until(lambda: virt.runs >= 1)
+            virt.stop()
+            runs = virt.runs
+            time.sleep(0.2)
+        finally:
+            scheduler.stop()
+        self.assertEqual(virt.runs, runs)
+        self.assertEqual(len(scheduler), 0)
+
+    def test_oneshot(self):
+        datastore = Datastore()
+        virt = self.create_virt('test', datastore, interval=0.05, oneshot=True)
+        self.assertEqual(virt.run_scheduled(), None)
+        self.assertTrue(virt.is_terminated())
+        self.assertEqual(virt.runs, 1)
+
+    def test_error(self):
+        datastore = Datastore()
+        virt = self.create_virt('test', datastore, interval=30, fail=True)
+        self.assertEqual(virt.run_scheduled(), 30)
+        self.assertEqual(virt.run_scheduled(), 30)
+        # Source is prepared again after an error
+        self.assertEqual(virt.prepared, 2)
+        self.assertFalse(virt.is_terminated())
+
+    def test_executor_schedules_polling_virts(self):
+        options = Mock()
+        options.state_file = None
+        options.worker_threads = 2
+        config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, config_dir)
+        executor = Executor(self.logger, options, config_dir=config_dir)
+        datastore = executor.datastore
+        polling = [self.create_virt('source_%d' % i, datastore,
+                                    terminate_event=executor.terminate_event)
+                   for i in range(5)]
+        event_driven = Mock()
+        event_driven.schedulable = False
+        executor.virts = polling + [event_driven]
+        executor._start_virts()
+        try:
+            self.assertEqual(executor.scheduler.workers, 2)
+            event_driven.start.assert_called_once_with()
+            self.wait_until(lambda: all(virt.runs == 1 for virt in polling))
+            for virt in polling:
+                self.assertFalse(virt.is_alive())
+        finally:
+            executor.stop_threads()
+        self.assertEqual(executor.scheduler, None)
@@ -0,0 +1,146 @@
+import os
+import json
+import shutil
+import tempfile
+
+from base import TestBase
+from mock import Mock, patch
+
+from virtwho.config import Config, Satellite6DestinationInfo, DefaultDestinationInfo
+from virtwho.state import SentState, destination_key
+from virtwho.virt import (
+    DestinationThread, DomainListReport, Guest, Hypervisor,
+    HostGuestAssociationReport, AbstractVirtReport)
+
+
+xvirt = type("", (), {'CONFIG_TYPE': 'xxx'})()
+
+
+class TestSentState(TestBase):
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.state_dir)
+        self.filename = os.path.join(self.state_dir, 'virt-who', 'state.json')
+
+    def test_roundtrip(self):
+        state = SentState(self.filename)
+        self.assertEqual(state.get('dest'), {})
+        state.update('dest', {'source1': 'hash1'})
+        state.update('dest', {'source2': {None: 'hash2', 'cluster': 'hash3'}})
+
+        restored = SentState(self.filename)
+        self.assertEqual(restored.get('dest'), {
+            'source1': 'hash1',
+            'source2': {None: 'hash2', 'cluster': 'hash3'},
+        })
+        self.assertEqual(os.listdir(os.path.dirname(self.filename)), ['state.json'])
+
+    def test_unchanged_state_is_not_written(self):
+        state = SentState(self.filename)
+        state.update('dest', {'source1': {'cluster': 'hash'}})
+        restored = SentState(self.filename)
+        with patch.object(restored, '_save') as save:
+            restored.update('dest', {'source1': {'cluster': 'hash'}})
+            save.assert_not_called()
+
+    def test_update_is_written_once(self):
+        state = SentState(self.filename)
+        with patch.object(state, '_save', wraps=state._save) as save:
+            state.update('dest', {'source1': 'hash1', 'source2': {'cluster': 'hash2'}})
+            save.assert_called_once()
+        self.assertEqual(SentState(self.filename).get('dest'), {
+            'source1': 'hash1', 'source2': {'cluster': 'hash2'}})
+
+    def test_other_versions_are_ignored(self):
+        state = SentState(self.filename)
+        state.update('dest', {'source1': 'hash1'})
+        with open(self.filename) as f:
+            data = json.load(f)
+
+        for key, value in (('version', SentState.VERSION + 1), ('hash_mode', 'other')):
+            changed = dict(data)
+            changed[key] = value
+            with open(self.filename, 'w') as f:
+                json.dump(changed, f)
+            self.assertEqual(SentState(self.filename).get('dest'), {})
+
+    def test_corrupted_file_is_ignored(self):
+        os.mkdir(os.path.dirname(self.filename))
+        with open(self.filename, 'w') as f:
+            f.write('{"version": ')
+        self.assertEqual(SentState(self.filename).get('dest'), {})
+
+    def test_destination_key(self):
+        info = Satellite6DestinationInfo(env='env', owner='owner', rhsm_password='secret')
+        same = Satellite6DestinationInfo(env='env', owner='owner', rhsm_password='other')
+        same.name = 'destination_1'
+        other = Satellite6DestinationInfo(env='env', owner='other')
+        self.assertEqual(destination_key(info), destination_key(same))
+        self.assertNotEqual(destination_key(info), destination_key(other))
+
+    def test_destination_key_identity(self):
+        # Host registered to another server or as another consumer doesn't
+        # reuse the hashes sent to the old one
+        info = DefaultDestinationInfo()
+        identity = ['candlepin.example.com', '443', 'consumer-1']
+        key = destination_key(info, identity)
+        self.assertEqual(key, destination_key(info, list(identity)))
+        self.assertNotEqual(key, destination_key(info, ['other.example.com', '443', 'consumer-1']))
+        self.assertNotEqual(key, destination_key(info, ['candlepin.example.com', '443', 'consumer-2']))
+        self.assertNotEqual(key, destination_key(info))
+
+        state = SentState(self.filename)
+        state.update(key, {'source1': 'hash1'})
+        reregistered = destination_key(info, ['candlepin.example.com', '443', 'consumer-2'])
+        self.assertEqual(SentState(self.filename).get(reregistered), {})
+
+
+class TestDestinationThreadState(TestBase):
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.state_dir)
+        self.filename = os.path.join(self.state_dir, 'state.json')
+
+    def create_thread(self, datastore, oneshot=False, source_keys=None):
+        options = Mock()
+        options.print_ = False
+        return DestinationThread(Mock(), Config('dest', 'esx'),
+                                 source_keys=source_keys or ['source1'], source=datastore,
+                                 dest=Mock(), interval=1, terminate_event=Mock(),
+                                 oneshot=oneshot, options=options,
+                                 state=SentState(self.filename), state_key='dest')
+
+    def test_sent_reports_are_skipped_after_restart(self):
+        report = DomainListReport(Config('source1', 'esx'),
+                                  [Guest('GUUID1', xvirt, Guest.STATE_RUNNING)])
+        datastore = {'source1': report}
+        destination_thread = self.create_thread(datastore)
+        destination_thread._send_data(destination_thread._get_data())
+        self.assertEqual(SentState(self.filename).get('dest'), {'source1': report.hash})
+
+        restarted = self.create_thread(datastore)
+        self.assertEqual(restarted._get_data(), {})
+        # Oneshot always sends the report
+        self.assertEqual(self.create_thread(datastore, oneshot=True)._get_data(),
+                         {'source1': report})
+
+    def test_check_in_is_saved_once(self):
+        datastore = dict(
+            (source_key, HostGuestAssociationReport(Config(source_key, 'esx'), {
+                'hypervisors': [Hypervisor(source_key + '-host', [
+                    Guest(source_key + '-guest', xvirt, Guest.STATE_RUNNING)])]}))
+            for source_key in ('source1', 'source2'))
+        destination_thread = self.create_thread(datastore,
+                                                source_keys=['source1', 'source2'])
+
+        def check_in(report, options=None):
+            report.state = AbstractVirtReport.STATE_FINISHED
+        destination_thread.dest.hypervisorCheckIn.side_effect = check_in
+        with patch.object(destination_thread.state, '_save',
+                          wraps=destination_thread.state._save) as save:
+            destination_thread._send_data(destination_thread._get_data())
+            save.assert_called_once()
+        self.assertEqual(SentState(self.filename).get('dest'), {
+            'source1': datastore['source1'].hash,
+            'source2': datastore['source2'].hash,
+        })
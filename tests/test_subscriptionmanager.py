@@ -1,15 +1,24 @@
 import os
 import sys
+import json
+import zlib
+import socket
+import ssl
 import shutil
 import tempfile
 
 from mock import patch, Mock, DEFAULT, MagicMock, ANY
+from threading import Event, Thread
 
 from base import TestBase, unittest
 
+import rhsm.connection as rhsm_connection
+
 from virtwho.config import Config, ConfigManager
-from virtwho.manager import Manager
+from virtwho.datastore import Datastore
+from virtwho.manager import Manager, ManagerError
 from virtwho.manager.subscriptionmanager import SubscriptionManager
+from virtwho.manager.subscriptionmanager.subscriptionmanager import GzipBuffer
 from virtwho.virt import Guest, Hypervisor, HostGuestAssociationReport, DomainListReport, AbstractVirtReport
 from virtwho.parser import parseOptions
 
@@ -47,6 +56,10 @@ class TestSubscriptionManager(TestBase):
     def tearDownClass(cls):
         shutil.rmtree(cls.tempdir)
 
+    def setUp(self):
+        # Each test patches UEPConnection, don't use connections from previous one
+        self.sm._connections.clear()
+
     @patch('rhsm.connection.UEPConnection')
     def test_sendVirtGuests(self, rhsmconnection):
         config = Config('test', 'libvirt')
@@ -54,8 +67,22 @@ class TestSubscriptionManager(TestBase):
         self.sm.sendVirtGuests(report)
         self.sm.connection.updateConsumer.assert_called_with(
             123,
-            guest_uuids=[g.toDict() for g in self.guestList],
+            guest_uuids=[g.toDict() for g in sorted(self.guestList, key=lambda g: g.uuid)],
+            hypervisor_id=self.hypervisor_id)
+
+    @patch('rhsm.connection.UEPConnection')
+    def test_sendVirtGuests_frozen(self, rhsmconnection):
+        config = Config('test', 'libvirt')
+        datastore = Datastore(mode=Datastore.FROZEN)
+        datastore.put('test', DomainListReport(config, self.guestList, self.hypervisor_id))
+        report = datastore.get('test')
+        self.assertTrue(report.frozen)
+        self.sm.sendVirtGuests(report)
+        self.sm.connection.updateConsumer.assert_called_with(
+            123,
+            guest_uuids=[g.toDict() for g in sorted(self.guestList, key=lambda g: g.uuid)],
             hypervisor_id=self.hypervisor_id)
+        self.assertEqual(report.state, AbstractVirtReport.STATE_FINISHED)
 
     @patch('rhsm.connection.UEPConnection')
     def test_hypervisorCheckIn(self, rhsmconnection):
@@ -89,6 +116,279 @@ class TestSubscriptionManager(TestBase):
             options=None
         )
 
+    def test_gzip_buffer(self):
+        data = {'hypervisors': [h.toDict() for h in self.mapping['hypervisors']] * 100}
+        out = GzipBuffer()
+        for chunk in json.JSONEncoder().iterencode(data):
+            out.write(chunk)
+        body = out.getvalue()
+        raw = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        self.assertEqual(json.loads(raw), data)
+        self.assertEqual(out.size, len(raw))
+        self.assertLess(len(body), out.size / 10)
+
+    @patch.object(SubscriptionManager, '_post')
+    @patch('rhsm.connection.UEPConnection')
+    def test_hypervisorCheckInCompressed(self, rhsmconnection, post):
+        self.sm.compression_rejected = False
+        rhsmconnection.return_value.has_capability.return_value = True
+        post.return_value = (200, {}, '{"id": "job-id"}')
+        config = Config("test", "esx", owner='owner', env='env')
+        report = HostGuestAssociationReport(config, self.mapping)
+        options = Mock(compress_checkin=True, reporter_id='reporter')
+        self.sm.hypervisorCheckIn(report, options=options)
+
+        self.sm.connection.hypervisorCheckIn.assert_not_called()
+        self.assertEqual(report.job_id, 'job-id')
+        path, body, headers = post.call_args[0]
+        self.assertTrue(path.startswith('/hypervisors/owner?'))
+        self.assertTrue('reporter_id=reporter' in path)
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(zlib.decompress(body, 16 + zlib.MAX_WBITS)),
+                         {'hypervisors': [h.toDict() for h in self.mapping['hypervisors']]})
+
+    @patch.object(SubscriptionManager, '_post')
+    @patch('rhsm.connection.UEPConnection')
+    def test_hypervisorCheckInCompressionRejected(self, rhsmconnection, post):
+        self.sm.compression_rejected = False
+        rhsmconnection.return_value.has_capability.return_value = True
+        post.return_value = (415, {}, '')
+        config = Config("test", "esx", owner='owner', env='env')
+        options = Mock(compress_checkin=True, reporter_id='reporter')
+        self.sm.hypervisorCheckIn(HostGuestAssociationReport(config, self.mapping),
+                                  options=options)
+        self.assertTrue(self.sm.compression_rejected)
+        self.sm.connection.hypervisorCheckIn.assert_called_with(
+            'owner', 'env', {'hypervisors': [h.toDict() for h in self.mapping['hypervisors']]},
+            options=options)
+
+        # Compression is not tried again
+        post.reset_mock()
+        self.sm.hypervisorCheckIn(HostGuestAssociationReport(config, self.mapping),
+                                  options=options)
+        post.assert_not_called()
+        self.sm.compression_rejected = False
+
+    @patch.object(SubscriptionManager, '_post')
+    @patch('rhsm.connection.UEPConnection')
+    def test_hypervisorCheckInCompressedSync(self, rhsmconnection, post):
+        self.sm.compression_rejected = False
+        rhsmconnection.return_value.has_capability.return_value = False
+        post.return_value = (200, {}, '{}')
+        config = Config("test", "esx", owner='owner', env='env')
+        report = HostGuestAssociationReport(config, self.mapping)
+        self.sm.hypervisorCheckIn(report, options=Mock(compress_checkin=True))
+        self.sm.connection.hypervisorCheckIn.assert_not_called()
+        self.assertEqual(report.state, AbstractVirtReport.STATE_FINISHED)
+        path, body, headers = post.call_args[0]
+        self.assertTrue(path.startswith('/hypervisors?'))
+        self.assertEqual(json.loads(zlib.decompress(body, 16 + zlib.MAX_WBITS)),
+                         {'123': sorted([g.toDict() for g in self.guestList],
+                                        key=lambda g: g['guestId'])})
+
+    @patch.object(SubscriptionManager, '_post')
+    @patch('rhsm.connection.UEPConnection')
+    def test_hypervisorCheckInCompressedBadRequest(self, rhsmconnection, post):
+        self.sm.compression_rejected = False
+        self.addCleanup(setattr, self.sm, 'compression_rejected', False)
+        rhsmconnection.return_value.has_capability.return_value = True
+        post.return_value = (400, {}, '{"displayMessage": "Bad request"}')
+        config = Config("test", "esx", owner='owner', env='env')
+        options = Mock(compress_checkin=True, reporter_id='reporter')
+
+        # The report itself is wrong, compression is still used
+        rhsmconnection.return_value.hypervisorCheckIn.side_effect = \
+            rhsm_connection.RestlibException(400, 'Bad request')
+        self.assertRaises(ManagerError, self.sm.hypervisorCheckIn,
+                          HostGuestAssociationReport(config, self.mapping), options=options)
+        self.assertFalse(self.sm.compression_rejected)
+
+        # The same check-in succeeds uncompressed
+        rhsmconnection.return_value.hypervisorCheckIn.side_effect = None
+        rhsmconnection.return_value.hypervisorCheckIn.return_value = {'id': 'job-id'}
+        report = HostGuestAssociationReport(config, self.mapping)
+        self.sm.hypervisorCheckIn(report, options=options)
+        self.assertEqual(report.job_id, 'job-id')
+        self.assertTrue(self.sm.compression_rejected)
+
+    @patch.object(SubscriptionManager, '_post')
+    @patch('rhsm.connection.UEPConnection')
+    def test_hypervisorCheckInCompressionUnsupported(self, rhsmconnection, post):
+        self.sm.compression_rejected = False
+        self.addCleanup(setattr, self.sm, 'compression_rejected', False)
+        rhsmconnection.return_value.has_capability.return_value = True
+        rhsmconnection.return_value.hypervisorCheckIn.return_value = {'id': 'job-id'}
+        post.return_value = None
+        config = Config("test", "esx", owner='owner', env='env')
+        options = Mock(compress_checkin=True, reporter_id='reporter')
+        self.sm.hypervisorCheckIn(HostGuestAssociationReport(config, self.mapping),
+                                  options=options)
+        self.assertTrue(self.sm.connection.hypervisorCheckIn.called)
+        self.assertTrue(self.sm.compression_rejected)
+
+    @patch('httplib.HTTPSConnection')
+    def test_post_uses_rhsm_settings(self, https_connection):
+        self.addCleanup(self.sm._disconnect)
+        restlib = Mock(host='rhsm.host', ssl_port=443, apihandler='/prefix',
+                       headers={'Authorization': 'Basic xyz', 'Accept': 'application/json'},
+                       user_agent='RHSM/1.0', timeout=None, insecure=True, ca_dir=None,
+                       cert_file=None, key_file=None, proxy_hostname=None,
+                       proxy_port=None, proxy_user=None, proxy_password=None)
+        self.sm.connection = Mock(conn=restlib)
+        response = https_connection.return_value.getresponse.return_value
+        response.status = 202
+        response.getheaders.return_value = [('content-type', 'application/json')]
+        response.read.return_value = '{"id": "job-id"}'
+
+        # python-rhsm left out the proxy (because of no_proxy)
+        status, headers, content = self.sm._post('/hypervisors/owner', 'body',
+                                                 {'Content-Encoding': 'gzip'})
+        self.assertEqual(status, 202)
+        self.assertEqual(https_connection.call_args[0], ('rhsm.host', 443))
+        https_connection.return_value.set_tunnel.assert_not_called()
+        method, url, body, request_headers = https_connection.return_value.request.call_args[0]
+        self.assertEqual(url, '/prefix/hypervisors/owner')
+        self.assertEqual(request_headers['Authorization'], 'Basic xyz')
+        self.assertEqual(request_headers['Content-Encoding'], 'gzip')
+
+        restlib.proxy_hostname = 'proxy.host'
+        restlib.proxy_port = '3128'
+        https_connection.reset_mock()
+        self.sm._post('/hypervisors/owner', 'body', {})
+        self.assertEqual(https_connection.call_args[0], ('proxy.host', 3128))
+        https_connection.return_value.set_tunnel.assert_called_once_with(
+            'rhsm.host', 443, {'User-Agent': 'RHSM/1.0'})
+
+        # Python without SSLContext (older than 2.7.9)
+        https_connection.reset_mock()
+        ssl_context = ssl.SSLContext
+        del ssl.SSLContext
+        try:
+            self.assertEqual(self.sm._post('/hypervisors/owner', 'body', {}), None)
+        finally:
+            ssl.SSLContext = ssl_context
+        https_connection.assert_not_called()
+
+    @patch('rhsm.connection.UEPConnection')
+    def test_connection_reused(self, rhsmconnection):
+        rhsmconnection.return_value.has_capability.return_value = True
+        rhsmconnection.return_value.hypervisorCheckIn.return_value = {'id': 'job-id'}
+        rhsmconnection.return_value.getJob.return_value = {'state': 'RUNNING'}
+        config = Config("test", "esx", owner='owner', env='env')
+        reused = self.sm.connections_reused
+        for _ in range(3):
+            report = HostGuestAssociationReport(config, self.mapping)
+            self.sm.hypervisorCheckIn(report)
+            self.sm.check_report_state(report)
+
+        rhsmconnection.assert_called_once()
+        self.assertEqual(rhsmconnection.return_value.ping.call_count, 1)
+        self.assertEqual(self.sm.connections_reused - reused, 5)
+
+    @patch('rhsm.connection.UEPConnection')
+    def test_connection_taken_over_by_new_thread(self, rhsmconnection):
+        rhsmconnection.side_effect = lambda **kwargs: Mock(**{
+            'ping.return_value': {'result': True},
+            'has_capability.return_value': False})
+        config = Config("test", "esx", owner='owner', env='env')
+        connections = []
+        both_connected = Event()
+        connected = []
+
+        def check_in(wait):
+            self.sm.hypervisorCheckIn(HostGuestAssociationReport(config, self.mapping))
+            connections.append(self.sm.connection)
+            connected.append(True)
+            if len(connected) == 2:
+                both_connected.set()
+            if wait:
+                both_connected.wait(5)
+
+        # Threads running at the same time have a connection each
+        threads = [Thread(target=check_in, args=(True,)) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(rhsmconnection.call_count, 2)
+        self.assertFalse(connections[0] is connections[1])
+
+        # The next threads take them over
+        threads = [Thread(target=check_in, args=(False,)) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+            thread.join()
+        self.assertEqual(rhsmconnection.call_count, 2)
+        self.assertEqual(set(connections[2:]) - set(connections[:2]), set())
+
+    @patch('rhsm.connection.UEPConnection')
+    def test_ping_error_is_manager_error(self, rhsmconnection):
+        rhsmconnection.return_value.ping.side_effect = socket.error("Connection refused")
+        self.assertRaises(ManagerError, self.sm._connect)
+        self.assertIsNone(self.sm.connection)
+        rhsmconnection.return_value.ping.side_effect = None
+        rhsmconnection.return_value.ping.return_value = {'result': True}
+        self.sm._connect()
+        self.assertEqual(rhsmconnection.call_count, 2)
+
+    @patch('rhsm.connection.UEPConnection')
+    def test_reconnect_on_connection_error(self, rhsmconnection):
+        rhsmconnection.return_value.has_capability.return_value = False
+        rhsmconnection.return_value.hypervisorCheckIn.side_effect = [socket.error("reset"), {}]
+        config = Config("test", "esx", owner='owner', env='env')
+        self.assertRaises(ManagerError, self.sm.hypervisorCheckIn,
+                          HostGuestAssociationReport(config, self.mapping))
+        self.assertIsNone(self.sm.connection)
+        self.sm.hypervisorCheckIn(HostGuestAssociationReport(config, self.mapping))
+        self.assertEqual(rhsmconnection.call_count, 2)
+
+    @patch('rhsm.connection.UEPConnection')
+    def test_capabilities_of_connection(self, rhsmconnection):
+        # The format of the check-in follows the capabilities of the
+        # connection it's sent with, as python-rhsm decides by them too
+        connections = [
+            Mock(**{'ping.return_value': {'result': True},
+                    'has_capability.return_value': False}),
+            Mock(**{'ping.return_value': {'result': True},
+                    'has_capability.return_value': True,
+                    'hypervisorCheckIn.return_value': {'id': 'job-id'}}),
+        ]
+        rhsmconnection.side_effect = connections
+        config = Config("test", "esx", owner='owner', env='env')
+        report = HostGuestAssociationReport(config, self.mapping)
+        self.sm.hypervisorCheckIn(report)
+        self.assertEqual(report.state, AbstractVirtReport.STATE_FINISHED)
+        self.sm._disconnect()
+        report = HostGuestAssociationReport(config, self.mapping)
+        self.sm.hypervisorCheckIn(report)
+        self.assertEqual(report.state, AbstractVirtReport.STATE_PROCESSING)
+        self.assertEqual(report.job_id, 'job-id')
+
+    def test_server(self):
+        self.addCleanup(setattr, self.sm, 'rhsm_config', self.sm.rhsm_config)
+        self.sm.rhsm_config = Mock()
+        self.sm.rhsm_config.get.side_effect = lambda section, key: {
+            'hostname': 'rhsm.conf.host', 'port': '443'}.get(key)
+        config = Config("test", "esx", owner='owner', env='env',
+                        rhsm_hostname='config.host')
+        self.assertEqual(self.sm.server(HostGuestAssociationReport(config, self.mapping)),
+                         'config.host:443')
+        # Guest lists are sent with settings from rhsm.conf
+        self.assertEqual(self.sm.server(DomainListReport(config, self.guestList)),
+                         'rhsm.conf.host:443')
+
+    def test_identity(self):
+        self.addCleanup(setattr, self.sm, 'rhsm_config', self.sm.rhsm_config)
+        self.sm.rhsm_config = Mock()
+        self.sm.rhsm_config.get.side_effect = lambda section, key: {
+            'hostname': 'rhsm.conf.host', 'port': '443'}.get(key)
+        self.assertEqual(self.sm.identity(), ['rhsm.conf.host', '443', 123])
+        # Not registered
+        self.addCleanup(setattr, self.sm, 'cert_uuid', self.sm.cert_uuid)
+        self.sm.cert_uuid = None
+        with patch('rhsm.certificate.create_from_file', side_effect=IOError('No such file')):
+            self.assertEqual(self.sm.identity(), ['rhsm.conf.host', '443', None])
+
     @patch('rhsm.connection.UEPConnection')
     def test_job_status(self, rhsmconnection):
         rhsmconnection.return_value.has_capability.return_value = True
@@ -1,17 +1,27 @@
 
 import os
+import time
+import json
+import hashlib
+import pickle
 import tempfile
 import shutil
+import socket
 
 from base import TestBase
 
 from mock import Mock, patch, call
 from threading import Event
+from operator import itemgetter
 
 from virtwho.config import ConfigManager, Config
+from virtwho import ratelimit
+from virtwho.datastore import Datastore
 from virtwho.manager import ManagerThrottleError, ManagerFatalError
-from virtwho.virt import HostGuestAssociationReport, Hypervisor, Guest, \
-    DestinationThread, ErrorReport, AbstractVirtReport, DomainListReport
+from virtwho.virt import HostGuestAssociationReport, Hypervisor, Guest, GuestCache, \
+    DestinationThread, ErrorReport, AbstractVirtReport, DomainListReport, \
+    HostFilter, ReportDiff, ReportSerializer, ReportHasher, ChangeJournal, \
+    Virt
 
 
 xvirt = type("", (), {'CONFIG_TYPE': 'xxx'})()
@@ -90,6 +100,494 @@ env=env
         }
 
 
+class TestHostFilter(TestBase):
+    def test_exact(self):
+        host_filter = HostFilter(['12345', 'Host.Example.com'])
+        self.assertTrue(host_filter.match('12345'))
+        self.assertTrue(host_filter.match('host.example.COM'))
+        self.assertFalse(host_filter.match('123456'))
+        # dot is still a regex wildcard
+        self.assertTrue(host_filter.match('hostXexample.com'))
+
+    def test_glob(self):
+        host_filter = HostFilter(['12*', 'AB?D', 'x[yz]'])
+        self.assertTrue(host_filter.match('12345'))
+        self.assertTrue(host_filter.match('abcd'))
+        self.assertTrue(host_filter.match('XZ'))
+        self.assertFalse(host_filter.match('0012'))
+        self.assertFalse(host_filter.match('xa'))
+
+    def test_regex(self):
+        host_filter = HostFilter(['12.+45', 'ab(c|d)e', 'host-\\d+'])
+        self.assertTrue(host_filter.match('12345'))
+        self.assertTrue(host_filter.match('ABDE'))
+        self.assertTrue(host_filter.match('host-42'))
+        self.assertFalse(host_filter.match('1245'))
+        self.assertFalse(host_filter.match('host-42x'))
+
+    def test_invalid_regex_is_ignored(self):
+        host_filter = HostFilter(['invalid[', '(also', '12345'])
+        self.assertTrue(host_filter.match('12345'))
+        self.assertTrue(host_filter.match('invalid['))
+        self.assertFalse(host_filter.match('also'))
+
+    def test_many_groups(self):
+        # More groups than one regular expression can hold
+        host_filter = HostFilter(['(host)-%d' % i for i in range(200)])
+        self.assertTrue(host_filter.match('host-0'))
+        self.assertTrue(host_filter.match('HOST-199'))
+        self.assertFalse(host_filter.match('host-200'))
+
+    def test_backreferences(self):
+        host_filter = HostFilter(['(a)(b)\\2', '(c)\\1'])
+        self.assertTrue(host_filter.match('abb'))
+        self.assertFalse(host_filter.match('aba'))
+        self.assertTrue(host_filter.match('CC'))
+        self.assertFalse(host_filter.match('ca'))
+
+    def test_named_groups(self):
+        host_filter = HostFilter(['x(?P<n>y)(?P=n)', 'z(?P<n>w)', 'host-.*'])
+        self.assertTrue(host_filter.match('xyy'))
+        self.assertTrue(host_filter.match('zw'))
+        self.assertTrue(host_filter.match('host-1'))
+
+    def test_filter_is_reused(self):
+        patterns = ['%05d' % i for i in range(5000)]
+        host_filter = HostFilter.get(patterns)
+        self.assertTrue(HostFilter.get(list(patterns)) is host_filter)
+        self.assertTrue(pickle.loads(pickle.dumps(host_filter)) is host_filter)
+        self.assertTrue(host_filter.match('04999'))
+        self.assertFalse(host_filter.match('05000'))
+
+
+class TestReportModel(TestBase):
+    def test_guest_has_no_dict(self):
+        guest = Guest('guest-1', xvirt, Guest.STATE_RUNNING)
+        self.assertFalse(hasattr(guest, '__dict__'))
+        hypervisor = Hypervisor('12345', guestIds=[guest])
+        self.assertFalse(hasattr(hypervisor, '__dict__'))
+
+    def test_guest_virt_type_is_shared(self):
+        guest1 = Guest('guest-1', xvirt, Guest.STATE_RUNNING)
+        other_virt = type("", (), {'CONFIG_TYPE': ''.join(['x', 'xx'])})()
+        guest2 = Guest('guest-2', other_virt, Guest.STATE_SHUTOFF)
+        self.assertTrue(guest1.virtWhoType is guest2.virtWhoType)
+
+    def test_guest_state_is_int(self):
+        guest = Guest('guest-1', xvirt, '1')
+        self.assertEqual(guest.state, Guest.STATE_RUNNING)
+        self.assertEqual(guest.toDict()['attributes']['active'], 1)
+
+    def test_pickle_roundtrip(self):
+        guest = Guest('guest-1', xvirt, Guest.STATE_PAUSED)
+        hypervisor = Hypervisor('12345', guestIds=[guest], name='host',
+                                facts={Hypervisor.CPU_SOCKET_FACT: '2'})
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            restored = pickle.loads(pickle.dumps(hypervisor, protocol))
+            self.assertEqual(restored.toDict(), hypervisor.toDict())
+            self.assertTrue(restored.guestIds[0].virtWhoType is guest.virtWhoType)
+
+    def create_report(self, state=Guest.STATE_RUNNING, **kwargs):
+        hypervisors = [
+            Hypervisor('12345', guestIds=[Guest('guest-1', xvirt, state)]),
+            Hypervisor('00000', guestIds=[Guest('guest-2', xvirt, Guest.STATE_RUNNING)]),
+        ]
+        return HostGuestAssociationReport(Config('test', 'esx'), {'hypervisors': hypervisors}, **kwargs)
+
+    def test_hypervisor_hash_is_cached(self):
+        hypervisor = Hypervisor('12345', guestIds=[Guest('guest-1', xvirt, Guest.STATE_RUNNING)])
+        digest = hypervisor.getHash()
+        with patch.object(Hypervisor, 'toDict') as toDict:
+            self.assertEqual(hypervisor.getHash(), digest)
+            toDict.assert_not_called()
+        hypervisor.name = 'renamed'
+        self.assertNotEqual(hypervisor.getHash(), digest)
+
+    def test_report_hash(self):
+        report = self.create_report()
+        self.assertEqual(report.hash, self.create_report().hash)
+        self.assertNotEqual(report.hash, self.create_report(state=Guest.STATE_SHUTOFF).hash)
+        self.assertNotEqual(report.hash, self.create_report(exclude_hosts=['00000']).hash)
+
+    def test_report_hash_is_cached(self):
+        report = self.create_report()
+        digest = report.hash
+        restored = pickle.loads(pickle.dumps(report))
+        with patch.object(Hypervisor, 'getHash') as getHash:
+            self.assertEqual(report.hash, digest)
+            self.assertEqual(restored.hash, digest)
+            getHash.assert_not_called()
+
+    def test_report_hash_reset_on_filter_change(self):
+        report = self.create_report()
+        digest = report.hash
+        report.exclude_hosts = ['00000']
+        self.assertNotEqual(report.hash, digest)
+        self.assertEqual(report.hash, self.create_report(exclude_hosts=['00000']).hash)
+
+    def test_association_is_computed_once(self):
+        report = self.create_report(exclude_hosts=['00000'])
+        self.assertEqual(report.association_computations, 0)
+        report.association
+        report.serializedAssociation
+        report.hash
+        self.assertEqual(len(report.association['hypervisors']), 1)
+        self.assertEqual(report.association_computations, 1)
+
+    def test_association_invalidation(self):
+        report = self.create_report()
+        self.assertEqual(len(report.association['hypervisors']), 2)
+        report.filter_hosts = ['00000']
+        self.assertEqual([h.hypervisorId for h in report.association['hypervisors']],
+                         ['00000'])
+        self.assertEqual(report.association_computations, 2)
+
+        report._assoc['hypervisors'].pop()
+        report.invalidate()
+        self.assertEqual(report.association['hypervisors'], [])
+        self.assertEqual(report.association_computations, 3)
+
+
+class TestGuestCache(TestBase):
+    def test_guests_are_shared(self):
+        cache = GuestCache()
+        guest = cache.get('guest-1', xvirt, Guest.STATE_RUNNING)
+        self.assertTrue(cache.get('guest-1', xvirt, '1') is guest)
+        cache.rotate()
+        self.assertTrue(cache.get('guest-1', xvirt, Guest.STATE_RUNNING) is guest)
+        self.assertFalse(cache.get('guest-1', xvirt, Guest.STATE_SHUTOFF) is guest)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+        # Shared guests don't keep the dict around
+        self.assertFalse(guest.toDict() is guest.toDict())
+
+    def test_unused_guests_are_evicted(self):
+        cache = GuestCache()
+        guest = cache.get('guest-1', xvirt, Guest.STATE_RUNNING)
+        cache.rotate()
+        cache.rotate()
+        self.assertFalse(cache.get('guest-1', xvirt, Guest.STATE_RUNNING) is guest)
+
+    def test_size_limit(self):
+        cache = GuestCache(size=2)
+        guests = [cache.get('guest-%d' % i, xvirt, Guest.STATE_RUNNING) for i in range(5)]
+        self.assertTrue(cache.get('guest-4', xvirt, Guest.STATE_RUNNING) is guests[4])
+        self.assertFalse(cache.get('guest-0', xvirt, Guest.STATE_RUNNING) is guests[0])
+
+    def test_guest_is_immutable(self):
+        guest = Guest('guest-1', xvirt, Guest.STATE_RUNNING)
+        self.assertRaises(AttributeError, setattr, guest, 'state', Guest.STATE_SHUTOFF)
+        restored = pickle.loads(pickle.dumps(guest))
+        self.assertEqual(restored.toDict(), guest.toDict())
+        self.assertRaises(AttributeError, setattr, restored, 'uuid', 'guest-2')
+
+    def test_virt_shares_guests_between_reports(self):
+        virt = Virt(Mock(), Config('test', 'esx', journal_size=0), dest=Mock(), interval=60)
+        virt.CONFIG_TYPE = 'esx'
+        first = [virt.sharedGuest('guest-%d' % i, Guest.STATE_RUNNING) for i in range(3)]
+        virt._send_data(HostGuestAssociationReport(
+            virt.config, {'hypervisors': [Hypervisor('host', first)]}))
+        second = [virt.sharedGuest('guest-%d' % i, Guest.STATE_RUNNING) for i in range(3)]
+        self.assertTrue(all(a is b for a, b in zip(first, second)))
+
+
+class TestReportSerializer(TestBase):
+    def create_report(self):
+        unicode_virt = type("", (), {'CONFIG_TYPE': u'fake'})()
+        hypervisors = [
+            Hypervisor('12345', guestIds=[
+                Guest('guest-2', xvirt, Guest.STATE_RUNNING),
+                Guest(u'guest-\u00e9', unicode_virt, Guest.STATE_PAUSED),
+                Guest('guest-1', xvirt, Guest.STATE_SHUTOFF),
+            ], name='host1', facts={
+                Hypervisor.CPU_SOCKET_FACT: '2',
+                Hypervisor.HYPERVISOR_TYPE_FACT: 'esx',
+            }),
+            Hypervisor('00000'),
+            Hypervisor('67890', guestIds=[Guest('guest-3', xvirt, Guest.STATE_UNKNOWN)], name=None),
+        ]
+        return HostGuestAssociationReport(Config('test', 'esx'), {'hypervisors': hypervisors})
+
+    def serialize(self, method, obj, chunk_size=64 * 1024):
+        out = Mock()
+        serializer = ReportSerializer(out, chunk_size=chunk_size)
+        getattr(serializer, method)(obj)
+        serializer.flush()
+        return out.write.call_args_list
+
+    def test_association_is_canonical(self):
+        report = self.create_report()
+        chunks = self.serialize('write_association', report)
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(chunks[0][0][0], json.dumps(report.serializedAssociation, sort_keys=True))
+
+    def test_chunks(self):
+        report = self.create_report()
+        chunks = self.serialize('write_association', report, chunk_size=16)
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(''.join(args[0] for args, kwargs in chunks),
+                         json.dumps(report.serializedAssociation, sort_keys=True))
+
+    def test_guest_mapping(self):
+        report = self.create_report()
+        chunks = self.serialize('write_guest_mapping', report, chunk_size=16)
+        expected = dict((hypervisor.hypervisorId,
+                         sorted([guest.toDict() for guest in hypervisor.guestIds],
+                                key=itemgetter('guestId')))
+                        for hypervisor in report.association['hypervisors'])
+        self.assertEqual(json.loads(''.join(args[0] for args, kwargs in chunks)), expected)
+
+    @patch.object(ReportHasher, 'mode', ReportHasher.JSON)
+    def test_json_hashes_are_compatible(self):
+        report = self.create_report()
+        for hypervisor in report.association['hypervisors']:
+            self.assertEqual(
+                hypervisor.getHash(),
+                hashlib.sha256(json.dumps(hypervisor.toDict(), sort_keys=True)).hexdigest())
+
+        guests = report.association['hypervisors'][0].guestIds
+        domain_report = DomainListReport(Config('test', 'libvirt'), guests, 'hypervisor-id')
+        self.assertEqual(
+            domain_report.hash,
+            hashlib.sha256(
+                json.dumps(sorted([g.toDict() for g in guests], key=itemgetter('guestId')),
+                           sort_keys=True) + 'hypervisor-id').hexdigest())
+
+
+class TestReportHasher(TestBase):
+    def digest(self, hypervisorId='12345', guests=(('guest-1', Guest.STATE_RUNNING),),
+               name='host', facts=None):
+        hypervisor = Hypervisor(hypervisorId, name=name, facts=facts, guestIds=[
+            Guest(uuid, xvirt, state) for uuid, state in guests])
+        return ReportHasher.hypervisor_digest(hypervisor)
+
+    def test_default_mode_is_binary(self):
+        self.assertEqual(ReportHasher.mode, ReportHasher.BINARY)
+        with patch.object(ReportHasher, 'mode', ReportHasher.JSON):
+            json_digest = self.digest()
+        self.assertNotEqual(self.digest(), json_digest)
+
+    def test_order_independent(self):
+        guests = (('guest-1', Guest.STATE_RUNNING), ('guest-2', Guest.STATE_SHUTOFF))
+        facts = dict(('fact%d' % i, str(i)) for i in range(20))
+        self.assertEqual(self.digest(guests=guests, facts=facts),
+                         self.digest(guests=reversed(guests), facts=dict(reversed(facts.items()))))
+
+    def test_fields_are_distinguished(self):
+        digests = set([
+            self.digest(),
+            self.digest(hypervisorId='12346'),
+            self.digest(name=None),
+            self.digest(name=''),
+            self.digest(facts={}),
+            self.digest(facts={'a': 'b'}),
+            self.digest(facts={'a': 'b', 'c': 'd'}),
+            self.digest(guests=()),
+            self.digest(guests=(('guest-1', Guest.STATE_SHUTOFF),)),
+            self.digest(guests=(('guest-1', Guest.STATE_RUNNING), ('guest-2', Guest.STATE_RUNNING))),
+            # Concatenation of the fields is the same as for the default
+            self.digest(hypervisorId='1234', name='5host'),
+        ])
+        self.assertEqual(len(digests), 11)
+
+    def test_guests_digest(self):
+        guests = [Guest('guest-1', xvirt, Guest.STATE_RUNNING)]
+        self.assertNotEqual(ReportHasher.guests_digest(guests, 'host1'),
+                            ReportHasher.guests_digest(guests, 'host2'))
+        self.assertNotEqual(ReportHasher.guests_digest(guests, None),
+                            ReportHasher.guests_digest(guests, 'None'))
+
+
+class TestReportDiff(TestBase):
+    def create_report(self, hosts):
+        hypervisors = [
+            Hypervisor(host_id, guestIds=[Guest(uuid, xvirt, state) for uuid, state in guests])
+            for host_id, guests in hosts
+        ]
+        return HostGuestAssociationReport(Config('test', 'esx'), {'hypervisors': hypervisors})
+
+    def test_no_changes(self):
+        hosts = [('host1', [('guest1', Guest.STATE_RUNNING)]), ('host2', [])]
+        diff = ReportDiff(self.create_report(hosts), self.create_report(hosts))
+        self.assertFalse(diff)
+        self.assertEqual(diff.summary(), 'no changes')
+
+    def test_no_previous_report(self):
+        current = self.create_report([('host1', [('guest1', Guest.STATE_RUNNING)])])
+        diff = ReportDiff(None, current)
+        self.assertEqual([h.hypervisorId for h in diff.added_hypervisors], ['host1'])
+        self.assertEqual(diff.removed_hypervisors, [])
+
+    def test_changes(self):
+        previous = self.create_report([
+            ('host1', [('guest1', Guest.STATE_RUNNING), ('guest2', Guest.STATE_RUNNING)]),
+            ('host2', [('guest3', Guest.STATE_RUNNING)]),
+            ('host3', [('guest4', Guest.STATE_RUNNING)]),
+        ])
+        current = self.create_report([
+            ('host1', [('guest1', Guest.STATE_SHUTOFF), ('guest5', Guest.STATE_RUNNING)]),
+            ('host2', [('guest3', Guest.STATE_RUNNING), ('guest2', Guest.STATE_RUNNING)]),
+            ('host4', [('guest4', Guest.STATE_RUNNING)]),
+        ])
+        diff = ReportDiff(previous, current)
+        self.assertTrue(diff)
+        self.assertEqual([h.hypervisorId for h in diff.added_hypervisors], ['host4'])
+        self.assertEqual([h.hypervisorId for h in diff.removed_hypervisors], ['host3'])
+        self.assertEqual([h.hypervisorId for h in diff.changed_hypervisors], ['host1', 'host2'])
+
+        host1, host2 = diff.changed_hypervisors
+        self.assertEqual([g.uuid for g in host1.added_guests], ['guest5'])
+        self.assertEqual([g.uuid for g in host1.removed_guests], ['guest2'])
+        self.assertEqual([(old.state, new.state) for old, new in host1.changed_guests],
+                         [(Guest.STATE_RUNNING, Guest.STATE_SHUTOFF)])
+        self.assertEqual([g.uuid for g in host2.added_guests], ['guest2'])
+        self.assertEqual(host2.removed_guests, [])
+        self.assertEqual(host2.changed_guests, [])
+
+        self.assertEqual(diff.moved_guests, [
+            ('guest2', 'host1', 'host2'),
+            ('guest4', 'host3', 'host4'),
+        ])
+        self.assertEqual(diff.summary(),
+                         'hypervisors: 1 added, 1 removed, 2 changed; '
+                         'guests: 3 added, 2 removed, 2 moved, 1 changed state')
+
+    def test_unchanged_hypervisors_are_skipped(self):
+        hosts = [('host%d' % i, [('guest%d' % i, Guest.STATE_RUNNING)]) for i in range(10)]
+        previous = self.create_report(hosts)
+        hosts[3] = ('host3', [])
+        current = self.create_report(hosts)
+        with patch('virtwho.virt.virt.HypervisorDiff') as hypervisor_diff:
+            diff = ReportDiff(previous, current)
+        self.assertEqual(hypervisor_diff.call_count, 1)
+        self.assertEqual(len(diff.changed_hypervisors), 1)
+
+
+class TestChangeJournal(TestBase):
+    def create_report(self, hosts, **kwargs):
+        hypervisors = [
+            Hypervisor(host_id, guestIds=[Guest(uuid, xvirt, state) for uuid, state in guests])
+            for host_id, guests in hosts
+        ]
+        return HostGuestAssociationReport(Config('journal', 'esx', **kwargs),
+                                          {'hypervisors': hypervisors})
+
+    def setUp(self):
+        super(TestChangeJournal, self).setUp()
+        self.addCleanup(ChangeJournal._journals.pop, 'journal', None)
+
+    def test_record(self):
+        previous = self.create_report([
+            ('host1', [('guest1', Guest.STATE_RUNNING), ('guest2', Guest.STATE_RUNNING)]),
+            ('host2', [('guest3', Guest.STATE_RUNNING)]),
+        ])
+        current = self.create_report([
+            ('host1', [('guest1', Guest.STATE_SHUTOFF), ('guest4', Guest.STATE_RUNNING)]),
+            ('host3', [('guest2', Guest.STATE_RUNNING), ('guest5', Guest.STATE_RUNNING)]),
+        ])
+        journal = ChangeJournal.get('journal')
+        self.assertEqual(journal.record(ReportDiff(previous, current), timestamp=10), 5)
+        self.assertEqual(
+            [(e.kind, e.hypervisorId, e.guestId, e.previous, e.current) for e in journal.events()],
+            [(ChangeJournal.HYPERVISOR_ADDED, 'host3', None, None, 2),
+             (ChangeJournal.HYPERVISOR_REMOVED, 'host2', None, 1, None),
+             (ChangeJournal.GUEST_MOVED, 'host3', 'guest2', 'host1', 'host3'),
+             (ChangeJournal.GUEST_ADDED, 'host1', 'guest4', None, None),
+             (ChangeJournal.GUEST_STATE_CHANGED, 'host1', 'guest1',
+              Guest.STATE_RUNNING, Guest.STATE_SHUTOFF)])
+        self.assertEqual(journal.events(since=10), [])
+
+        dump = json.loads(ChangeJournal.dump(['journal']))
+        self.assertEqual(len(dump['sources']['journal']), 5)
+        self.assertEqual(dump['sources']['journal'][2], {
+            'timestamp': 10, 'type': 'guest_moved', 'hypervisorId': 'host3',
+            'guestId': 'guest2', 'previous': 'host1', 'current': 'host3'})
+
+    def test_size_is_bounded(self):
+        journal = ChangeJournal.get('journal', size=3)
+        previous = self.create_report([('host1', [])])
+        for i in range(5):
+            current = self.create_report([('host1', [('guest%d' % i, Guest.STATE_RUNNING)])])
+            journal.record(ReportDiff(previous, current), timestamp=i)
+        self.assertEqual(len(journal), 3)
+        self.assertEqual([e.guestId for e in journal.events()], ['guest2', 'guest3', 'guest4'])
+        self.assertTrue(ChangeJournal.get('journal', size=3) is journal)
+
+    def test_virt_records_changes(self):
+        virt = Virt(Mock(), Config('journal', 'esx', journal_size=10), dest=Mock(),
+                    interval=60)
+        virt._send_data(self.create_report([('host1', [('guest1', Guest.STATE_RUNNING)])]))
+        journal = ChangeJournal.get('journal', 10)
+        self.assertEqual(len(journal), 0)
+        virt._send_data(self.create_report([('host1', [('guest1', Guest.STATE_PAUSED)])]))
+        self.assertEqual([e.kind for e in journal.events()],
+                         [ChangeJournal.GUEST_STATE_CHANGED])
+
+    def test_journal_disabled_by_default(self):
+        virt = Virt(Mock(), Config('journal', 'esx'), dest=Mock(), interval=60)
+        virt._send_data(self.create_report([('host1', [])]))
+        virt._send_data(self.create_report([('host2', [])]))
+        self.assertFalse('journal' in ChangeJournal.sources())
+        self.assertEqual(virt._previous_report, None)
+
+    def test_journal_disabled(self):
+        virt = Virt(Mock(), Config('journal', 'esx', journal_size='0'), dest=Mock(),
+                    interval=60)
+        virt._send_data(self.create_report([('host1', [])]))
+        virt._send_data(self.create_report([('host2', [])]))
+        self.assertFalse('journal' in ChangeJournal.sources())
+        self.assertEqual(virt._previous_report, None)
+
+
+class TestAdaptiveInterval(TestBase):
+    def create_report(self, host):
+        return HostGuestAssociationReport(Config('adaptive', 'esx'), {
+            'hypervisors': [Hypervisor(host, [Guest('guest', xvirt, Guest.STATE_RUNNING)])]})
+
+    def create_virt(self, **kwargs):
+        virt = Virt(Mock(), Config('adaptive', 'esx', journal_size='0'), dest=Mock(),
+                    interval=600, **kwargs)
+        virt.min_interval = 60
+        virt.max_interval = 3600
+        return virt
+
+    def test_disabled_by_default(self):
+        virt = Virt(Mock(), Config('adaptive', 'esx', journal_size='0'), dest=Mock(),
+                    interval=600)
+        for _ in range(3):
+            virt._send_data(self.create_report('host'))
+        self.assertEqual(virt.current_interval, 600)
+        self.assertEqual(virt.next_interval(), 600)
+
+    def test_back_off_while_unchanged(self):
+        virt = self.create_virt()
+        virt._send_data(self.create_report('host'))
+        self.assertEqual(virt.current_interval, 600)
+        intervals = []
+        for _ in range(4):
+            virt._send_data(self.create_report('host'))
+            intervals.append(virt.current_interval)
+        self.assertEqual(intervals, [1200, 2400, 3600, 3600])
+        self.assertEqual(virt.next_interval(), 3600)
+
+    def test_shorten_while_changing(self):
+        virt = self.create_virt()
+        intervals = []
+        for i in range(6):
+            virt._send_data(self.create_report('host%d' % i))
+            intervals.append(virt.current_interval)
+        self.assertEqual(intervals, [600, 300, 150, 75, 60, 60])
+
+        # Back off again once the reports stop changing
+        virt._send_data(self.create_report('host5'))
+        self.assertEqual(virt.current_interval, 120)
+
+    def test_oneshot(self):
+        virt = self.create_virt(oneshot=True)
+        virt._send_data(self.create_report('host'))
+        virt._send_data(self.create_report('host'))
+        self.assertEqual(virt.current_interval, 600)
+
+
 class TestDestinationThread(TestBase):
     def test_get_data(self):
         # Show that get_data accesses the given source and tries to retrieve
@@ -152,7 +650,7 @@ class TestDestinationThread(TestBase):
         result_data = destination_thread._get_data()
         self.assertEquals(result_data, expected_data)
 
-    @patch('virtwho.virt.virt.Event')
+    @patch('virtwho.virt.virt.WakeupEvent')
     def test_send_data_quit_on_error_report(self, mock_event_class):
         mock_event = Mock(spec=Event())
         mock_event_class.return_value = mock_event
@@ -289,7 +787,7 @@ class TestDestinationThread(TestBase):
         logger = Mock()
         config = Mock()
         config.polling_interval = 10
-        terminate_event = Mock()
+        terminate_event = Event()
         interval = 10  # Arbitrary for this test
         options = Mock()
         options.print_ = False
@@ -304,15 +802,15 @@ class TestDestinationThread(TestBase):
         # expect and with what parameters we expect
         destination_thread.wait = Mock()
         destination_thread._send_data(data_to_send)
-        # We expect there two be two calls to wait with the value of the
-        # polling_interval attr because we'd like to wait one polling
-        # interval before making the first check. Because the mock
+        # The state is checked right after the check-in. Because the mock
         # check_report_state function will modify the report to be in the
         # successful state after the first call, we expect to wait exactly
-        # twice, both of duration config.polling_interval
+        # once, for the initial backoff of the job polling
         destination_thread.wait.assert_has_calls([
-            call(wait_time=config.polling_interval),
+            call(wait_time=DestinationThread.JOB_POLL_DELAY),
         ])
+        self.assertEqual(destination_thread.last_report_for_source,
+                         {'source1': report1.hash, 'source2': report2.hash})
 
     def test_send_data_poll_async_429(self):
         # This test's that when a 429 is detected during async polling
@@ -362,7 +860,7 @@ class TestDestinationThread(TestBase):
         check_report_mock = check_report_state_closure(states)
         manager.check_report_state = Mock(side_effect=check_report_mock)
         logger = Mock()
-        terminate_event = Mock()
+        terminate_event = Event()
         interval = 10  # Arbitrary for this test
         options = Mock()
         options.print_ = False
@@ -377,6 +875,206 @@ class TestDestinationThread(TestBase):
         destination_thread._send_data(data_to_send)
         destination_thread.wait.assert_has_calls(expected_wait_calls)
 
+    def test_oneshot_job_wait_stops_on_terminate(self):
+        datastore = Datastore()
+        datastore.put('source1', self.create_report('source1', 'host1'))
+        destination_thread = self.create_async_thread(
+            datastore, ['source1'], [AbstractVirtReport.STATE_PROCESSING] * 2)
+        destination_thread._oneshot = True
+        destination_thread.terminate_event.set()
+        start = time.time()
+        destination_thread._send_data(destination_thread._get_data())
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(destination_thread.dest.check_report_state.call_count, 1)
+
+    def create_async_thread(self, datastore, source_keys, states):
+        manager = Mock()
+        manager.hypervisorCheckIn.side_effect = lambda report, options=None: report
+
+        def check_report_state(report):
+            report.state = states.pop(0)
+        manager.check_report_state.side_effect = check_report_state
+        config = Mock()
+        config.polling_interval = 60
+        options = Mock()
+        options.print_ = False
+        return DestinationThread(Mock(), config, source_keys=source_keys,
+                                 source=datastore, dest=manager, interval=600,
+                                 terminate_event=Event(), oneshot=False,
+                                 options=options)
+
+    def create_report(self, name, host):
+        return HostGuestAssociationReport(Config(name, 'esx'), {
+            'hypervisors': [Hypervisor(host, [Guest('guest', xvirt, Guest.STATE_RUNNING)])]})
+
+    def test_async_job_does_not_block(self):
+        """
+        Running check-in job is checked between the runs, with backoff,
+        and doesn't stop the domain list reports from being sent.
+        """
+        datastore = Datastore()
+        report1 = self.create_report('source1', 'host1')
+        datastore.put('source1', report1)
+        states = [AbstractVirtReport.STATE_PROCESSING] * 3 + [AbstractVirtReport.STATE_FINISHED] * 2
+        destination_thread = self.create_async_thread(datastore, ['source1', 'source2'], states)
+        manager = destination_thread.dest
+
+        destination_thread._send_data(destination_thread._get_data())
+        self.assertEqual(manager.hypervisorCheckIn.call_count, 1)
+        self.assertEqual(manager.check_report_state.call_count, 1)
+        job = destination_thread._batch.jobs[0]
+        self.assertEqual(job.delay, DestinationThread.JOB_POLL_DELAY)
+        self.assertEqual(destination_thread.last_report_for_source, {})
+
+        # New reports come while the job is running
+        report1_new = self.create_report('source1', 'host1-new')
+        datastore.put('source1', report1_new)
+        report2 = DomainListReport(Config('source2', 'esx'),
+                                   [Guest('guest', xvirt, Guest.STATE_RUNNING)])
+        datastore.put('source2', report2)
+        destination_thread._send_data(destination_thread._get_data())
+        # The job is not due yet, the host/guest report waits
+        self.assertEqual(manager.check_report_state.call_count, 1)
+        self.assertEqual(manager.hypervisorCheckIn.call_count, 1)
+        self.assertEqual(manager.sendVirtGuests.call_count, 1)
+        self.assertEqual(manager.sendVirtGuests.call_args[0][0].hash, report2.hash)
+
+        delays = []
+        while destination_thread._batch is not None:
+            delays.append(destination_thread._batch.jobs[0].delay)
+            destination_thread._batch.jobs[0].next_check = 0
+            destination_thread._send_data(destination_thread._get_data())
+        # Exponential backoff
+        self.assertEqual(delays, [5, 10, 20])
+        # The new report is checked in as soon as the job finished
+        self.assertEqual(manager.hypervisorCheckIn.call_count, 2)
+        self.assertEqual([hypervisor.hypervisorId for hypervisor in
+                          manager.hypervisorCheckIn.call_args[0][0]._assoc['hypervisors']],
+                         ['host1-new'])
+        self.assertEqual(manager.check_report_state.call_count, 5)
+        self.assertEqual(destination_thread.last_report_for_source['source1'],
+                         report1_new.hash)
+        self.assertEqual(destination_thread._get_data(), {})
+
+    def test_async_job_failed(self):
+        datastore = Datastore()
+        report1 = self.create_report('source1', 'host1')
+        datastore.put('source1', report1)
+        states = [AbstractVirtReport.STATE_FAILED, AbstractVirtReport.STATE_FINISHED]
+        destination_thread = self.create_async_thread(datastore, ['source1'], states)
+        destination_thread._send_data(destination_thread._get_data())
+        self.assertEqual(destination_thread._batch, None)
+        self.assertEqual(destination_thread.last_report_for_source, {})
+        # The report is checked in again
+        destination_thread._send_data(destination_thread._get_data())
+        self.assertEqual(destination_thread.dest.hypervisorCheckIn.call_count, 2)
+        self.assertEqual(destination_thread.last_report_for_source,
+                         {'source1': report1.hash})
+        self.assertEqual(destination_thread._get_data(), {})
+
+    def test_wait_for_job(self):
+        datastore = Datastore()
+        datastore.put('source1', self.create_report('source1', 'host1'))
+        destination_thread = self.create_async_thread(
+            datastore, ['source1'], [AbstractVirtReport.STATE_PROCESSING])
+        destination_thread._send_data(destination_thread._get_data())
+        destination_thread._batch.jobs[0].next_check = time.time() + 0.05
+        start = time.time()
+        destination_thread._wait_for_next_run(600)
+        self.assertLess(time.time() - start, 1)
+
+    def test_chunked_checkin(self):
+        """
+        Hypervisors are checked in in chunks, concurrently, source is sent
+        only when all chunks with its hypervisors finished.
+        """
+        datastore = Datastore()
+        report1 = HostGuestAssociationReport(Config('source1', 'esx'), {'hypervisors': [
+            Hypervisor('s1h%d' % i, []) for i in range(3)]})
+        report2 = HostGuestAssociationReport(Config('source2', 'esx'), {'hypervisors': [
+            Hypervisor('s2h%d' % i, []) for i in range(2)]})
+        datastore.put('source1', report1)
+        datastore.put('source2', report2)
+        destination_thread = self.create_async_thread(datastore, ['source1', 'source2'], [])
+        destination_thread.options.checkin_batch_size = 2
+        destination_thread.options.checkin_concurrency = 3
+
+        chunks = []
+        second_call = Event()
+
+        def hypervisor_check_in(report, options=None):
+            hypervisors = [h.hypervisorId for h in report._assoc['hypervisors']]
+            chunks.append(hypervisors)
+            if len(chunks) == 1:
+                # The other chunks are sent while this one is running
+                self.assertTrue(second_call.wait(5))
+            else:
+                second_call.set()
+            report.state = AbstractVirtReport.STATE_PROCESSING
+            return report
+
+        def check_report_state(report):
+            if 's2h1' in [h.hypervisorId for h in report._assoc['hypervisors']]:
+                report.state = AbstractVirtReport.STATE_FAILED
+            else:
+                report.state = AbstractVirtReport.STATE_FINISHED
+        manager = destination_thread.dest
+        manager.hypervisorCheckIn.side_effect = hypervisor_check_in
+        manager.check_report_state.side_effect = check_report_state
+
+        destination_thread._send_data(destination_thread._get_data())
+        self.assertEqual(sorted(chunks), [['s1h0', 's1h1'], ['s1h2', 's2h0'], ['s2h1']])
+        self.assertEqual(manager.check_report_state.call_count, 3)
+        self.assertEqual(destination_thread._batch, None)
+        # One of the chunks with source2 failed, it's sent again
+        self.assertEqual(destination_thread.last_report_for_source, {'source1': report1.hash})
+        self.assertEqual(destination_thread._get_data().keys(), ['source2'])
+
+    def test_chunk_fails_unexpectedly(self):
+        """
+        Unexpected error in one of the chunks doesn't leave the check-in
+        running, the sources of the chunk are sent again.
+        """
+        datastore = Datastore()
+        report1 = HostGuestAssociationReport(Config('source1', 'esx'), {'hypervisors': [
+            Hypervisor('s1h%d' % i, []) for i in range(3)]})
+        datastore.put('source1', report1)
+        destination_thread = self.create_async_thread(datastore, ['source1'], [])
+        destination_thread.options.checkin_batch_size = 2
+        destination_thread.options.checkin_concurrency = 2
+
+        def hypervisor_check_in(report, options=None):
+            if len(report._assoc['hypervisors']) == 1:
+                raise socket.error('Connection reset by peer')
+            report.state = AbstractVirtReport.STATE_FINISHED
+            return report
+        manager = destination_thread.dest
+        manager.hypervisorCheckIn.side_effect = hypervisor_check_in
+
+        destination_thread._send_data(destination_thread._get_data())
+        self.assertEqual(manager.hypervisorCheckIn.call_count, 2)
+        self.assertEqual(destination_thread._batch, None)
+        self.assertEqual(destination_thread.last_report_for_source, {})
+        # Waiting for the next run works without any job
+        destination_thread._wait_for_next_run(0)
+
+        # The report is checked in again
+        manager.hypervisorCheckIn.side_effect = None
+        manager.hypervisorCheckIn.return_value = None
+        destination_thread._send_data(destination_thread._get_data())
+        self.assertEqual(manager.hypervisorCheckIn.call_count, 4)
+
+    def test_checkin_fails_unexpectedly(self):
+        datastore = Datastore()
+        datastore.put('source1', self.create_report('source1', 'host1'))
+        destination_thread = self.create_async_thread(datastore, ['source1'], [])
+        manager = destination_thread.dest
+        manager.hypervisorCheckIn.side_effect = socket.error('Connection reset by peer')
+        self.assertRaises(socket.error, destination_thread._send_data,
+                          destination_thread._get_data())
+        self.assertEqual(destination_thread._batch, None)
+        destination_thread._wait_for_next_run(0)
+
     def test_send_data_domain_list_reports(self):
         # Show that DomainListReports are sent using the sendVirtGuests
         # method of the destination
@@ -458,6 +1156,42 @@ class TestDestinationThread(TestBase):
         destination_thread.wait.assert_has_calls([call(
                 wait_time=error_to_throw.retry_after)])
 
+    def test_throttling_shared_by_destinations(self):
+        # A 429 received by one destination makes other destinations
+        # sending to the same server wait too
+        server = 'shared-server-%s:443' % id(self)
+        self.addCleanup(ratelimit._registry._servers.pop, server, None)
+        config1 = Config('source1', 'esx')
+        virt1 = Mock()
+        virt1.CONFIG_TYPE = 'esx'
+        report1 = DomainListReport(config1, [Guest('GUUID1', virt1, Guest.STATE_RUNNING)],
+                                   hypervisor_id='hypervisor_id_1')
+        options = Mock()
+        options.print_ = False
+        threads = []
+        for name in ['dest1', 'dest2']:
+            config = Mock()
+            config.polling_interval = 10
+            manager = Mock()
+            manager.server.return_value = server
+            thread = DestinationThread(Mock(), config, source_keys=['source1'],
+                                       source={'source1': report1}, dest=manager,
+                                       interval=10, terminate_event=Mock(),
+                                       oneshot=True, options=options)
+            thread.wait = Mock()
+            threads.append(thread)
+        threads[0].dest.sendVirtGuests.side_effect = [ManagerThrottleError(retry_after=30), None]
+
+        threads[0]._send_data({'source1': report1})
+        threads[0].wait.assert_called_once_with(wait_time=30)
+        threads[1]._send_data({'source1': report1})
+        # The first call after the throttling is reserved for the first
+        # destination, the second one waits longer
+        wait_time = threads[1].wait.call_args[1]['wait_time']
+        self.assertGreater(wait_time, 30)
+        self.assertLessEqual(wait_time, 31)
+        threads[1].dest.sendVirtGuests.assert_called_once_with(report1, options=options)
+
     def test_duplicate_reports_are_ignored(self):
         """
         Test that duplicate reports are filtered out when retrieving items
@@ -515,7 +1249,144 @@ class TestDestinationThread(TestBase):
         self.assertEqual(next_data_to_send, expected_next_data_to_send)
 
 
-class TestDestinationThreadTiming(TestBase):
+class TestPartitionedReports(TestBase):
+    def create_report(self, partition_reports=True, states=None):
+        states = states or {}
+        config = Config('source1', 'esx', partition_reports=partition_reports)
+        hypervisors = [
+            Hypervisor(host_id, guestIds=[
+                Guest('guest-%s' % host_id, xvirt, states.get(host_id, Guest.STATE_RUNNING))
+            ], partition=partition)
+            for host_id, partition in (('host-1', 'cluster-a'),
+                                       ('host-2', 'cluster-a'),
+                                       ('host-3', 'cluster-b'))
+        ]
+        return HostGuestAssociationReport(config, {'hypervisors': hypervisors})
+
+    def create_thread(self, datastore):
+        manager = Mock()
+        options = Mock()
+        options.print_ = False
+        destination_thread = DestinationThread(Mock(), Config('dest', 'esx'),
+                                               source_keys=['source1'],
+                                               source=datastore,
+                                               dest=manager,
+                                               interval=1,
+                                               terminate_event=Mock(),
+                                               oneshot=False, options=options)
+
+        def hypervisorCheckIn(report, options=None):
+            report.state = AbstractVirtReport.STATE_FINISHED
+            return report
+        manager.hypervisorCheckIn = Mock(side_effect=hypervisorCheckIn)
+        return destination_thread, manager
+
+    def test_partitions(self):
+        report = self.create_report()
+        self.assertTrue(report.partitioned)
+        self.assertFalse(self.create_report(partition_reports=False).partitioned)
+        self.assertEqual(sorted(report.partitions), ['cluster-a', 'cluster-b'])
+        self.assertEqual([h.hypervisorId for h in report.partitions['cluster-a']],
+                         ['host-1', 'host-2'])
+
+        changed = self.create_report(states={'host-3': Guest.STATE_SHUTOFF})
+        self.assertEqual(report.partition_hashes['cluster-a'],
+                         changed.partition_hashes['cluster-a'])
+        self.assertNotEqual(report.partition_hashes['cluster-b'],
+                            changed.partition_hashes['cluster-b'])
+
+    def test_partition_is_not_sent(self):
+        report = self.create_report()
+        hypervisor = report.partitions['cluster-b'][0]
+        digest = hypervisor.getHash()
+        hypervisor.partition = 'cluster-c'
+        self.assertEqual(hypervisor.getHash(), digest)
+        self.assertNotIn('partition', hypervisor.toDict())
+        restored = pickle.loads(pickle.dumps(hypervisor))
+        self.assertEqual(restored.partition, 'cluster-c')
+
+    def test_only_changed_partitions_are_sent(self):
+        report = self.create_report()
+        datastore = {'source1': report}
+        destination_thread, manager = self.create_thread(datastore)
+
+        destination_thread._send_data(destination_thread._get_data())
+        sent = manager.hypervisorCheckIn.call_args[0][0]
+        self.assertEqual(len(sent.association['hypervisors']), 3)
+        self.assertEqual(destination_thread.last_report_for_source,
+                         {'source1': report.partition_hashes})
+
+        # Nothing changed
+        datastore['source1'] = self.create_report()
+        self.assertEqual(destination_thread._get_data(), {})
+
+        # Change in one partition, only that one is sent
+        changed = self.create_report(states={'host-3': Guest.STATE_SHUTOFF})
+        datastore['source1'] = changed
+        data_to_send = destination_thread._get_data()
+        self.assertEqual(data_to_send, {'source1': changed})
+        manager.hypervisorCheckIn.reset_mock()
+        destination_thread._send_data(data_to_send)
+        sent = manager.hypervisorCheckIn.call_args[0][0]
+        self.assertEqual([h.hypervisorId for h in sent.association['hypervisors']],
+                         ['host-3'])
+
+    def test_removed_partition_is_not_new_data(self):
+        report = self.create_report()
+        datastore = {'source1': report}
+        destination_thread, manager = self.create_thread(datastore)
+        destination_thread._update_last_report('source1', report)
+
+        smaller = self.create_report()
+        smaller._assoc['hypervisors'].pop()
+        datastore['source1'] = smaller
+        self.assertEqual(destination_thread._get_data(), {})
+        self.assertEqual(destination_thread.last_report_for_source,
+                         {'source1': {'cluster-a': report.partition_hashes['cluster-a']}})
+
+
+class TestDestinationThreadVersions(TestBase):
+    def create_thread(self, datastore):
+        options = Mock()
+        options.print_ = False
+        return DestinationThread(Mock(), Config('dest', 'esx'),
+                                 source_keys=['source1', 'source2'],
+                                 source=datastore, dest=Mock(), interval=1,
+                                 terminate_event=Event(), options=options)
+
+    def test_unchanged_sources_are_not_loaded(self):
+        datastore = Datastore()
+        report = DomainListReport(Config('source1', 'esx'),
+                                  [Guest('GUUID1', xvirt, Guest.STATE_RUNNING)])
+        datastore.put('source1', report)
+        destination_thread = self.create_thread(datastore)
+        data = destination_thread._get_data()
+        self.assertEqual(data.keys(), ['source1'])
+
+        # Not sent yet, the same report is returned again
+        self.assertEqual(destination_thread._get_data().keys(), ['source1'])
+
+        destination_thread._send_data(destination_thread._get_data())
+        with patch.object(datastore, '_load') as load:
+            self.assertEqual(destination_thread._get_data(), {})
+            load.assert_not_called()
+
+        # Same report put again is loaded, but it's a duplicate
+        datastore.put('source1', report)
+        self.assertEqual(destination_thread._get_data(), {})
+        with patch.object(datastore, '_load') as load:
+            self.assertEqual(destination_thread._get_data(), {})
+            load.assert_not_called()
+
+    def test_wait_for_next_run_wakes_up_on_new_report(self):
+        datastore = Datastore()
+        destination_thread = self.create_thread(datastore)
+        destination_thread._get_data()
+        datastore.put('source2', ErrorReport(Config('source2', 'esx')))
+        start = time.time()
+        destination_thread._wait_for_next_run(30)
+        self.assertTrue(time.time() - start < 5)
+
     """
     A group of tests meant to show that the destination thread does things
     in the right amount of time given different circumstances.
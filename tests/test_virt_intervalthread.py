@@ -1,8 +1,10 @@
+import time
 from base import TestBase
 
 from mock import patch, Mock, sentinel, call
 from virtwho.virt import IntervalThread
-from threading import Event
+from virtwho.wakeup import WakeupEvent
+from threading import Event, Thread
 from datetime import datetime
 
 class TestIntervalThreadTiming(TestBase):
@@ -13,7 +15,7 @@ class TestIntervalThreadTiming(TestBase):
     def setUp(self):
         time_patcher = patch('time.sleep')
         self.mock_time = time_patcher.start()
-        event_patcher = patch('virtwho.virt.virt.Event')
+        event_patcher = patch('virtwho.virt.virt.WakeupEvent')
         self.mock_internal_terminate_event = event_patcher.start().return_value
         self.mock_internal_terminate_event.is_set.return_value = False
         self.addCleanup(time_patcher.stop)
@@ -114,17 +116,13 @@ class TestIntervalThreadTiming(TestBase):
 
     def test_wait(self):
         interval_thread = self.setup_interval_thread()
-        interval_thread.is_terminated = Mock()
-        interval_thread.is_terminated.return_value = False
-        # The total time we expect to be waited
         wait_time = 10
-        # The time we expect to be waited each interval
-        expected_wait_interval = 1
-        expected_calls = [call(expected_wait_interval) for x in range(wait_time)]
-
-        interval_thread.wait(wait_time=wait_time)
-        self.assertEquals(interval_thread.is_terminated.call_count, wait_time)
-        self.mock_time.assert_has_calls(expected_calls)
+        with patch('virtwho.virt.virt.wait_for') as mock_wait_for:
+            interval_thread.wait(wait_time=wait_time)
+        mock_wait_for.assert_called_once_with(
+            interval_thread.is_terminated,
+            [self.mock_internal_terminate_event, self.terminate_event],
+            wait_time)
 
     def test_is_terminated_terminate_event(self):
         interval_thread = self.setup_interval_thread()
@@ -184,3 +182,105 @@ class TestIntervalThreadTiming(TestBase):
         interval_thread.wait = Mock()
         interval_thread.run()
         interval_thread.wait.assert_not_called()
+
+
+class TestIntervalThreadWakeup(TestBase):
+    """
+    Tests of waiting with real events (without mocked time).
+    """
+    def start_waiting(self, interval_thread, wait_time=3600):
+        waiting = Thread(target=interval_thread.wait, args=(wait_time,))
+        waiting.daemon = True
+        waiting.start()
+        return waiting
+
+    def assert_wakes_up(self, waiting, action):
+        time.sleep(0.05)
+        self.assertTrue(waiting.is_alive())
+        start = time.time()
+        action()
+        waiting.join(5)
+        self.assertFalse(waiting.is_alive())
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_stop_interrupts_wait(self):
+        interval_thread = IntervalThread(self.logger, Mock(), interval=3600)
+        waiting = self.start_waiting(interval_thread)
+        self.assert_wakes_up(waiting, interval_thread.stop)
+
+    def test_terminate_event_interrupts_wait(self):
+        terminate_event = WakeupEvent()
+        interval_thread = IntervalThread(self.logger, Mock(), interval=3600,
+                                         terminate_event=terminate_event)
+        waiting = self.start_waiting(interval_thread)
+        self.assert_wakes_up(waiting, terminate_event.set)
+        self.assertTrue(interval_thread.is_terminated())
+
+    def test_plain_terminate_event_is_polled(self):
+        terminate_event = Event()
+        interval_thread = IntervalThread(self.logger, Mock(), interval=3600,
+                                         terminate_event=terminate_event)
+        with patch('virtwho.wakeup.POLL_INTERVAL', 0.01):
+            waiting = self.start_waiting(interval_thread)
+            self.assert_wakes_up(waiting, terminate_event.set)
+
+    def test_sub_second_wait(self):
+        interval_thread = IntervalThread(self.logger, Mock(), interval=3600)
+        start = time.time()
+        interval_thread.wait(0.1)
+        elapsed = time.time() - start
+        self.assertGreaterEqual(elapsed, 0.1)
+        self.assertLess(elapsed, 0.5)
+
+
+class TestIntervalThreadSchedule(TestBase):
+    def create_thread(self, name='test', oneshot=False, **kwargs):
+        config = Mock()
+        config.name = name
+        interval_thread = IntervalThread(self.logger, config, interval=100,
+                                         oneshot=oneshot)
+        for key, value in kwargs.items():
+            setattr(interval_thread, key, value)
+        return interval_thread
+
+    def test_no_jitter_by_default(self):
+        interval_thread = self.create_thread()
+        self.assertEqual(interval_thread.next_interval(), 100)
+        self.assertEqual(interval_thread.start_delay(), 0)
+
+    def test_jitter(self):
+        interval_thread = self.create_thread(interval_jitter=10)
+        intervals = set(interval_thread.next_interval() for _ in range(100))
+        self.assertTrue(len(intervals) > 1)
+        for interval in intervals:
+            self.assertTrue(90 <= interval <= 110)
+
+    def test_jitter_is_at_most_half_of_interval(self):
+        interval_thread = self.create_thread(interval_jitter=1000)
+        for _ in range(100):
+            self.assertTrue(50 <= interval_thread.next_interval() <= 150)
+
+    def test_start_delay_is_deterministic(self):
+        delays = [self.create_thread('source_%d' % i, start_stagger=3600).start_delay()
+                  for i in range(100)]
+        self.assertEqual(delays, [self.create_thread('source_%d' % i, start_stagger=3600).start_delay()
+                                  for i in range(100)])
+        for delay in delays:
+            self.assertTrue(0 <= delay < 3600)
+        # The phases are spread over the whole stagger time
+        self.assertTrue(min(delays) < 600)
+        self.assertTrue(max(delays) > 3000)
+
+    def test_oneshot_is_not_delayed(self):
+        interval_thread = self.create_thread(oneshot=True, interval_jitter=10,
+                                             start_stagger=3600)
+        self.assertEqual(interval_thread.next_interval(), 100)
+        self.assertEqual(interval_thread.start_delay(), 0)
+
+    def test_run_waits_for_start_delay(self):
+        interval_thread = self.create_thread(start_stagger=3600)
+        interval_thread.wait = Mock(side_effect=lambda wait_time: interval_thread.stop())
+        interval_thread._run = Mock()
+        interval_thread.run()
+        interval_thread.wait.assert_called_once_with(interval_thread.start_delay())
+        interval_thread._run.assert_not_called()
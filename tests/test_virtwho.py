@@ -20,20 +20,26 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
 import sys
 import os
+import time
+import shutil
+import tempfile
 from Queue import Empty, Queue
+from threading import Timer
 from mock import patch, Mock, sentinel, ANY, call
 
 from base import TestBase
 
 from virtwho import util
-from virtwho.config import Config, ConfigManager
-from virtwho.manager import ManagerThrottleError, ManagerFatalError
+from virtwho.config import Config, ConfigManager, Satellite6DestinationInfo
+from virtwho.state import destination_key
+from virtwho.manager import ManagerError, ManagerThrottleError, ManagerFatalError
 from virtwho.virt import (
     HostGuestAssociationReport, Hypervisor, Guest,
-    DomainListReport, AbstractVirtReport)
+    DomainListReport, AbstractVirtReport, Virt, DestinationThread)
 from virtwho.parser import parseOptions, OptionError
 from virtwho.executor import Executor, ReloadRequest
 from virtwho.main import _main
+from virtwho.wakeup import WakeupEvent
 
 
 class TestOptions(TestBase):
@@ -240,8 +246,8 @@ class TestOptions(TestBase):
 class TestExecutor(TestBase):
 
     @patch.object(Executor, 'terminate_threads')
-    @patch('virtwho.executor.time')
-    def test_wait_on_threads(self, mock_time, mock_terminate_threads):
+    @patch('virtwho.wakeup.POLL_INTERVAL', 0.01)
+    def test_wait_on_threads(self, mock_terminate_threads):
         """
         Tests that, given no kwargs, the wait_on_threads method will wait until
         all threads is_terminated method returns True.
@@ -256,18 +262,299 @@ class TestExecutor(TestBase):
         mock_thread1 = Mock()
         mock_thread1.is_terminated = Mock(side_effect=[False, True])
         mock_thread2 = Mock()
-        mock_thread2.is_terminated = Mock(side_effect=[False, False, True])
+        mock_thread2.is_terminated = Mock(side_effect=[False, False, False, True])
 
         threads = [mock_thread1, mock_thread2]
 
-        mock_time.sleep = Mock()
-        Executor.wait_on_threads(threads)
-        mock_time.sleep.assert_has_calls([
-            call(1),
-            call(1),
-        ])
+        self.assertEqual(Executor.wait_on_threads(threads), [])
+        self.assertEqual(mock_thread2.is_terminated.call_count, 4)
         mock_terminate_threads.assert_not_called()
 
+    @patch.object(Executor, 'terminate_threads')
+    @patch('virtwho.wakeup.POLL_INTERVAL', 0.01)
+    def test_wait_on_threads_timeout(self, mock_terminate_threads):
+        mock_thread = Mock()
+        mock_thread.is_terminated.return_value = False
+        self.assertEqual(Executor.wait_on_threads([mock_thread], max_wait_time=0.05),
+                         [mock_thread])
+        mock_terminate_threads.assert_not_called()
+        self.assertEqual(Executor.wait_on_threads([mock_thread], max_wait_time=0.05,
+                                                  kill_on_timeout=True), [])
+        mock_terminate_threads.assert_called_once_with([mock_thread])
+
+    def test_shutdown_latency(self):
+        """
+        Stopping virt-who with 500 configured sources (all of them waiting
+        for the next interval) must not take seconds.
+        """
+        options = Mock()
+        options.state_file = None
+        options.interval = 3600
+        options.oneshot = False
+        config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, config_dir)
+        executor = Executor(self.logger, options, config_dir=config_dir)
+        datastore = executor.datastore
+
+        virt = type("", (), {'CONFIG_TYPE': 'esx'})()
+        configs = [Config('source_%d' % i, 'esx') for i in range(500)]
+        for config in configs:
+            thread = Virt(self.logger, config, datastore,
+                          terminate_event=executor.terminate_event,
+                          interval=3600)
+            thread._get_report = lambda config=config: HostGuestAssociationReport(
+                config, {'hypervisors': [Hypervisor(config.name, [
+                    Guest(config.name, virt, Guest.STATE_RUNNING)])]})
+            executor.virts.append(thread)
+        manager = Mock()
+        manager.hypervisorCheckIn.return_value = {}
+        executor.destinations.append(DestinationThread(
+            self.logger, Config('destination', 'esx'),
+            source_keys=[config.name for config in configs],
+            source=datastore, dest=manager, options=options,
+            terminate_event=executor.terminate_event, interval=3600))
+
+        for thread in executor.virts + executor.destinations:
+            thread.start()
+        # Wait until all the sources sent their reports and are idle
+        datastore.wait_for_change([config.name for config in configs[-1:]], 10,
+                                  since_version=0)
+        time.sleep(0.5)
+
+        start = time.time()
+        executor.terminate()
+        latency = time.time() - start
+        # The one second sleep loops took up to a second here
+        self.assertLess(latency, 0.5)
+        for thread in executor.virts + executor.destinations:
+            self.assertFalse(thread.is_alive())
+
+    def _write_config(self, config_dir, name, server):
+        with open(os.path.join(config_dir, name + '.conf'), 'w') as f:
+            f.write("[%s]\ntype=esx\nserver=%s\nusername=admin\npassword=password\n"
+                    "owner=owner\nenv=env\n" % (name, server))
+
+    @patch('virtwho.manager.Manager.fromInfo')
+    def test_destination_name_is_stable(self, fromInfo):
+        fromInfo.return_value.identity.return_value = None
+        options = Mock()
+        options.state_file = None
+        options.oneshot = False
+        options.start_stagger = 60
+        executor = Executor(self.logger, options, config_dir=tempfile.mkdtemp())
+        info = Satellite6DestinationInfo(env='env', owner='owner')
+        dest = executor._create_destination(info, ['source'])
+        name = info.name
+        self.assertEqual(name, 'destination_%s' % destination_key(info)[:16])
+        # Naming the info again (on reload) doesn't change it
+        again = executor._create_destination(info, ['source'])
+        self.assertEqual(info.name, name)
+        self.assertEqual(again.start_delay(), dest.start_delay())
+
+    @patch.object(Executor, '_create_destination')
+    @patch.object(Executor, '_create_virt')
+    def test_reload_changed_configs(self, create_virt, create_destination):
+        """
+        Reload restarts only the sources whose configuration changed.
+        """
+        create_virt.side_effect = lambda config: Mock(config=config, schedulable=False)
+        create_destination.side_effect = lambda info, source_keys: Mock(
+            config=info, source_keys=source_keys)
+        config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, config_dir)
+        for name in ('unchanged', 'changed', 'removed'):
+            self._write_config(config_dir, name, name + '.example.com')
+        options = Mock()
+        options.state_file = None
+        options.oneshot = False
+        options.configs = []
+        executor = Executor(self.logger, options, config_dir=config_dir)
+        executor.virts = executor._create_virt_backends()
+        executor.destinations = executor._create_destinations()
+        virts = dict((virt.config.name, virt) for virt in executor.virts)
+        destination = executor.destinations[0]
+        for name in virts:
+            executor.datastore.put(name, name)
+
+        self._write_config(config_dir, 'changed', 'other.example.com')
+        os.remove(os.path.join(config_dir, 'removed.conf'))
+        self._write_config(config_dir, 'added', 'added.example.com')
+        create_virt.reset_mock()
+        executor.reload()
+
+        self.assertEqual(sorted(call[0][0].name for call in create_virt.call_args_list),
+                         ['added', 'changed'])
+        virts['unchanged'].stop.assert_not_called()
+        virts['changed'].stop.assert_called_once_with()
+        virts['removed'].stop.assert_called_once_with()
+        self.assertEqual(sorted(virt.config.name for virt in executor.virts),
+                         ['added', 'changed', 'unchanged'])
+        for virt in executor.virts:
+            if virt.config.name != 'unchanged':
+                virt.start.assert_called_once_with()
+        self.assertEqual(executor.datastore.get('unchanged'), 'unchanged')
+        self.assertRaises(KeyError, executor.datastore.get, 'changed')
+        self.assertFalse(executor.terminate_event.is_set())
+
+        # Sources of the destination changed, so it's replaced
+        destination.stop.assert_called_once_with()
+        self.assertEqual(len(executor.destinations), 1)
+        self.assertEqual(executor.destinations[0].source_keys,
+                         ['added', 'changed', 'unchanged'])
+        executor.destinations[0].start.assert_called_once_with()
+
+    @patch.object(Executor, '_create_destination')
+    @patch.object(Executor, '_create_virt')
+    def test_reload_unchanged_configs(self, create_virt, create_destination):
+        create_virt.side_effect = lambda config: Mock(config=config, schedulable=False)
+        create_destination.side_effect = lambda info, source_keys: Mock(
+            config=info, source_keys=source_keys)
+        config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, config_dir)
+        self._write_config(config_dir, 'test', 'test.example.com')
+        options = Mock()
+        options.state_file = None
+        options.oneshot = False
+        options.configs = []
+        executor = Executor(self.logger, options, config_dir=config_dir)
+        executor.virts = executor._create_virt_backends()
+        executor.destinations = executor._create_destinations()
+        virt = executor.virts[0]
+        destination = executor.destinations[0]
+
+        executor.reload()
+        self.assertEqual(create_virt.call_count, 1)
+        self.assertEqual(create_destination.call_count, 1)
+        self.assertEqual(executor.virts, [virt])
+        self.assertEqual(executor.destinations, [destination])
+        virt.stop.assert_not_called()
+        destination.stop.assert_not_called()
+
+        # Invalid configuration doesn't stop anything
+        os.remove(os.path.join(config_dir, 'test.conf'))
+        executor.reload()
+        self.assertEqual(executor.virts, [virt])
+        virt.stop.assert_not_called()
+
+    @patch.object(Executor, '_create_destination')
+    @patch.object(Executor, '_create_virt')
+    def test_reload_without_destinations(self, create_virt, create_destination):
+        """
+        virt-who keeps running when reload leaves no destinations.
+        """
+        create_virt.side_effect = lambda config: Mock(config=config, schedulable=False)
+        create_destination.side_effect = lambda info, source_keys: Mock(
+            config=info, source_keys=source_keys)
+        config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, config_dir)
+        self._write_config(config_dir, 'test', 'test.example.com')
+        options = Mock()
+        options.state_file = None
+        options.oneshot = False
+        options.configs = []
+        executor = Executor(self.logger, options, config_dir=config_dir)
+        executor.virts = executor._create_virt_backends()
+        executor.destinations = executor._create_destinations()
+        executor.running = True
+
+        os.remove(os.path.join(config_dir, 'test.conf'))
+        self._write_config(config_dir, 'other', 'other.example.com')
+        create_destination.side_effect = ManagerError('Unable to connect')
+        executor.reload()
+        self.assertEqual(executor.destinations, [])
+
+        Timer(0.1, executor.terminate_event.set).start()
+        start = time.time()
+        executor.run()
+        self.assertGreater(time.time() - start, 0.05)
+        self.assertFalse(executor.running)
+
+    @patch.object(Executor, '_create_destination')
+    @patch.object(Executor, '_create_virt')
+    def test_reload_during_start(self, create_virt, create_destination):
+        """
+        SIGHUP received while the threads are started is handled once all
+        of them are started, no thread is started twice.
+        """
+        virts = []
+        create_virt.side_effect = lambda config: virts.append(
+            Mock(config=config, schedulable=False)) or virts[-1]
+        create_destination.side_effect = lambda info, source_keys: Mock(
+            config=info, source_keys=source_keys)
+        config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, config_dir)
+        self._write_config(config_dir, 'test', 'test.example.com')
+        options = Mock()
+        options.state_file = None
+        options.oneshot = False
+        options.configs = []
+        options.interval = 60
+        executor = Executor(self.logger, options, config_dir=config_dir)
+        start_virts = executor._start_virts
+        reloads = []
+
+        def sighup(virts=None):
+            start_virts(virts)
+            if not reloads:
+                self._write_config(config_dir, 'test', 'other.example.com')
+                reloads.append(executor.reload())
+
+        with patch.object(executor, '_start_virts', side_effect=sighup):
+            executor.run()
+
+        self.assertEqual(reloads, [False])
+        self.assertFalse(executor.reload_pending)
+        # The original source and the one from the reloaded config
+        self.assertEqual([virt.config.server for virt in virts],
+                         ['test.example.com', 'other.example.com'])
+        for virt in virts:
+            virt.start.assert_called_once_with()
+        virts[0].stop.assert_called()
+        create_destination.assert_called_once()
+
+    @patch('virtwho.wakeup.POLL_INTERVAL', 0.01)
+    def test_oneshot_pipelined(self):
+        """
+        Destination starts as soon as its own sources are done, not after
+        all the sources are.
+        """
+        def create_virt(name, delay):
+            virt = Mock(schedulable=False)
+            virt.config.name = name
+            event = WakeupEvent()
+            virt.is_terminated = event.is_set
+            virt.wakeup_sources = [event]
+            virt.start.side_effect = lambda: Timer(delay, event.set).start()
+            return virt
+
+        def create_destination(source_keys):
+            destination = Mock(source_keys=source_keys, started=None)
+            destination.start.side_effect = lambda: setattr(
+                destination, 'started', time.time())
+            destination.is_terminated.return_value = True
+            return destination
+
+        options = Mock()
+        options.state_file = None
+        options.oneshot = True
+        options.print_ = False
+        config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, config_dir)
+        executor = Executor(self.logger, options, config_dir=config_dir)
+        slow = create_virt('slow', 0.5)
+        fast_destination = create_destination(['fast', 'failed'])
+        slow_destination = create_destination(['slow'])
+        executor._create_virt_backends = Mock(return_value=[
+            create_virt('fast', 0), slow])
+        executor._create_destinations = Mock(return_value=[
+            fast_destination, slow_destination])
+
+        start = time.time()
+        executor.run_oneshot()
+        self.assertLess(fast_destination.started - start, 0.4)
+        self.assertTrue(slow.is_terminated())
+        self.assertGreaterEqual(slow_destination.started - start, 0.5)
+
     def test_terminate_threads(self):
         threads = [Mock(), Mock()]
         Executor.terminate_threads(threads)
@@ -0,0 +1,88 @@
+import time
+from threading import Event, Thread
+
+from base import TestBase
+from mock import patch
+
+from virtwho.wakeup import WakeupEvent, WakeupSource, WakeupTimer, Waiter, wait_for
+
+
+class TestWaitFor(TestBase):
+    def test_predicate_already_true(self):
+        self.assertEqual(wait_for(lambda: 'result', [], 10), 'result')
+
+    def test_timeout(self):
+        start = time.time()
+        self.assertEqual(wait_for(lambda: [], [WakeupEvent()], 0.05), [])
+        self.assertGreaterEqual(time.time() - start, 0.05)
+
+    def test_source_wakes_up(self):
+        event = WakeupEvent()
+        source = WakeupSource()
+        values = []
+        result = []
+        waiting = Thread(target=lambda: result.append(
+            wait_for(lambda: list(values), [event, source, source], 10)))
+        waiting.start()
+        while not source._waiters:
+            time.sleep(0.001)
+        values.append('changed')
+        source.wake_waiters()
+        waiting.join(1)
+        self.assertFalse(waiting.is_alive())
+        self.assertEqual(result, [['changed']])
+        # The waiter is unregistered afterwards
+        self.assertEqual(source._waiters, set())
+        self.assertEqual(event._waiters, set())
+
+    def test_plain_event_is_polled(self):
+        event = Event()
+        Thread(target=lambda: (time.sleep(0.05), event.set())).start()
+        with patch('virtwho.wakeup.POLL_INTERVAL', 0.01):
+            self.assertTrue(wait_for(event.is_set, [event], 10))
+
+
+class TestWakeupEvent(TestBase):
+    def test_wait(self):
+        event = WakeupEvent()
+        self.assertFalse(event.wait(0.01))
+        Thread(target=lambda: (time.sleep(0.05), event.set())).start()
+        self.assertTrue(event.wait(10))
+        self.assertTrue(event.is_set())
+        event.clear()
+        self.assertFalse(event.is_set())
+
+
+class TestWakeupTimer(TestBase):
+    def test_waiters_are_woken_in_order(self):
+        timer = WakeupTimer()
+        woken = []
+
+        class RecordingWaiter(Waiter):
+            __slots__ = ('name',)
+
+            def wake(self):
+                woken.append(self.name)
+                super(RecordingWaiter, self).wake()
+
+        waiters = []
+        for name, delay in (('second', 0.06), ('first', 0.03), ('cancelled', 0.01)):
+            waiter = RecordingWaiter()
+            waiter.name = name
+            waiters.append((waiter, timer.schedule(time.time() + delay, waiter)))
+        timer.cancel(waiters[2][1])
+        waiters[0][0].block()
+        self.assertEqual(woken, ['first', 'second'])
+
+
+class TestMainThread(TestBase):
+    def test_main_thread_wakes_up_for_signals(self):
+        # Signal handlers run only between waits of the main thread
+        event = WakeupEvent()
+        with patch('virtwho.wakeup.POLL_INTERVAL', 0.01):
+            with patch('virtwho.wakeup.current_thread') as mock_current_thread:
+                mock_current_thread.return_value.name = 'MainThread'
+                with patch('virtwho.wakeup.Waiter.block',
+                           autospec=True, side_effect=Waiter.block) as mock_block:
+                    self.assertFalse(wait_for(event.is_set, [event], 0.1))
+        self.assertTrue(mock_block.call_count > 1)
@@ -65,6 +65,7 @@ rm -rf $RPM_BUILD_ROOT
 
 mkdir -p %{buildroot}/%{_sharedstatedir}/%{name}/
 touch %{buildroot}/%{_sharedstatedir}/%{name}/key
+touch %{buildroot}/%{_sharedstatedir}/%{name}/state.json
 
 mkdir -p %{buildroot}/%{_datadir}/zsh/site-functions
 install -m 644 virt-who-zsh %{buildroot}/%{_datadir}/zsh/site-functions/_virt-who
@@ -121,6 +122,7 @@ fi
 %{_mandir}/man5/virt-who-config.5.gz
 %attr(700, root, root) %{_sharedstatedir}/%{name}
 %ghost %{_sharedstatedir}/%{name}/key
+%ghost %{_sharedstatedir}/%{name}/state.json
 %{_datadir}/zsh/site-functions/_virt-who
 %{_sysconfdir}/virt-who.d/template.conf
 %{_sysconfdir}/virt-who.conf
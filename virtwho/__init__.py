@@ -2,3 +2,9 @@
 # Default interval for sending list of UUIDs
 DefaultInterval = 3600  # One per hour
 MinimumSendInterval = 60  # One minute
+
+# Hashes of the last sent reports are stored here
+DefaultStateFile = '/var/lib/virt-who/state.json'
+
+# Datastore in mmap mode keeps snapshots of the reports here
+DefaultSnapshotDir = '/var/lib/virt-who/snapshots'
@@ -21,7 +21,7 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 import os
 
 from ConfigParser import SafeConfigParser, NoOptionError, Error, MissingSectionHeaderError
-from virtwho import DefaultInterval
+from virtwho import DefaultInterval, DefaultStateFile, MinimumSendInterval
 from password import Password
 from binascii import unhexlify
 import hashlib
@@ -318,7 +318,16 @@ class GlobalConfig(GeneralConfig):
         'configs': '',
         'reporter_id': util.generateReporterId(),
         'smType': None,
-        'interval': DefaultInterval
+        'interval': DefaultInterval,
+        'state_file': DefaultStateFile,
+        'worker_threads': 0,
+        'interval_jitter': 0,
+        'start_stagger': 0,
+        'min_interval': MinimumSendInterval,
+        'max_interval': 0,
+        'checkin_batch_size': 0,
+        'checkin_concurrency': 1,
+        'compress_checkin': False,
     }
     LIST_OPTIONS = (
         'configs',
@@ -328,10 +337,18 @@ class GlobalConfig(GeneralConfig):
         'oneshot',
         'background',
         'print_'
-        'log_per_config'
+        'log_per_config',
+        'compress_checkin',
     )
     INT_OPTIONS = (
         'interval',
+        'worker_threads',
+        'interval_jitter',
+        'start_stagger',
+        'min_interval',
+        'max_interval',
+        'checkin_batch_size',
+        'checkin_concurrency',
     )
 
     @classmethod
@@ -362,6 +379,10 @@ class Config(GeneralConfig):
     BOOL_OPTIONS = (
         'is_hypervisor',
         'simplified_vim',
+        'partition_reports',
+    )
+    INT_OPTIONS = (
+        'journal_size',
     )
     PASSWORD_OPTIONS = (
         ('encrypted_password', 'password'),
@@ -451,6 +472,10 @@ class Config(GeneralConfig):
             if self.exclude_host_parents is not None:
                 logger.warn("exclude_host_parents is not supported in %s mode, ignoring it", self.type)
 
+        if self.type not in ('esx', 'rhevm'):
+            if self.partition_reports:
+                logger.warn("partition_reports is not supported in %s mode, ignoring it", self.type)
+
         if self.type != 'fake':
             if self.is_hypervisor is not None:
                 logger.warn("is_hypervisor is not supported in %s mode, ignoring it", self.type)
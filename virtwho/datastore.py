@@ -17,38 +17,151 @@ You should have received a copy of the GNU General Public License
 along with this program; if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """
+import os
+import time
+import errno
+import mmap
+import logging
+import tempfile
+from copy import copy
+from urllib import quote
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
 from threading import Lock
 
+from virtwho import DefaultSnapshotDir
+from virtwho.wakeup import WakeupSource, wait_for
 
-class Datastore(object):
-    """ This class is a threadsafe datastore"""
 
-    def __init__(self, *args, **kwargs):
+class _FrozenItem(object):
+    """ Frozen value stored by reference """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+
+class _SnapshotItem(object):
+    """ Report stored as memory-mapped snapshot, with its hashes """
+    __slots__ = ('snapshot', 'config', 'state', 'hash', 'partition_of',
+                 'partition_hashes')
+
+    def __init__(self, snapshot, config, state, hash, partition_of=None,
+                 partition_hashes=None):
+        self.snapshot = snapshot
+        self.config = config
+        self.state = state
+        self.hash = hash
+        self.partition_of = partition_of
+        self.partition_hashes = partition_hashes
+
+
+class Datastore(WakeupSource):
+    """
+    This class is a threadsafe datastore
+
+    In the default `pickle` mode every value is pickled on `put` and
+    unpickled on `get`, so each reader gets its own copy.
+
+    In the `frozen` mode values that have a `freeze` method (reports) are
+    frozen on `put` and stored by reference, `get` returns a shallow copy
+    sharing the immutable content. Other values are pickled as usual.
+
+    In the `mmap` mode host/guest association reports are written as
+    canonical JSON (the same as their `serializedAssociation`) to
+    `<snapshot_dir>/<quoted key>.json` and only the memory-mapped file and
+    the hashes are kept, so big reports don't stay on the heap. `get`
+    returns a `SnapshotReport` that decodes the hypervisors on first use.
+    The file always contains the latest complete snapshot (it's replaced
+    atomically), so it can be read by other tools. Other values are
+    pickled as usual, as are the reports if the snapshot can't be written.
+
+    The default mode can be set by the VIRTWHO_DATASTORE_MODE environment
+    variable, the default snapshot directory by VIRTWHO_SNAPSHOT_DIR.
+
+    Every `put` gets a new version number (versions only grow and are
+    shared by all the keys). `get_if_changed` and `wait_for_change` use
+    them to tell readers which keys were updated. Every `put` also wakes
+    up the threads waiting in `virtwho.wakeup.wait_for` on the datastore.
+    """
+    PICKLE = 'pickle'
+    FROZEN = 'frozen'
+    MMAP = 'mmap'
+    MODES = (PICKLE, FROZEN, MMAP)
+
+    default_mode = os.environ.get('VIRTWHO_DATASTORE_MODE', PICKLE).strip().lower()
+    if default_mode not in MODES:
+        default_mode = PICKLE
+    default_snapshot_dir = os.environ.get('VIRTWHO_SNAPSHOT_DIR', DefaultSnapshotDir)
+
+    def __init__(self, mode=None, snapshot_dir=None, *args, **kwargs):
+        if mode is None:
+            mode = self.default_mode
+        if mode not in self.MODES:
+            raise ValueError("Invalid datastore mode: %s" % mode)
+        super(Datastore, self).__init__()
+        self.mode = mode
+        self.snapshot_dir = snapshot_dir or self.default_snapshot_dir
+        self.logger = logging.getLogger('virtwho')
         self._datastore = dict()
         self._datastore_lock = Lock()
+        self._version = 0
+        self._versions = dict()
 
     def put(self, key, value):
         """
         Stores the value, retrievable by key, in a threadsafe manner in the
-        underlying datastore. (Assumes all items are pickleable)
+        underlying datastore. (Assumes all items are pickleable or, in the
+        frozen mode, can be frozen)
 
         @param key: The unique identifier for this value
         @type  key: str
 
         @param value: The object to store
         """
-        with self._datastore_lock:
+        to_store = None
+        if self.mode == self.FROZEN and hasattr(value, 'freeze'):
+            # Freezing computes hashes etc., do it before taking the lock
+            value.freeze()
+            to_store = _FrozenItem(value)
+        elif self.mode == self.MMAP:
+            to_store = self._write_snapshot(key, value)
+        if to_store is None:
             to_store = pickle.dumps(value)
+        with self._datastore_lock:
+            self._version += 1
+            self._versions[key] = self._version
             self._datastore[key] = to_store
+        self.wake_waiters()
+
+    def delete(self, key):
+        """
+        Removes the value for the given key (if there is any) from the
+        underlying datastore, in the `mmap` mode its snapshot file too.
+
+        @param key: The unique identifier for this value
+        @type  key: str
+        """
+        with self._datastore_lock:
+            self._datastore.pop(key, None)
+            self._versions.pop(key, None)
+            if self.mode == self.MMAP:
+                # Readers keep the mapping of removed file
+                filename = self._snapshot_filename(key)
+                try:
+                    os.unlink(filename)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        self.logger.warning("Unable to remove snapshot %s: %s",
+                                            filename, str(e))
 
     def get(self, key, default=None):
         """
         Retrieves the value for the given key, in a threadsafe manner from the
-        underlying datastore. (Assumes all items in the datastore are pickled)
+        underlying datastore. (Assumes all items in the datastore are pickled
+        or frozen)
 
         @param key: The unique identifier for this value
         @type  key: str
@@ -61,9 +174,125 @@ class Datastore(object):
         """
         with self._datastore_lock:
             try:
-                item = pickle.loads(self._datastore[key])
-                return item
+                item = self._datastore[key]
             except KeyError:
                 if default:
                     return default
                 raise
+        return self._load(item)
+
+    def _write_snapshot(self, key, report):
+        """
+        Write the report to its snapshot file and map it to memory.
+
+        @return: _SnapshotItem or None if the value is not a host/guest
+        association report or the snapshot can't be written
+        """
+        # Imports can't be top-level, it would be circular dependency
+        from virtwho.virt import HostGuestAssociationReport, ReportSerializer
+        if not isinstance(report, HostGuestAssociationReport):
+            return None
+        partition_of = None
+        partition_hashes = None
+        if report.partitioned:
+            partition_hashes = report.partition_hashes
+            partition_of = dict(
+                (hypervisor.hypervisorId, hypervisor.partition)
+                for hypervisor in report.association['hypervisors']
+                if hypervisor.partition is not None)
+        filename = self._snapshot_filename(key)
+        try:
+            if not os.path.isdir(self.snapshot_dir):
+                os.makedirs(self.snapshot_dir, 0700)
+            fd, tmp_name = tempfile.mkstemp(prefix='.snapshot', dir=self.snapshot_dir)
+            try:
+                with os.fdopen(fd, 'w+') as f:
+                    serializer = ReportSerializer(f)
+                    serializer.write_association(report)
+                    serializer.flush()
+                    f.flush()
+                    # Readers keep the mapping even after the file is replaced
+                    snapshot = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                os.rename(tmp_name, filename)
+            except Exception:
+                os.unlink(tmp_name)
+                raise
+        except (IOError, OSError, mmap.error) as e:
+            self.logger.warning("Unable to write snapshot %s, keeping the report in memory: %s",
+                                filename, str(e))
+            return None
+        return _SnapshotItem(snapshot, report.config, report.state, report.hash,
+                             partition_of, partition_hashes)
+
+    def _snapshot_filename(self, key):
+        return os.path.join(self.snapshot_dir, quote(key, safe='') + '.json')
+
+    @staticmethod
+    def _load(item):
+        if isinstance(item, _FrozenItem):
+            return copy(item.value)
+        if isinstance(item, _SnapshotItem):
+            # Imports can't be top-level, it would be circular dependency
+            from virtwho.virt import SnapshotReport
+            return SnapshotReport(item.config, item.snapshot, item.hash,
+                                  item.partition_of, item.partition_hashes,
+                                  item.state)
+        return pickle.loads(item)
+
+    @property
+    def version(self):
+        """
+        Version of the last update of any key, 0 if there was none.
+        """
+        with self._datastore_lock:
+            return self._version
+
+    def get_if_changed(self, key, since_version):
+        """
+        Retrieves the value for the given key only if it was updated after
+        `since_version`. The value is not loaded at all otherwise.
+
+        @param key: The unique identifier for this value
+        @type  key: str
+
+        @param since_version: Version returned by previous call (or 0)
+        @type  since_version: int
+
+        @return: tuple (version, value) or None if the key has no newer
+        value
+        """
+        with self._datastore_lock:
+            version = self._versions.get(key)
+            if version is None or version <= since_version:
+                return None
+            item = self._datastore[key]
+        return version, self._load(item)
+
+    def wait_for_change(self, keys, timeout=None, since_version=None):
+        """
+        Blocks until any of the keys is updated after `since_version`
+        (by default after the call) or until the timeout expires.
+
+        @param keys: The keys to watch
+        @type  keys: list
+
+        @param timeout: Maximal time to wait in seconds, None means forever
+        @type  timeout: float
+
+        @param since_version: Only updates newer than this version count
+        @type  since_version: int
+
+        @return: list of keys that were updated, empty if the timeout expired
+        """
+        if since_version is None:
+            since_version = self.version
+        return wait_for(lambda: self.changed_keys(keys, since_version),
+                        [self], timeout) or []
+
+    def changed_keys(self, keys, since_version):
+        """
+        Return list of the keys that were updated after `since_version`.
+        """
+        with self._datastore_lock:
+            return [key for key in keys
+                    if self._versions.get(key, 0) > since_version]
@@ -1,19 +1,21 @@
-import time
-from threading import Event
 from Queue import Empty, Queue
 import errno
 import socket
 import sys
+import time
 
 from virtwho import log, MinimumSendInterval
 
 from virtwho.config import ConfigManager
 from virtwho.datastore import Datastore
+from virtwho.scheduler import Scheduler
+from virtwho.state import SentState, destination_key
+from virtwho.wakeup import WakeupEvent, wait_for
 from virtwho.manager import (
     Manager, ManagerThrottleError, ManagerError, ManagerFatalError)
 from virtwho.virt import (
     AbstractVirtReport, ErrorReport, DomainListReport,
-    HostGuestAssociationReport, Virt, DestinationThread,
+    HostGuestAssociationReport, Virt, DestinationThread, IntervalThread,
     info_to_destination_class)
 
 try:
@@ -38,16 +40,31 @@ class Executor(object):
         """
         self.logger = logger
         self.options = options
-        self.terminate_event = Event()
+        self.terminate_event = WakeupEvent()
         self.virts = []
         self.destinations = []
+        # Runs the poll-style virts when worker_threads option is set
+        self.scheduler = None
 
         # Queue for getting events from virt backends
         self.datastore = Datastore()
         self.reloading = False
-
+        # Threads were started by `run`, `reload` updates them in place
+        self.running = False
+        # `run` is creating and starting the threads, reload requested
+        # meanwhile is done once they are all started
+        self.starting = False
+        self.reload_pending = False
+
+        self.config_dir = config_dir
         self.configManager = ConfigManager(self.logger, config_dir)
 
+        # Hashes of sent reports, kept across reloads and restarts
+        self.state = None
+        state_file = getattr(options, 'state_file', None)
+        if isinstance(state_file, basestring) and state_file:
+            self.state = SentState(state_file, logger=self.logger)
+
         for config in self.configManager.configs:
             logger.debug("Using config named '%s'" % config.name)
 
@@ -57,18 +74,27 @@ class Executor(object):
         """
         virts = []
         for config in self.configManager.configs:
-            try:
-                logger = log.getLogger(config=config)
-                virt = Virt.from_config(logger, config, self.datastore,
-                                        terminate_event=self.terminate_event,
-                                        interval=self.options.interval,
-                                        oneshot=self.options.oneshot)
-            except Exception as e:
-                self.logger.error('Unable to use configuration "%s": %s', config.name, str(e))
-                continue
-            virts.append(virt)
+            virt = self._create_virt(config)
+            if virt is not None:
+                virts.append(virt)
         return virts
 
+    def _create_virt(self, config):
+        """
+        Create virt backend thread for the config, None if it fails.
+        """
+        try:
+            logger = log.getLogger(config=config)
+            virt = Virt.from_config(logger, config, self.datastore,
+                                    terminate_event=self.terminate_event,
+                                    interval=self.options.interval,
+                                    oneshot=self.options.oneshot)
+        except Exception as e:
+            self.logger.error('Unable to use configuration "%s": %s', config.name, str(e))
+            return None
+        self._configure_schedule(virt)
+        return virt
+
     def _create_destinations(self):
         """Populate self.destinations with a list of  list with them
 
@@ -82,20 +108,47 @@ class Executor(object):
             # at this time. This method will make no assumptions of creating
             # defaults of any kind.
             source_keys = self.configManager.dest_to_sources_map[info]
-            info.name = "destination_%s" % hash(info)
-            logger = log.getLogger(name=info.name)
-            manager = Manager.fromInfo(logger, self.options, info)
-            dest_class = info_to_destination_class[type(info)]
-            dest = dest_class(config=info, logger=logger,
-                              source_keys=source_keys,
-                              options=self.options,
-                              source=self.datastore, dest=manager,
-                              terminate_event=self.terminate_event,
-                              interval=self.options.interval,
-                              oneshot=self.options.oneshot)
-            dests.append(dest)
+            dests.append(self._create_destination(info, source_keys))
         return dests
 
+    def _create_destination(self, info, source_keys):
+        """
+        Create destination thread for the info, sending reports of given
+        sources.
+        """
+        # The name has to be the same in every run of virt-who, start of
+        # the destination is staggered by it
+        info.name = "destination_%s" % destination_key(info)[:16]
+        logger = log.getLogger(name=info.name)
+        manager = Manager.fromInfo(logger, self.options, info)
+        dest_class = info_to_destination_class[type(info)]
+        dest = dest_class(config=info, logger=logger,
+                          source_keys=source_keys,
+                          options=self.options,
+                          source=self.datastore, dest=manager,
+                          terminate_event=self.terminate_event,
+                          interval=self.options.interval,
+                          oneshot=self.options.oneshot,
+                          state=self.state,
+                          state_key=destination_key(info, manager.identity()))
+        self._configure_schedule(dest)
+        return dest
+
+    @staticmethod
+    def _info_key(info):
+        """
+        Identity of the destination info that doesn't change when its name
+        is set (unlike `hash(info)`).
+        """
+        options = []
+        for key, value in sorted(info):
+            if key == 'name':
+                continue
+            if isinstance(value, list):
+                value = tuple(value)
+            options.append((key, value))
+        return type(info), tuple(options)
+
     @staticmethod
     def wait_on_threads(threads, max_wait_time=None, kill_on_timeout=False):
         """
@@ -117,22 +170,24 @@ class Executor(object):
         not quit yet.
         @rtype: list
         """
-        total_waited = 0
         threads_not_terminated = list(threads)
-        while len(threads_not_terminated) > 0:
-            if max_wait_time is not None and total_waited > max_wait_time:
-                if kill_on_timeout:
-                    Executor.terminate_threads(threads_not_terminated)
-                    return []
-                return threads_not_terminated
-            for thread in threads_not_terminated:
-                if thread.is_terminated():
-                    threads_not_terminated.remove(thread)
-            if not threads_not_terminated:
-                break
-            time.sleep(1)
-            if max_wait_time is not None:
-                total_waited += 1
+        sources = []
+        for thread in threads:
+            if isinstance(thread, IntervalThread):
+                sources.extend(thread.wakeup_sources)
+            else:
+                # Checked every second
+                sources.append(thread)
+
+        def all_terminated():
+            threads_not_terminated[:] = [
+                thread for thread in threads_not_terminated
+                if not thread.is_terminated()]
+            return not threads_not_terminated
+
+        if not wait_for(all_terminated, sources, max_wait_time) and kill_on_timeout:
+            Executor.terminate_threads(threads_not_terminated)
+            return []
         return threads_not_terminated
 
     @staticmethod
@@ -142,7 +197,36 @@ class Executor(object):
             if thread.ident:
                 thread.join()
 
+    def _start_destinations_when_ready(self, start_time):
+        """
+        Start each destination as soon as all its sources have finished
+        (put their report or error to the datastore), so slow sources of
+        one destination don't delay the others.
+        """
+        pending = list(self.destinations)
+        virts = dict((virt.config.name, virt) for virt in self.virts)
+        sources = []
+        for virt in self.virts:
+            sources.extend(virt.wakeup_sources)
+
+        def start_ready():
+            for thread in pending[:]:
+                # Sources that failed to start won't put anything
+                if all(virts[source_key].is_terminated()
+                       for source_key in thread.source_keys
+                       if source_key in virts):
+                    self.logger.debug("Sources %s are done after %.1f seconds, "
+                                      "starting their destination",
+                                      ', '.join(thread.source_keys),
+                                      time.time() - start_time)
+                    thread.start()
+                    pending.remove(thread)
+            return not pending
+
+        wait_for(start_ready, sources)
+
     def run_oneshot(self):
+        start_time = time.time()
         # Start all sources
         self.virts = self._create_virt_backends()
 
@@ -160,12 +244,10 @@ class Executor(object):
             self.terminate()
             sys.exit(err)
 
-        for thread in self.virts:
-            thread.start()
-
-        Executor.wait_on_threads(self.virts)
+        self._start_virts()
 
         if self.options.print_:
+            Executor.wait_on_threads(self.virts)
             to_print = {}
             for source in self.configManager.sources:
                 try:
@@ -177,18 +259,42 @@ class Executor(object):
                                      '\"%s\" for printing' % source)
             return to_print
 
-        for thread in self.destinations:
-            thread.start()
-
+        self._start_destinations_when_ready(start_time)
         Executor.wait_on_threads(self.destinations)
+        self.logger.info("Oneshot run finished in %.1f seconds", time.time() - start_time)
 
     def run(self):
         self.logger.debug("Starting infinite loop with %d seconds interval", self.options.interval)
 
+        if self.running:
+            # Reloaded, the threads were already updated by `reload`
+            self._wait_on_destinations()
+            self.terminate()
+            return
+
+        # SIGHUP handler runs in this thread, it can't wait for the start
+        # to finish, `reload` only marks the reload as pending until then
+        self.starting = True
+        try:
+            self._start()
+        finally:
+            self.starting = False
+        if self.reload_pending:
+            self.logger.info("Reloading")
+            self.reload()
+
+        # Interruptibly wait on the other threads to be terminated
+        self._wait_on_destinations()
+
+        self.terminate()
+
+    def _start(self):
+        """
+        Create and start all the sources and destinations.
+        """
         # Need to update the dest to source mapping of the configManager object
         # here because of the way that main reads the config from the command
         # line
-        # TODO: Update dests to source map on addition or removal of configs
         self.configManager.update_dest_to_source_map()
         # Start all sources
         self.virts = self._create_virt_backends()
@@ -206,20 +312,70 @@ class Executor(object):
             self.terminate()
             sys.exit(err)
 
-        for thread in self.virts:
-            thread.start()
+        self._start_virts()
 
         for thread in self.destinations:
             thread.start()
+        self.running = True
 
-        # Interruptibly wait on the other threads to be terminated
+    def _wait_on_destinations(self):
+        """
+        Wait for all the destinations to be terminated. If there are none
+        (reload removed all of them), wait until virt-who is terminated or
+        reloaded again instead of exiting.
+        """
+        if not self.destinations:
+            self.logger.warning("No destinations are configured, waiting "
+                                "for the configuration to be reloaded")
+            wait_for(self.terminate_event.is_set, [self.terminate_event])
+            return
         self.wait_on_threads(self.destinations)
 
-        self.terminate()
+    def _configure_schedule(self, thread):
+        """
+        Set the jitter and start staggering of the thread from options,
+        and the adaptive interval bounds of the polling backends.
+        """
+        for option in ('interval_jitter', 'start_stagger'):
+            value = getattr(self.options, option, 0)
+            if isinstance(value, (int, long)) and value > 0:
+                setattr(thread, option, value)
+        if isinstance(thread, Virt) and thread.schedulable:
+            for option in ('min_interval', 'max_interval'):
+                value = getattr(self.options, option, 0)
+                if isinstance(value, (int, long)) and value > 0:
+                    setattr(thread, option, value)
+
+    def _start_virts(self, virts=None):
+        """
+        Start the virt backends (all of them by default). With
+        `worker_threads` option set, the poll-style backends are run by the
+        scheduler on a pool of that many threads, only the event-driven
+        ones get threads of their own.
+        """
+        if virts is None:
+            virts = self.virts
+        workers = getattr(self.options, 'worker_threads', 0)
+        scheduled = []
+        if isinstance(workers, int) and workers > 0:
+            scheduled = [virt for virt in virts if virt.schedulable]
+        if scheduled:
+            if self.scheduler is None:
+                self.scheduler = Scheduler(self.logger, min(workers, len(scheduled)))
+                self.scheduler.start()
+            for virt in scheduled:
+                self.scheduler.add(virt, virt.start_delay())
+        scheduled_ids = set(id(virt) for virt in scheduled)
+        for virt in virts:
+            if id(virt) not in scheduled_ids:
+                virt.start()
 
     def stop_threads(self):
         self.terminate_event.set()
         self.terminate_threads(self.virts)
+        if self.scheduler is not None:
+            self.scheduler.stop()
+            self.scheduler = None
         self.terminate_threads(self.destinations)
 
     def terminate(self):
@@ -228,11 +384,112 @@ class Executor(object):
         self.virts = []
         self.destinations = []
         self.datastore = None
+        self.running = False
 
     def reload(self):
         """
-        Causes all threads to be terminated in preparation for running again
+        Re-read the configuration and restart only the sources and
+        destinations whose configuration changed, the others keep running
+        (with their sessions and reports).
+
+        In oneshot mode all threads are terminated in preparation for
+        running again.
+
+        @return: False if the threads are being started, the reload is
+        then done by `run` once they are started
+        """
+        if self.starting:
+            self.logger.debug("Reload requested while starting, "
+                              "reloading once started")
+            self.reload_pending = True
+            return False
+        self.reload_pending = False
+        if self.options.oneshot:
+            self.stop_threads()
+            self.virts = []
+            self.destinations = []
+            self.terminate_event.clear()
+            self.datastore = Datastore()
+            return True
+        configManager = self._read_configs()
+        if configManager is None:
+            return True
+        self.configManager = configManager
+        self._reload_virts()
+        self._reload_destinations()
+        return True
+
+    def _read_configs(self):
         """
-        self.stop_threads()
-        self.terminate_event.clear()
-        self.datastore = Datastore()
\ No newline at end of file
+        Read the configuration the same way as on start.
+
+        @return: new ConfigManager or None if there are no valid configs
+        """
+        configManager = ConfigManager(self.logger, self.config_dir)
+        for conffile in getattr(self.options, 'configs', None) or []:
+            try:
+                configManager.readFile(conffile)
+            except Exception as e:
+                self.logger.error('Config file "%s" skipped because of an error: %s',
+                                  conffile, str(e))
+        # Configuration from command line or environment doesn't change
+        for config in self.configManager.configs:
+            if config.name == 'env/cmdline':
+                configManager.addConfig(config)
+        if len(configManager.configs) == 0:
+            self.logger.error("No valid configuration found, keeping the current one")
+            return None
+        configManager.update_dest_to_source_map()
+        return configManager
+
+    def _reload_virts(self):
+        running = dict((virt.config.name, virt) for virt in self.virts)
+        configs = dict((config.name, config) for config in self.configManager.configs)
+        stopped = []
+        for name, virt in running.items():
+            config = configs.get(name)
+            if config is None or config.hash != virt.config.hash:
+                self.logger.info('Stopping source "%s"', name)
+                stopped.append(virt)
+                del running[name]
+        self.terminate_threads(stopped)
+        for virt in stopped:
+            self.datastore.delete(virt.config.name)
+
+        started = []
+        for config in self.configManager.configs:
+            if config.name in running:
+                continue
+            virt = self._create_virt(config)
+            if virt is not None:
+                self.logger.info('Starting source "%s"', config.name)
+                started.append(virt)
+        self._start_virts(started)
+        self.virts = [virt for virt in self.virts if virt.config.name in running] + started
+
+    def _reload_destinations(self):
+        running = {}
+        for dest in self.destinations:
+            running[(self._info_key(dest.config), tuple(dest.source_keys))] = dest
+        kept = []
+        started = []
+        for info in self.configManager.dests:
+            source_keys = self.configManager.dest_to_sources_map[info]
+            dest = running.pop((self._info_key(info), tuple(source_keys)), None)
+            if dest is not None:
+                kept.append(dest)
+                continue
+            try:
+                dest = self._create_destination(info, source_keys)
+            except Exception as e:
+                self.logger.error('Unable to use destination for sources %s: %s',
+                                  ', '.join(source_keys), str(e))
+                continue
+            started.append(dest)
+        for dest in running.values():
+            self.logger.info('Stopping destination for sources %s', ', '.join(dest.source_keys))
+        self.terminate_threads(running.values())
+        for dest in started:
+            self.logger.info('Starting destination for sources %s', ', '.join(dest.source_keys))
+            dest.start()
+        self.destinations = kept + started
\ No newline at end of file
@@ -37,7 +37,8 @@ from virtwho.executor import Executor, ReloadRequest
 from virtwho.manager import ManagerFatalError
 from virtwho.parser import parseOptions, OptionError
 from virtwho.password import InvalidKeyFile
-from virtwho.virt import DomainListReport, HostGuestAssociationReport
+from virtwho.virt import DomainListReport, HostGuestAssociationReport, \
+    ChangeJournal
 
 try:
     from systemd.daemon import notify as sd_notify
@@ -104,11 +105,25 @@ def atexit_fn(*args, **kwargs):
 
 def reload(signal, stackframe):
     if executor:
-        executor.reload()
-        raise ReloadRequest()
+        if executor.reload():
+            raise ReloadRequest()
+        return
     exit(1, status="virt-who cannot reload, exiting")
 
 
+def dump_changes(signal, stackframe):
+    """
+    Print recent changes of all sources in JSON format, in the background
+    the changes are logged instead.
+    """
+    data = ChangeJournal.dump()
+    if executor and executor.options.background:
+        executor.logger.info("Recent changes: %s", data)
+    else:
+        print(data)
+        sys.stdout.flush()
+
+
 def main():
     logger = options = None
     try:
@@ -191,6 +206,7 @@ def main():
     with locker():
         signal.signal(signal.SIGHUP, reload)
         signal.signal(signal.SIGTERM, atexit_fn)
+        signal.signal(signal.SIGUSR1, dump_changes)
 
         executor.logger = logger = log.getLogger(name='main', config=None,
                                                  queue=True)
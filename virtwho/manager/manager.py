@@ -60,6 +60,23 @@ class Manager(object):
         '''
         raise NotImplementedError()
 
+    def server(self, report):
+        '''
+        Return identifier of the server the report is sent to, callers
+        aimed at the same server share its throttling (see
+        `virtwho.ratelimit`). None means the server is not known.
+        '''
+        return None
+
+    def identity(self):
+        '''
+        Return identifier of the server and account the reports are sent
+        to, as far as the destination info doesn't tell it. Sent reports
+        are remembered per destination and identity (see `virtwho.state`).
+        None means there is nothing to add to the destination info.
+        '''
+        return None
+
     @classmethod
     def fromOptions(cls, logger, options, config=None):
         # Imports can't be top-level, it would be circular dependency
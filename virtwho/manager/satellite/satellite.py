@@ -21,6 +21,7 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 import xmlrpclib
 import pickle
 import json
+import logging
 
 from virtwho.manager import Manager, ManagerError
 from virtwho.util import RequestsXmlrpcTransport
@@ -216,8 +217,9 @@ class Satellite(Manager):
         hypervisor_count = len(mapping['hypervisors'])
         guest_count = sum(len(hypervisor.guestIds) for hypervisor in mapping['hypervisors'])
         self.logger.info("Sending update in hosts-to-guests mapping: %d hypervisors and %d guests found", hypervisor_count, guest_count)
-        serialized_mapping = {'hypervisors': [h.toDict() for h in mapping['hypervisors']]}
-        self.logger.debug("Host-to-guest mapping: %s", json.dumps(serialized_mapping, indent=4))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            serialized_mapping = {'hypervisors': [h.toDict() for h in mapping['hypervisors']]}
+            self.logger.debug("Host-to-guest mapping: %s", json.dumps(serialized_mapping, indent=4))
         if len(mapping) == 0:
             self.logger.info("no hypervisors found, not sending data to satellite")
 
@@ -19,7 +19,15 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """
 
 import os
+import ssl
 import json
+import zlib
+import base64
+import socket
+import urllib
+import logging
+import threading
+import httplib
 from httplib import BadStatusLine
 
 import rhsm.connection as rhsm_connection
@@ -28,7 +36,7 @@ import rhsm.config as rhsm_config
 
 from virtwho.config import NotSetSentinel
 from virtwho.manager import Manager, ManagerError, ManagerFatalError, ManagerThrottleError
-from virtwho.virt import AbstractVirtReport
+from virtwho.virt import AbstractVirtReport, HostGuestAssociationReport, ReportSerializer
 
 
 class SubscriptionManagerError(ManagerError):
@@ -39,6 +47,32 @@ class SubscriptionManagerUnregisteredError(ManagerFatalError):
     pass
 
 
+class GzipBuffer(object):
+    """
+    File-like object that compresses everything written to it with gzip
+    right away, so only the compressed data is kept in memory.
+    """
+    def __init__(self, level=6):
+        # wbits 16 + MAX_WBITS makes zlib write gzip header and trailer
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self._compressed = []
+        # Number of uncompressed bytes written
+        self.size = 0
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.size += len(data)
+        self._compressed.append(self._compressor.compress(data))
+
+    def getvalue(self):
+        """ Finish the compression and return the gzip data. """
+        if self._compressor is not None:
+            self._compressed.append(self._compressor.flush())
+            self._compressor = None
+        return ''.join(self._compressed)
+
+
 # Mapping between strings returned from getJob and report statuses
 STATE_MAPPING = {
     'FINISHED': AbstractVirtReport.STATE_FINISHED,
@@ -51,6 +85,12 @@ STATE_MAPPING = {
 
 class SubscriptionManager(Manager):
     smType = "sam"
+    # Connection settings of python-rhsm used for compressed check-ins
+    RESTLIB_ATTRIBUTES = (
+        'host', 'ssl_port', 'apihandler', 'headers', 'user_agent', 'timeout',
+        'insecure', 'ca_dir', 'cert_file', 'key_file', 'proxy_hostname',
+        'proxy_port', 'proxy_user', 'proxy_password', '_load_ca_certificates',
+        'validateResponse')
 
     """ Class for interacting subscription-manager. """
     def __init__(self, logger, options):
@@ -58,8 +98,62 @@ class SubscriptionManager(Manager):
         self.options = options
         self.cert_uuid = None
         self.rhsm_config = None
+        # Thread -> (connection settings, UEPConnection) the thread uses.
+        # UEPConnection can't be used by several threads at once, but the
+        # connections of finished threads (like the workers sending chunks
+        # of the previous check-in) are taken over by new threads.
+        self._connections = {}
+        self._connections_lock = threading.Lock()
+        # Set when the server doesn't accept compressed check-ins
+        self.compression_rejected = False
+        # Number of connections opened and number of times an open
+        # connection was used instead of opening a new one
+        self.connections_opened = 0
+        self.connections_reused = 0
         self.readConfig()
 
+    @property
+    def connection(self):
+        """ UEPConnection of the calling thread, chunks of one check-in
+            can be sent from several threads at once. """
+        return self._connections.get(threading.current_thread(), (None, None))[1]
+
+    @connection.setter
+    def connection(self, connection):
+        thread = threading.current_thread()
+        with self._connections_lock:
+            if connection is None:
+                self._connections.pop(thread, None)
+            else:
+                self._connections[thread] = (None, connection)
+
+    @property
+    def _connection_kwargs(self):
+        """ Settings the connection of the calling thread was made with. """
+        return self._connections.get(threading.current_thread(), (None, None))[0]
+
+    def _take_connection(self, kwargs):
+        """
+        Find open connection made with given settings for the calling
+        thread: its own one or one left by a finished thread. Connections
+        of the finished threads made with other settings are dropped.
+
+        @return: True if there is such connection
+        """
+        thread = threading.current_thread()
+        with self._connections_lock:
+            entry = self._connections.get(thread)
+            if entry is not None and entry[0] == kwargs:
+                return True
+            for owner, owner_entry in self._connections.items():
+                if owner is thread or owner.is_alive():
+                    continue
+                del self._connections[owner]
+                if owner_entry[0] == kwargs:
+                    self._connections[thread] = owner_entry
+                    return True
+            return False
+
     def readConfig(self):
         """ Parse rhsm.conf in order to obtain consumer
             certificate and key paths. """
@@ -72,7 +166,16 @@ class SubscriptionManager(Manager):
         self.key_file = os.path.join(consumerCertDir, key)
 
     def _connect(self, config=None):
-        """ Connect to the subscription-manager. """
+        """
+        Connect to the subscription-manager.
+
+        The connection is kept open and used again by the next call from
+        the same thread (or from a new thread, once this one is finished),
+        unless it's made with different settings or the connection failed
+        in the meantime (see `_disconnect`). Reusing it saves the ping and
+        the capability check; whether the HTTPS connection itself is kept
+        open between requests depends on python-rhsm.
+        """
 
         kwargs = {
             'host': self.rhsm_config.get('server', 'hostname'),
@@ -123,23 +226,88 @@ class SubscriptionManager(Manager):
                     continue
 
         if rhsm_username and rhsm_password:
-            self.logger.debug("Authenticating with RHSM username %s", rhsm_username)
             kwargs['username'] = rhsm_username
             kwargs['password'] = rhsm_password
         else:
-            self.logger.debug("Authenticating with certificate: %s", self.cert_file)
             if not os.access(self.cert_file, os.R_OK):
                 raise SubscriptionManagerUnregisteredError(
                     "Unable to read certificate, system is not registered or you are not root")
             kwargs['cert_file'] = self.cert_file
             kwargs['key_file'] = self.key_file
 
-        self.connection = rhsm_connection.UEPConnection(**kwargs)
+        if self._take_connection(kwargs):
+            self.connections_reused += 1
+            self.logger.debug("Using open connection to subscription manager "
+                              "(%d connections reused)", self.connections_reused)
+            return
+
+        if 'username' in kwargs:
+            self.logger.debug("Authenticating with RHSM username %s", rhsm_username)
+        else:
+            self.logger.debug("Authenticating with certificate: %s", self.cert_file)
+        connection = rhsm_connection.UEPConnection(**kwargs)
+        with self._connections_lock:
+            self._connections[threading.current_thread()] = (kwargs, connection)
+        self.connections_opened += 1
         try:
-            if not self.connection.ping()['result']:
+            if not connection.ping()['result']:
                 raise SubscriptionManagerError("Unable to obtain status from server, UEPConnection is likely not usable.")
-        except BadStatusLine:
+        except ManagerError:
+            self._disconnect()
+            raise
+        except Exception as e:
+            # The connection is not usable, whatever the error was
+            self._disconnect()
+            self._connection_failed(e)
+
+    def server(self, report):
+        """ Return "host:port" of the server the report is sent to. """
+        # Only host/guest reports are sent with settings from the config
+        # (see `hypervisorCheckIn` and `sendVirtGuests`)
+        config = report.config if isinstance(report, HostGuestAssociationReport) else None
+        host = self.rhsm_config.get('server', 'hostname')
+        port = self.rhsm_config.get('server', 'port')
+        if config:
+            for key in ('rhsm_hostname', 'rhsm_port'):
+                try:
+                    value = config[key]
+                except KeyError:
+                    continue
+                if value is not NotSetSentinel and value is not None:
+                    if key == 'rhsm_hostname':
+                        host = value
+                    else:
+                        port = value
+        return '%s:%s' % (host, port)
+
+    def identity(self):
+        """ Return "host:port" of the default server and UUID of the
+            consumer (None if the system is not registered). """
+        try:
+            consumer = self.uuid()
+        except SubscriptionManagerError:
+            consumer = None
+        return [self.rhsm_config.get('server', 'hostname'),
+                self.rhsm_config.get('server', 'port'), consumer]
+
+    def _disconnect(self):
+        """ Drop the connection of the calling thread, the next call will
+            open a new one. """
+        self.connection = None
+
+    def _connection_failed(self, e):
+        """
+        Handle exception raised by python-rhsm. Connection errors (those
+        without HTTP status code) drop the connection so the next call
+        opens a new one.
+        """
+        if isinstance(e, BadStatusLine):
+            self._disconnect()
             raise ManagerError("Communication with subscription manager interrupted")
+        if hasattr(e, 'code'):
+            raise ManagerError("Communication with subscription manager failed with code %d: %s" % (e.code, str(e)))
+        self._disconnect()
+        raise ManagerError("Communication with subscription manager failed: %s" % str(e))
 
     def sendVirtGuests(self, report, options=None):
         """
@@ -147,17 +315,17 @@ class SubscriptionManager(Manager):
 
         `guests` is a list of `Guest` instances (or it children).
         """
-        guests = report.guests
         self._connect()
 
-        # Sort the list
-        guests.sort(key=lambda item: item.uuid)
+        # Sort the list (a copy, guests of a frozen report can't be changed)
+        guests = sorted(report.guests, key=lambda item: item.uuid)
 
         serialized_guests = [guest.toDict() for guest in guests]
         self.logger.info('Sending update in guests lists for config '
                          '"%s": %d guests found',
                          report.config.name, len(guests))
-        self.logger.debug("Domain info: %s", json.dumps(serialized_guests, indent=4))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Domain info: %s", json.dumps(serialized_guests, indent=4))
 
         # Send list of guest uuids to the server
         try:
@@ -167,14 +335,18 @@ class SubscriptionManager(Manager):
         except rhsm_connection.RateLimitExceededException as e:
             retry_after = int(getattr(e, 'headers', {}).get('Retry-After', '60'))
             raise ManagerThrottleError(retry_after)
+        except (BadStatusLine, socket.error) as e:
+            self._connection_failed(e)
         report.state = AbstractVirtReport.STATE_FINISHED
 
     def hypervisorCheckIn(self, report, options=None):
         """ Send hosts to guests mapping to subscription manager. """
         mapping = report.association
-        serialized_mapping = {}
+        serialized_mapping = None
 
         self._connect(report.config)
+        # python-rhsm keeps the capabilities for the lifetime of the
+        # connection and uses them to choose the format of the check-in
         self.logger.debug("Checking if server has capability 'hypervisor_async'")
         is_async = hasattr(self.connection, 'has_capability') and self.connection.has_capability('hypervisors_async')
         if is_async and os.environ.get('VIRTWHO_DISABLE_ASYNC', '').lower() in ['1', 'yes', 'true']:
@@ -183,42 +355,47 @@ class SubscriptionManager(Manager):
 
         if is_async:
             self.logger.debug("Server has capability 'hypervisors_async'")
-            # Transform the mapping into the async version
-            serialized_mapping = {'hypervisors': [h.toDict() for h in mapping['hypervisors']]}
-
         else:
             self.logger.debug("Server does not have 'hypervisors_async' capability")
-            # Reformat the data from the mapping to make it fit with
-            # the old api.
-            for hypervisor in mapping['hypervisors']:
-                guests = [g.toDict() for g in hypervisor.guestIds]
-                serialized_mapping[hypervisor.hypervisorId] = guests
 
         hypervisor_count = len(mapping['hypervisors'])
         guest_count = sum(len(hypervisor.guestIds) for hypervisor in mapping['hypervisors'])
         self.logger.info('Sending update in hosts-to-guests mapping for config '
                          '"%s": %d hypervisors and %d guests found',
                          report.config.name, hypervisor_count, guest_count)
-        self.logger.debug("Host-to-guest mapping: %s", json.dumps(serialized_mapping, indent=4))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            # Serializing large mappings is expensive, don't do it needlessly
+            serialized_mapping = self._serialize_mapping(mapping, is_async)
+            self.logger.debug("Host-to-guest mapping: %s", json.dumps(serialized_mapping, indent=4))
+        compress = getattr(options, 'compress_checkin', False) is True and \
+            not self.compression_rejected
         try:
-            try:
-                result = self.connection.hypervisorCheckIn(report.config.owner, report.config.env, serialized_mapping, options=options)  # pylint:disable=unexpected-keyword-arg
-            except TypeError:
-                # This is temporary workaround until the options parameter gets implemented
-                # in python-rhsm
-                self.logger.debug("hypervisorCheckIn method in python-rhsm doesn't understand options parameter, ignoring")
-                result = self.connection.hypervisorCheckIn(report.config.owner, report.config.env, serialized_mapping)
-        except BadStatusLine:
-            raise ManagerError("Communication with subscription manager interrupted")
+            sent = False
+            if compress:
+                sent, result = self._compressed_check_in(report, is_async, options)
+            if not sent:
+                if serialized_mapping is None:
+                    serialized_mapping = self._serialize_mapping(mapping, is_async)
+                try:
+                    result = self.connection.hypervisorCheckIn(report.config.owner, report.config.env, serialized_mapping, options=options)  # pylint:disable=unexpected-keyword-arg
+                except TypeError:
+                    # This is temporary workaround until the options parameter gets implemented
+                    # in python-rhsm
+                    self.logger.debug("hypervisorCheckIn method in python-rhsm doesn't understand options parameter, ignoring")
+                    result = self.connection.hypervisorCheckIn(report.config.owner, report.config.env, serialized_mapping)
+                if compress and not self.compression_rejected:
+                    # The server refused the compressed check-in, but
+                    # accepted the same one uncompressed
+                    self.logger.info("Server doesn't accept compressed check-in, "
+                                     "sending check-ins uncompressed")
+                    self.compression_rejected = True
         except rhsm_connection.RateLimitExceededException as e:
             retry_after = int(getattr(e, 'headers', {}).get('Retry-After', '60'))
             raise ManagerThrottleError(retry_after)
         except rhsm_connection.GoneException:
             raise ManagerError("Communication with subscription manager failed: consumer no longer exists")
-        except rhsm_connection.ConnectionException as e:
-            if hasattr(e, 'code'):
-                raise ManagerError("Communication with subscription manager failed with code %d: %s" % (e.code, str(e)))
-            raise ManagerError("Communication with subscription manager failed: %s" % str(e))
+        except (BadStatusLine, socket.error, rhsm_connection.ConnectionException) as e:
+            self._connection_failed(e)
         if is_async is True:
             report.state = AbstractVirtReport.STATE_PROCESSING
             report.job_id = result['id']
@@ -226,18 +403,148 @@ class SubscriptionManager(Manager):
             report.state = AbstractVirtReport.STATE_FINISHED
         return result
 
+    @staticmethod
+    def _serialize_mapping(mapping, is_async):
+        if is_async:
+            # Transform the mapping into the async version
+            return {'hypervisors': [h.toDict() for h in mapping['hypervisors']]}
+        # Reformat the data from the mapping to make it fit with
+        # the old api.
+        serialized_mapping = {}
+        for hypervisor in mapping['hypervisors']:
+            guests = [g.toDict() for g in hypervisor.guestIds]
+            serialized_mapping[hypervisor.hypervisorId] = guests
+        return serialized_mapping
+
+    def _compressed_check_in(self, report, is_async, options):
+        """
+        Send the hosts to guests mapping with gzip compressed body, to the
+        same URL as python-rhsm would. The JSON is written straight from the
+        report to the compressor, only the compressed body is kept.
+
+        @return: tuple (sent, parsed response); not sent means the check-in
+        needs to be sent uncompressed (the server refused the compressed
+        body or the request can't be made in this environment)
+        """
+        config = report.config
+        if is_async:
+            params = {'env': config.env, 'cloaked': False}
+            reporter_id = getattr(options, 'reporter_id', None)
+            if reporter_id:
+                params['reporter_id'] = reporter_id
+            path = '/hypervisors/%s?%s' % (config.owner, urllib.urlencode(params))
+            content_type = 'text/plain'
+        else:
+            path = '/hypervisors?%s' % urllib.urlencode({'owner': config.owner, 'env': config.env})
+            content_type = 'application/json'
+        body = GzipBuffer()
+        serializer = ReportSerializer(body)
+        if is_async:
+            serializer.write_association(report)
+        else:
+            serializer.write_guest_mapping(report)
+        serializer.flush()
+        data = body.getvalue()
+        self.logger.debug("Check-in compressed from %d to %d bytes", body.size, len(data))
+        headers = {
+            'Content-Type': content_type,
+            'Content-Encoding': 'gzip',
+        }
+        response = self._post(path, data, headers)
+        if response is None:
+            self.compression_rejected = True
+            return False, None
+        status, response_headers, content = response
+        if status == 415:
+            self.logger.info("Server doesn't accept compressed check-in (code 415), "
+                             "sending check-ins uncompressed")
+            self.compression_rejected = True
+            return False, None
+        if status == 400:
+            # Either the compression or the report itself is wrong, the
+            # uncompressed check-in tells which one
+            self.logger.debug("Compressed check-in failed with code 400, "
+                              "sending it uncompressed")
+            return False, None
+        if status == 429:
+            retry_after = dict((name.lower(), value) for name, value
+                               in response_headers.iteritems()).get('retry-after', '60')
+            raise ManagerThrottleError(int(retry_after))
+        # Other errors are raised as python-rhsm would raise them
+        self.connection.conn.validateResponse({
+            'status': status,
+            'headers': response_headers,
+            'content': content,
+        }, 'POST', path)
+        try:
+            return True, (json.loads(content) if content else None)
+        except ValueError:
+            raise ManagerError("Communication with subscription manager failed: invalid response")
+
+    def _post(self, path, body, headers):
+        """
+        POST the body with the settings python-rhsm resolved for the
+        connection of this thread: server, certificates, proxy (unless
+        no_proxy says otherwise), authentication and timeout.
+
+        @return: tuple (status, dict of headers, content), or None when
+        python-rhsm or python is too old to make the request this way
+        """
+        restlib = getattr(self.connection, 'conn', None)
+        if not hasattr(ssl, 'SSLContext') or not all(
+                hasattr(restlib, attr) for attr in self.RESTLIB_ATTRIBUTES):
+            self.logger.info("Compressed check-in is not supported by this version "
+                             "of python or python-rhsm, sending check-ins uncompressed")
+            return None
+        try:
+            # The same TLS settings as python-rhsm uses
+            context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+            if restlib.insecure:
+                context.verify_mode = ssl.CERT_NONE
+            else:
+                context.verify_mode = ssl.CERT_REQUIRED
+                if restlib.ca_dir is not None:
+                    restlib._load_ca_certificates(context)
+            if restlib.cert_file and os.path.exists(restlib.cert_file):
+                context.load_cert_chain(restlib.cert_file, keyfile=restlib.key_file)
+        except (IOError, ssl.SSLError, rhsm_connection.ConnectionException) as e:
+            raise ManagerError("Unable to set up connection to subscription manager: %s" % str(e))
+        port = int(restlib.ssl_port)
+        if restlib.proxy_hostname and restlib.proxy_port:
+            connection = httplib.HTTPSConnection(restlib.proxy_hostname, int(restlib.proxy_port),
+                                                 context=context, timeout=restlib.timeout)
+            tunnel_headers = {'User-Agent': restlib.user_agent}
+            if restlib.proxy_user and restlib.proxy_password:
+                tunnel_headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(
+                    '%s:%s' % (restlib.proxy_user, restlib.proxy_password))
+            connection.set_tunnel(restlib.host, port, tunnel_headers)
+        else:
+            connection = httplib.HTTPSConnection(restlib.host, port, context=context,
+                                                 timeout=restlib.timeout)
+        # Authorization and the other headers python-rhsm sends
+        request_headers = dict(restlib.headers)
+        if restlib.user_agent:
+            request_headers['User-Agent'] = restlib.user_agent
+        request_headers.update(headers)
+        try:
+            connection.request('POST', restlib.apihandler + path, body, request_headers)
+            response = connection.getresponse()
+            return (response.status, dict(response.getheaders()),
+                    response.read().decode('utf-8'))
+        except (socket.error, httplib.HTTPException) as e:
+            raise ManagerError("Communication with subscription manager failed: %s" % str(e))
+        finally:
+            connection.close()
+
     def check_report_state(self, report):
         job_id = report.job_id
         self._connect(report.config)
         self.logger.debug('Checking status of job %s', job_id)
         try:
             result = self.connection.getJob(job_id)
-        except BadStatusLine:
-            raise ManagerError("Communication with subscription manager interrupted")
-        except rhsm_connection.ConnectionException as e:
-            if hasattr(e, 'code'):
-                raise ManagerError("Communication with subscription manager failed with code %d: %s" % (e.code, str(e)))
-            raise ManagerError("Communication with subscription manager failed: %s" % str(e))
+        except (BadStatusLine, socket.error, rhsm_connection.ConnectionException) as e:
+            self._connection_failed(e)
         state = STATE_MAPPING.get(result['state'], AbstractVirtReport.STATE_FAILED)
         report.state = state
         if state not in (AbstractVirtReport.STATE_FINISHED,
@@ -0,0 +1,122 @@
+"""
+Throttling of the calls to destination servers shared by all the
+destinations, part of virt-who
+
+Copyright (C) 2017 Red Hat, Inc.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+import time
+from threading import Lock
+
+
+class ThrottleRegistry(object):
+    """
+    Servers that asked virt-who to slow down (HTTP 429 with Retry-After),
+    shared by all destinations that send to the same server.
+
+    When the server is throttled, nobody calls it until the Retry-After
+    time passes. After that the waiting callers get one call each
+    `spacing` seconds (like a token bucket refilled at that rate), so
+    they don't all hit the server at the same moment again. The server is
+    forgotten once all the waiting callers are through.
+    """
+    def __init__(self, spacing=1.0):
+        """
+        @param spacing: Time between calls in seconds after the throttling
+        @type spacing: float
+        """
+        self.spacing = spacing
+        self._lock = Lock()
+        # server -> [time the server accepts calls again, next free slot]
+        self._servers = {}
+
+    def throttle(self, server, retry_after):
+        """
+        Remember that the server asked to wait `retry_after` seconds and
+        reserve the first call after that for the caller.
+
+        @return: Time in seconds the caller has to wait
+        """
+        retry_after = retry_after or 0
+        with self._lock:
+            now = time.time()
+            entry = self._servers.get(server)
+            if entry is None or entry[1] <= now:
+                entry = self._servers[server] = [now + retry_after, now + retry_after]
+                delay = retry_after
+            else:
+                entry[0] = max(entry[0], now + retry_after)
+                entry[1] = max(entry[0], entry[1])
+                delay = max(retry_after, entry[1] - now)
+            entry[1] += self.spacing
+            return delay
+
+    def reserve(self, server):
+        """
+        Reserve a call to the server.
+
+        @return: Time in seconds the caller has to wait before the call,
+        0 if the server is not throttled
+        """
+        with self._lock:
+            entry = self._servers.get(server)
+            if entry is None:
+                return 0
+            now = time.time()
+            if entry[1] <= now:
+                # Everybody waiting got through
+                del self._servers[server]
+                return 0
+            slot = max(now, entry[1])
+            entry[1] = slot + self.spacing
+            return slot - now
+
+    def remaining(self, server):
+        """
+        Return time in seconds until the server accepts calls again,
+        without reserving any call.
+        """
+        with self._lock:
+            entry = self._servers.get(server)
+            if entry is None:
+                return 0
+            return max(0, entry[0] - time.time())
+
+
+_registry = ThrottleRegistry()
+
+
+def throttle(server, retry_after):
+    """ `ThrottleRegistry.throttle` of the registry shared by the process,
+        None server is never throttled. """
+    if server is None:
+        return retry_after or 0
+    return _registry.throttle(server, retry_after)
+
+
+def reserve(server):
+    """ `ThrottleRegistry.reserve` of the registry shared by the process. """
+    if server is None:
+        return 0
+    return _registry.reserve(server)
+
+
+def remaining(server):
+    """ `ThrottleRegistry.remaining` of the registry shared by the process. """
+    if server is None:
+        return 0
+    return _registry.remaining(server)
@@ -0,0 +1,121 @@
+"""
+Scheduler running poll-style virt backends on a pool of threads,
+part of virt-who
+
+Copyright (C) 2017 Red Hat, Inc.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+import time
+import heapq
+import itertools
+from Queue import Queue
+from threading import Lock, Thread
+
+from virtwho.wakeup import WakeupEvent, wait_for
+
+
+class Scheduler(object):
+    """
+    Runs poll-style sources (see `Virt.schedulable`) on a fixed number of
+    worker threads instead of one thread per source.
+
+    The sources are not started as threads, one iteration of their loop
+    (`IntervalThread.run_scheduled`) is run by a worker each time the
+    source is due. The next run times are kept in a heap, a dispatcher
+    thread hands the due sources to the workers. Stopping a source (or
+    setting its terminate event) removes it from the schedule.
+    """
+    def __init__(self, logger, workers):
+        """
+        @param workers: Number of worker threads
+        @type workers: int
+        """
+        self.logger = logger
+        self.workers = workers
+        self._heap = []
+        self._lock = Lock()
+        self._counter = itertools.count()
+        self._changed = WakeupEvent()
+        self._terminated = WakeupEvent()
+        self._queue = Queue()
+        self._threads = []
+
+    def __len__(self):
+        with self._lock:
+            return len(self._heap)
+
+    def add(self, source, delay=0):
+        """
+        Schedule the source to run after `delay` seconds.
+
+        @param source: The source to run
+        @type source: virtwho.virt.Virt
+        """
+        with self._lock:
+            heapq.heappush(self._heap, (time.time() + delay, next(self._counter), source))
+        self._changed.set()
+
+    def start(self):
+        dispatcher = Thread(target=self._dispatch, name='virt-who-scheduler')
+        self._threads.append(dispatcher)
+        for i in range(self.workers):
+            self._threads.append(Thread(target=self._work, name='virt-who-worker-%d' % i))
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+        self.logger.debug("Scheduler started with %d worker threads", self.workers)
+
+    def stop(self):
+        """
+        Stop the scheduler and wait for the running sources to finish
+        their current iteration.
+        """
+        self._terminated.set()
+        for _ in range(self.workers):
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _dispatch(self):
+        while not self._terminated.is_set():
+            due = []
+            with self._lock:
+                now = time.time()
+                while self._heap and self._heap[0][0] <= now:
+                    due.append(heapq.heappop(self._heap)[2])
+                next_run = self._heap[0][0] if self._heap else None
+                self._changed.clear()
+            for source in due:
+                if not source.is_terminated():
+                    self._queue.put(source)
+            timeout = None if next_run is None else next_run - time.time()
+            wait_for(lambda: self._terminated.is_set() or self._changed.is_set(),
+                     [self._terminated, self._changed], timeout)
+
+    def _work(self):
+        while True:
+            source = self._queue.get()
+            if source is None:
+                return
+            try:
+                delay = source.run_scheduled()
+            except Exception:
+                self.logger.exception("Scheduled run of '%s' failed:", source.config.name)
+                delay = source.interval
+            if delay is not None and not self._terminated.is_set():
+                self.add(source, delay)
@@ -0,0 +1,156 @@
+"""
+Module for keeping state of virt-who between runs, part of virt-who
+
+Copyright (C) 2017 Red Hat, Inc.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import tempfile
+from threading import Lock
+
+from virtwho import DefaultStateFile
+from virtwho.virt import ReportHasher
+
+
+def destination_key(info, identity=None):
+    """
+    Return identifier of the destination that doesn't change between runs
+    of virt-who (unlike `hash(info)`). Passwords are not part of it.
+
+    @param info: Destination info
+    @type info: virtwho.config.Info
+
+    @param identity: Server and account the destination sends to, that
+    are not in the info (see `Manager.identity`)
+    """
+    options = sorted((key, value) for key, value in info
+                     if 'password' not in key and key != 'name')
+    data = [type(info).__name__, options]
+    if identity is not None:
+        data.append(identity)
+    return hashlib.sha256(json.dumps(data, default=str)).hexdigest()
+
+
+class SentState(object):
+    """
+    Hashes of the reports last successfully sent by each destination for
+    each source, stored in a JSON file, so the unchanged reports are not
+    sent again after restart or reload.
+
+    The file contains the format `version` and the `hash_mode` the hashes
+    were computed with; a file with different version or hash mode is
+    ignored. The file is written atomically (written to a temporary file
+    and renamed) once per `update`, destinations pass all the sources of
+    one check-in together.
+    """
+    VERSION = 1
+
+    def __init__(self, filename=DefaultStateFile, logger=None):
+        self.filename = filename
+        self.logger = logger or logging.getLogger('virtwho')
+        self._lock = Lock()
+        self._destinations = self._load()
+
+    def _load(self):
+        try:
+            with open(self.filename, 'r') as f:
+                data = json.load(f)
+        except IOError as e:
+            if os.path.exists(self.filename):
+                self.logger.warning("Unable to read state file %s: %s", self.filename, str(e))
+            return {}
+        except ValueError as e:
+            self.logger.warning("State file %s is corrupted, ignoring it: %s", self.filename, str(e))
+            return {}
+        if not isinstance(data, dict) or data.get('version') != self.VERSION:
+            self.logger.info("State file %s has unsupported version, ignoring it", self.filename)
+            return {}
+        if data.get('hash_mode') != ReportHasher.mode:
+            self.logger.info("State file %s was written with different hash mode, ignoring it",
+                             self.filename)
+            return {}
+        return data.get('destinations', {})
+
+    @staticmethod
+    def _encode(value):
+        # Partitions can be None, JSON keys must be strings
+        if isinstance(value, dict):
+            return {'partitions': [list(item) for item in sorted(value.items())]}
+        return value
+
+    @staticmethod
+    def _decode(value):
+        if isinstance(value, dict):
+            return dict((partition, partition_hash)
+                        for partition, partition_hash in value['partitions'])
+        return value
+
+    def get(self, destination):
+        """
+        Return dict of source key to the last sent hash (or dict of partition
+        to hash) for given destination.
+        """
+        with self._lock:
+            sources = self._destinations.get(destination, {})
+            return dict((source, self._decode(value))
+                        for source, value in sources.iteritems())
+
+    def update(self, destination, values):
+        """
+        Remember the hashes last sent by the destination and save the state
+        file if any of them changed.
+
+        @param values: dict of source key to the hash (or dict of partition
+        to hash)
+        """
+        with self._lock:
+            sources = self._destinations.setdefault(destination, {})
+            changed = False
+            for source, value in values.iteritems():
+                value = self._encode(value)
+                if sources.get(source) != value:
+                    sources[source] = value
+                    changed = True
+            if not changed:
+                return
+            data = json.dumps({
+                'version': self.VERSION,
+                'hash_mode': ReportHasher.mode,
+                'destinations': self._destinations,
+            }, sort_keys=True)
+            self._save(data)
+
+    def _save(self, data):
+        directory = os.path.dirname(self.filename) or '.'
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory, 0700)
+            fd, tmp_name = tempfile.mkstemp(prefix='.state', dir=directory)
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(tmp_name, self.filename)
+            except Exception:
+                os.unlink(tmp_name)
+                raise
+        except (IOError, OSError) as e:
+            self.logger.warning("Unable to write state file %s: %s", self.filename, str(e))
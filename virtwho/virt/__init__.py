@@ -1,10 +1,13 @@
+from virt import (Virt, VirtError, Guest, GuestCache, AbstractVirtReport,
+                  DomainListReport, HostGuestAssociationReport, SnapshotReport,
+                  ErrorReport, Hypervisor, HostFilter, ReportDiff,
+                  HypervisorDiff, ReportSerializer, ReportHasher, ChangeEvent,
+                  ChangeJournal, DestinationThread, IntervalThread,
+                  info_to_destination_class)
 
-
-from virt import (Virt, VirtError, Guest, AbstractVirtReport, DomainListReport,
-                  HostGuestAssociationReport, ErrorReport,
-                  Hypervisor, DestinationThread, IntervalThread, info_to_destination_class)
-
-__all__ = ['Virt', 'VirtError', 'Guest', 'AbstractVirtReport',
-           'DomainListReport', 'HostGuestAssociationReport',
-           'ErrorReport', 'Hypervisor', 'DestinationThread',
+__all__ = ['Virt', 'VirtError', 'Guest', 'GuestCache', 'AbstractVirtReport',
+           'DomainListReport', 'HostGuestAssociationReport', 'SnapshotReport',
+           'ErrorReport', 'Hypervisor', 'HostFilter', 'ReportDiff',
+           'HypervisorDiff', 'ReportSerializer', 'ReportHasher',
+           'ChangeEvent', 'ChangeJournal', 'DestinationThread',
            'IntervalThread', 'info_to_destination_class']
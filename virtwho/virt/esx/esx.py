@@ -217,7 +217,7 @@ class Esx(virt.Virt):
             if last_version != version or time() > next_update:
                 assoc = self.getHostGuestMapping()
                 self._send_data(virt.HostGuestAssociationReport(self.config, assoc))
-                next_update = time() + self.interval
+                next_update = time() + self.next_interval()
                 last_version = version
 
             if self._oneshot:
@@ -291,7 +291,7 @@ class Esx(virt.Virt):
                             state = virt.Guest.STATE_SHUTOFF
                     except KeyError:
                         self.logger.debug("Guest '%s' doesn't have 'runtime.powerState' property", vm_id.value)
-                    guests.append(virt.Guest(vm['config.uuid'], self, state))
+                    guests.append(self.sharedGuest(vm['config.uuid'], state))
             try:
                 name = host['config.network.dnsConfig.hostName']
                 domain_name = host['config.network.dnsConfig.domainName']
@@ -309,7 +309,8 @@ class Esx(virt.Virt):
             if version:
                 facts[virt.Hypervisor.HYPERVISOR_VERSION_FACT] = version
 
-            mapping['hypervisors'].append(virt.Hypervisor(hypervisorId=uuid, guestIds=guests, name=name, facts=facts))
+            mapping['hypervisors'].append(virt.Hypervisor(hypervisorId=uuid, guestIds=guests, name=name,
+                                                          facts=facts, partition=parent))
         return mapping
 
     def login(self):
@@ -558,7 +558,7 @@ class HyperV(virt.Virt):
                 self.logger.warning("Unknown state for guest %s", elementName)
                 state = virt.Guest.STATE_UNKNOWN
 
-            guests.append(virt.Guest(HyperV.decodeWinUUID(uuid), self, state))
+            guests.append(self.sharedGuest(HyperV.decodeWinUUID(uuid), state))
         # Get the hostname
         hostname = None
         socket_count = None
@@ -27,6 +27,7 @@ from xml.etree import ElementTree
 from virtwho.virt import (
     Hypervisor, Guest, VirtError, HostGuestAssociationReport,
     DomainListReport, Virt)
+from virtwho.wakeup import WakeupEvent, wait_for
 
 
 class LibvirtdGuest(Guest):
@@ -72,6 +73,8 @@ def libvirt_cred_request(credentials, config):
 class Libvirtd(Virt):
     """ Class for interacting with libvirt. """
     CONFIG_TYPE = "libvirt"
+    # How often to check the connection if libvirt can't tell us it closed
+    CONNECTION_CHECK_INTERVAL = 5
 
     def __init__(self, logger, config, dest, terminate_event=None,
                  interval=None, oneshot=False, registerEvents=True):
@@ -86,6 +89,8 @@ class Libvirtd(Virt):
         self._host_uuid = None
         self._host_name = None
         self.eventLoopThread = None
+        self._connection_closed = WakeupEvent()
+        self._close_callback_registered = False
         libvirt.registerErrorHandler(lambda ctx, error: None, None)
 
     def getVersion(self):
@@ -170,6 +175,13 @@ class Libvirtd(Virt):
             raise VirtError(str(e))
         v.domainEventRegister(self._callback, None)
         v.setKeepAlive(5, 3)
+        self._connection_closed.clear()
+        try:
+            v.registerCloseCallback(self._close_callback, None)
+            self._close_callback_registered = True
+        except (AttributeError, libvirt.libvirtError):
+            # Older libvirt, the connection is checked periodically
+            self._close_callback_registered = False
         return v
 
     def _disconnect(self):
@@ -177,6 +189,9 @@ class Libvirtd(Virt):
             return
         try:
             self.virt.domainEventDeregister(self._callback)
+            if self._close_callback_registered:
+                self.virt.unregisterCloseCallback()
+                self._close_callback_registered = False
             self.virt.close()
         except libvirt.libvirtError:
             pass
@@ -193,7 +208,7 @@ class Libvirtd(Virt):
             if self.virt is None:
                 self.virt = self._connect()
 
-            if self.virt.isAlive() != 1:
+            if self._connection_closed.is_set() or self.virt.isAlive() != 1:
                 self._disconnect()
                 self.virt = self._connect()
 
@@ -201,26 +216,41 @@ class Libvirtd(Virt):
                 report = self._get_report()
                 self._send_data(report)
                 initial = False
-                self.next_update = time.time() + self.interval
+                self.next_update = time.time() + self.next_interval()
 
             if self._oneshot:
                 break
 
-            time.sleep(1)
+            self._wait_for_update()
             if time.time() > self.next_update:
                 report = self._get_report()
                 self._send_data(report)
-                self.next_update = time.time() + self.interval
+                self.next_update = time.time() + self.next_interval()
 
         if self.eventLoopThread is not None and self.eventLoopThread.isAlive():
             self.eventLoopThread.terminate()
             self.eventLoopThread.join(1)
         self._disconnect()
 
+    def _wait_for_update(self):
+        """
+        Wait until it's time for the next report, the connection is closed
+        or the thread is terminated.
+        """
+        timeout = self.next_update - time.time()
+        if not self._close_callback_registered:
+            timeout = min(timeout, self.CONNECTION_CHECK_INTERVAL)
+        wait_for(lambda: self.is_terminated() or self._connection_closed.is_set(),
+                 self.wakeup_sources + [self._connection_closed], timeout)
+
+    def _close_callback(self, conn, reason, opaque):
+        self.logger.debug("Libvirt connection closed (reason %s)", reason)
+        self._connection_closed.set()
+
     def _callback(self, *args, **kwargs):
         report = self._get_report()
         self._send_data(report)
-        self.next_update = time.time() + self.interval
+        self.next_update = time.time() + self.next_interval()
 
     def _get_report(self):
         if self.isHypervisor():
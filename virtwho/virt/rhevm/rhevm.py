@@ -231,7 +231,8 @@ class RhevM(virt.Virt):
             except AttributeError:
                 pass
 
-            hosts[id] = virt.Hypervisor(hypervisorId=host_id, name=host.find('name').text, facts=facts)
+            hosts[id] = virt.Hypervisor(hypervisorId=host_id, name=host.find('name').text, facts=facts,
+                                        partition=host_cluster_id)
             mapping[id] = []
         for vm in vms_xml.findall('vm'):
             guest_id = vm.get('id')
@@ -261,7 +262,7 @@ class RhevM(virt.Virt):
                     guest_id)
                 state = virt.Guest.STATE_UNKNOWN
 
-            hosts[host_id].guestIds.append(virt.Guest(guest_id, self, state))
+            hosts[host_id].guestIds.append(self.sharedGuest(guest_id, state))
 
         return {'hypervisors': hosts.values()}
 
@@ -18,12 +18,16 @@ along with this program; if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """
 
+import os
 import sys
 import time
+import random
 import logging
-from operator import itemgetter
+from operator import itemgetter, attrgetter
 from datetime import datetime
-from threading import Thread, Event
+from threading import Thread, Lock
+from Queue import Queue, Empty
+from collections import deque
 import json
 import hashlib
 import re
@@ -31,6 +35,9 @@ import fnmatch
 from virtwho.config import NotSetSentinel, Satellite5DestinationInfo, \
     Satellite6DestinationInfo, DefaultDestinationInfo
 from virtwho.manager import ManagerError, ManagerThrottleError, ManagerFatalError
+from virtwho.datastore import Datastore
+from virtwho.wakeup import WakeupEvent, wait_for
+from virtwho import ratelimit
 
 try:
     from collections import OrderedDict
@@ -38,17 +45,33 @@ except ImportError:
     # Python 2.6 doesn't have OrderedDict, we need to have our own
     from virtwho.util import OrderedDict
 
-from virtwho import DefaultInterval
+from virtwho import DefaultInterval, MinimumSendInterval
 
 class VirtError(Exception):
     pass
 
 
+# Virt types are shared by every guest of a backend, keep only one copy
+# of each string around instead of one per guest.
+_virt_types = {}
+
+
+def _shared_virt_type(virtWhoType):
+    return _virt_types.setdefault(virtWhoType, virtWhoType)
+
+
 class Guest(object):
     """
     This class represents one virtualization guest running on some
     host/hypervisor.
+
+    Guests are immutable, so the same instance can be shared by successive
+    reports (see `GuestCache`). `toDict` builds a new dict on every call,
+    guests are kept for a long time and shouldn't carry a copy of it.
     """
+    # Reports can contain hundreds of thousands of guests, don't waste
+    # memory on a per-instance __dict__
+    __slots__ = ('uuid', 'virtWhoType', 'state')
 
     STATE_UNKNOWN = 0      # unknown state
     STATE_RUNNING = 1      # running
@@ -74,15 +97,29 @@ class Guest(object):
 
         `state` is a number that represents the state of the guest (stopped, running, ...)
         """
-        self.uuid = uuid
-        self.virtWhoType = virt.CONFIG_TYPE
-        self.state = state
+        self._set(uuid, _shared_virt_type(virt.CONFIG_TYPE), int(state))
+
+    def _set(self, uuid, virtWhoType, state):
+        set_attr = object.__setattr__
+        set_attr(self, 'uuid', uuid)
+        set_attr(self, 'virtWhoType', virtWhoType)
+        set_attr(self, 'state', state)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Guest is immutable, can't set '%s'" % name)
 
     def __repr__(self):
         return 'Guest({0.uuid!r}, {0.virtWhoType!r}, {0.state!r})'.format(self)
 
+    def __getstate__(self):
+        return (self.uuid, self.virtWhoType, self.state)
+
+    def __setstate__(self, state):
+        uuid, virtWhoType, guest_state = state
+        self._set(uuid, _shared_virt_type(virtWhoType), guest_state)
+
     def toDict(self):
-        d = OrderedDict((
+        return OrderedDict((
             ('guestId', self.uuid),
             ('state', self.state),
             ('attributes', {
@@ -90,19 +127,91 @@ class Guest(object):
                 'active': 1 if self.state in (self.STATE_RUNNING, self.STATE_PAUSED) else 0
             }),
         ))
-        return d
+
+    @classmethod
+    def fromDict(cls, d):
+        """
+        Create guest from its `toDict` representation.
+        """
+        guest = cls.__new__(cls)
+        guest._set(d['guestId'],
+                   _shared_virt_type(d['attributes']['virtWhoType']),
+                   int(d['state']))
+        return guest
+
+
+class GuestCache(object):
+    """
+    Cache of Guest instances, so that successive reports from one backend
+    share the guests that didn't change instead of allocating new ones.
+
+    Guests are looked up by (uuid, state, virtWhoType). The cache keeps two
+    generations: guests used since the last call of `rotate` and guests
+    used before that. Rotating drops the older generation, so a guest
+    that isn't part of two successive reports is evicted. The current
+    generation is also rotated when it reaches `size` guests.
+    """
+    DEFAULT_SIZE = 1000000
+
+    def __init__(self, size=DEFAULT_SIZE):
+        self.size = size
+        self._current = {}
+        self._previous = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, uuid, virt, state):
+        """
+        Return Guest with given properties, create it if it's not cached.
+        """
+        state = int(state)
+        key = (uuid, state, virt.CONFIG_TYPE)
+        guest = self._current.get(key)
+        if guest is None:
+            guest = self._previous.get(key)
+            if guest is None:
+                guest = Guest(uuid, virt, state)
+                self.misses += 1
+            else:
+                self.hits += 1
+            if len(self._current) >= self.size:
+                self.rotate()
+            self._current[key] = guest
+        else:
+            self.hits += 1
+        return guest
+
+    def rotate(self):
+        """
+        Start new generation, guests not used since the previous rotation
+        are dropped.
+        """
+        self._previous = self._current
+        self._current = {}
 
 
 class Hypervisor(object):
     """
     A model for information about a hypervisor
+
+    The digest returned by `getHash` is cached. Assigning any attribute
+    drops the cached digest, but changes made in place (for example
+    appending to `guestIds`) have to be done before the hash is first
+    computed. After `freeze` the hypervisor can't be changed at all.
+
+    `partition` is the cluster (or other parent) the hypervisor belongs
+    to. It's used only to split reports into partitions (see the
+    `partition_reports` option), it's neither sent nor hashed.
     """
+    __slots__ = ('hypervisorId', 'guestIds', 'name', 'facts', 'partition',
+                 '_hash', '_frozen')
 
     CPU_SOCKET_FACT = 'cpu.cpu_socket(s)'
     HYPERVISOR_TYPE_FACT = 'hypervisor.type'
     HYPERVISOR_VERSION_FACT = 'hypervisor.version'
 
-    def __init__(self, hypervisorId, guestIds=None, name=None, facts=None):
+    def __init__(self, hypervisorId, guestIds=None, name=None, facts=None,
+                 partition=None):
         """
         Create a new Hypervisor that will be sent to subscription manager
 
@@ -111,15 +220,51 @@ class Hypervisor(object):
         'guestIds': a list of Guests
 
         'name': the hostname, if available
+
+        'partition': the cluster or parent of the hypervisor, if available
         """
+        object.__setattr__(self, '_frozen', False)
         self.hypervisorId = hypervisorId
         self.guestIds = guestIds or []
         self.name = name
         self.facts = facts
+        self.partition = partition
 
     def __repr__(self):
         return 'Hypervisor({0.hypervisorId!r}, {0.guestIds!r}, {0.name!r}, {0.facts!r})'.format(self)
 
+    def __setattr__(self, name, value):
+        if self._frozen:
+            raise AttributeError("Hypervisor is frozen, can't set '%s'" % name)
+        object.__setattr__(self, name, value)
+        if name != '_hash':
+            object.__setattr__(self, '_hash', None)
+
+    def __getstate__(self):
+        return (self.hypervisorId, self.guestIds, self.name, self.facts,
+                self.partition, self._hash)
+
+    def __setstate__(self, state):
+        object.__setattr__(self, '_frozen', False)
+        (self.hypervisorId, self.guestIds, self.name, self.facts,
+         self.partition, _hash) = state
+        self._hash = _hash
+
+    def freeze(self):
+        """
+        Make the hypervisor immutable, its hash is computed beforehand.
+        Unpickled copies are not frozen.
+        """
+        if not self._frozen:
+            # Same guests, keep the hash if it's already computed
+            object.__setattr__(self, 'guestIds', tuple(self.guestIds))
+            self.getHash()
+            object.__setattr__(self, '_frozen', True)
+
+    @property
+    def frozen(self):
+        return self._frozen
+
     def toDict(self):
         d = OrderedDict((
             ('hypervisorId', {'hypervisorId': self.hypervisorId}),
@@ -132,17 +277,326 @@ class Hypervisor(object):
             d['facts'] = self.facts
         return d
 
+    @classmethod
+    def fromDict(cls, d, partition=None):
+        """
+        Create hypervisor from its `toDict` representation, the partition
+        is not part of it.
+        """
+        return cls(d['hypervisorId']['hypervisorId'],
+                   [Guest.fromDict(guest) for guest in d['guestIds']],
+                   name=d.get('name'),
+                   facts=d.get('facts'),
+                   partition=partition)
+
     def __str__(self):
         return str(self.toDict())
 
     def getHash(self):
-        sortedRepresentation = json.dumps(self.toDict(), sort_keys=True)
-        return hashlib.sha256(sortedRepresentation).hexdigest()
+        if self._hash is None:
+            self._hash = ReportHasher.hypervisor_digest(self)
+        return self._hash
+
+
+class ReportSerializer(object):
+    """
+    Streaming writer of canonical JSON for guests, hypervisors and reports.
+
+    The output is byte for byte the same as `json.dumps(..., sort_keys=True)`
+    of the `toDict()` (or `serializedAssociation`) representation, but it's
+    produced guest by guest and written out in chunks of roughly
+    `chunk_size` bytes, so the whole tree of dicts or the whole string is
+    never built.
+
+    `out` is either a file-like object (with `write` method) or a hash
+    object from hashlib (with `update` method).
+    """
+    def __init__(self, out, chunk_size=64 * 1024):
+        self._write = out.write if hasattr(out, 'write') else out.update
+        self.chunk_size = chunk_size
+        self._buffer = []
+        self._buffered = 0
+
+    def _emit(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self._write(''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+
+    def write_guest(self, guest):
+        active = 1 if guest.state in (Guest.STATE_RUNNING, Guest.STATE_PAUSED) else 0
+        self._emit('{"attributes": {"active": %d, "virtWhoType": %s}, '
+                   '"guestId": %s, "state": %s}' % (
+                       active, json.dumps(guest.virtWhoType),
+                       json.dumps(guest.uuid), json.dumps(guest.state)))
+
+    def write_guests(self, guests):
+        """
+        Write list of guests, sorted by their uuid.
+        """
+        self._emit('[')
+        for i, guest in enumerate(sorted(guests, key=attrgetter('uuid'))):
+            if i:
+                self._emit(', ')
+            self.write_guest(guest)
+        self._emit(']')
+
+    def write_hypervisor(self, hypervisor):
+        self._emit('{')
+        if hypervisor.facts is not None:
+            self._emit('"facts": %s, ' % json.dumps(hypervisor.facts, sort_keys=True))
+        self._emit('"guestIds": ')
+        self.write_guests(hypervisor.guestIds)
+        self._emit(', "hypervisorId": {"hypervisorId": %s}' % json.dumps(hypervisor.hypervisorId))
+        if hypervisor.name is not None:
+            self._emit(', "name": %s' % json.dumps(hypervisor.name))
+        self._emit('}')
+
+    def write_association(self, report):
+        """
+        Write the filtered association of the HostGuestAssociationReport,
+        same as its `serializedAssociation`.
+        """
+        self._emit('{"hypervisors": [')
+        hypervisors = sorted(report.association['hypervisors'],
+                             key=attrgetter('hypervisorId'))
+        for i, hypervisor in enumerate(hypervisors):
+            if i:
+                self._emit(', ')
+            self.write_hypervisor(hypervisor)
+        self._emit(']}')
+
+    def write_guest_mapping(self, report):
+        """
+        Write the filtered association of the HostGuestAssociationReport in
+        the format of the synchronous hypervisor check-in: object mapping
+        hypervisorId to the list of its guests.
+        """
+        self._emit('{')
+        hypervisors = sorted(report.association['hypervisors'],
+                             key=attrgetter('hypervisorId'))
+        for i, hypervisor in enumerate(hypervisors):
+            if i:
+                self._emit(', ')
+            self._emit('%s: ' % json.dumps(hypervisor.hypervisorId))
+            self.write_guests(hypervisor.guestIds)
+        self._emit('}')
+
+
+class ReportHasher(object):
+    """
+    Computes the digests used to detect changes in reports.
+
+    In the default `binary` mode the fields are fed to SHA-256 directly as
+    netstrings (length prefixed), in fixed order: hypervisorId, name,
+    facts sorted by name and guests sorted by uuid as (uuid, state,
+    virtWhoType). None is encoded as '-'. No JSON is involved.
+
+    The `json` mode hashes the canonical JSON representation, which is
+    what older versions of virt-who did. Use it (VIRTWHO_HASH_MODE=json)
+    when hashes have to be compared with ones computed that way.
+    """
+    BINARY = 'binary'
+    JSON = 'json'
+    MODES = (BINARY, JSON)
+
+    mode = os.environ.get('VIRTWHO_HASH_MODE', BINARY).strip().lower()
+    if mode not in MODES:
+        mode = BINARY
+
+    @staticmethod
+    def _netstring(value):
+        if value is None:
+            return '-'
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        elif not isinstance(value, str):
+            value = str(value)
+        return '%d:%s,' % (len(value), value)
+
+    @classmethod
+    def _guests(cls, guests):
+        netstring = cls._netstring
+        parts = ['%d:' % len(guests)]
+        append = parts.append
+        for guest in sorted(guests, key=attrgetter('uuid')):
+            uuid = guest.uuid
+            if uuid.__class__ is str:
+                # Fast path for the most common case
+                state = str(guest.state)
+                append('%d:%s,%d:%s,' % (len(uuid), uuid, len(state), state))
+            else:
+                append(netstring(uuid))
+                append(netstring(guest.state))
+            append(netstring(guest.virtWhoType))
+        return parts
+
+    @classmethod
+    def hypervisor_digest(cls, hypervisor):
+        digest = hashlib.sha256()
+        if cls.mode == cls.JSON:
+            serializer = ReportSerializer(digest)
+            serializer.write_hypervisor(hypervisor)
+            serializer.flush()
+            return digest.hexdigest()
+
+        netstring = cls._netstring
+        parts = [netstring(hypervisor.hypervisorId), netstring(hypervisor.name)]
+        if hypervisor.facts is None:
+            parts.append('-')
+        else:
+            parts.append('%d:' % len(hypervisor.facts))
+            for name in sorted(hypervisor.facts):
+                parts.append(netstring(name))
+                parts.append(netstring(hypervisor.facts[name]))
+        parts.extend(cls._guests(hypervisor.guestIds))
+        digest.update(''.join(parts))
+        return digest.hexdigest()
+
+    @classmethod
+    def guests_digest(cls, guests, hypervisor_id=None):
+        digest = hashlib.sha256()
+        if cls.mode == cls.JSON:
+            serializer = ReportSerializer(digest)
+            serializer.write_guests(guests)
+            serializer.flush()
+            digest.update(str(hypervisor_id))
+            return digest.hexdigest()
+
+        digest.update(''.join(cls._guests(guests)))
+        digest.update(cls._netstring(hypervisor_id))
+        return digest.hexdigest()
+
+
+class HostFilter(object):
+    """
+    Matcher for the `exclude_hosts` and `filter_hosts` options.
+
+    A host matches when it matches any of the patterns either as a shell
+    style wildcard or as a regular expression (both case insensitive).
+    The patterns are compiled only once: plain names (like UUIDs) go to
+    a set, wildcards and regular expressions are each combined into one
+    compiled expression. Regular expressions with groups are compiled on
+    their own, joining them would renumber the groups (breaking the
+    backreferences) or duplicate the group names. Invalid regular
+    expressions are ignored.
+
+    Use `HostFilter.get` to obtain an instance, it reuses already built
+    filters for the same list of patterns.
+    """
+    GLOB_CHARS = frozenset('*?[')
+    REGEX_CHARS = frozenset('.^$*+?{}[]\\|()')
+
+    _cache = {}
+    _cache_size = 64
+
+    def __init__(self, patterns):
+        self.patterns = tuple(patterns)
+        logger = logging.getLogger("virtwho")
+        exact = set()
+        globs = []
+        regexes = []
+        grouped = []
+        for pattern in self.patterns:
+            if self.GLOB_CHARS.isdisjoint(pattern):
+                exact.add(pattern.lower())
+            else:
+                globs.append(self._translate_glob(pattern.lower()))
+            if not self.REGEX_CHARS.isdisjoint(pattern):
+                try:
+                    regex = re.compile('^%s$' % pattern, re.IGNORECASE)
+                except (re.error, OverflowError, AssertionError):
+                    logger.debug("Host filter '%s' is not a valid regular expression", pattern)
+                    continue
+                if regex.groups:
+                    grouped.append(regex)
+                else:
+                    regexes.append(pattern)
+
+        self._exact = frozenset(exact)
+        self._globs = self._compile(['(?:%s)' % glob for glob in globs],
+                                    re.DOTALL)
+        self._regexes = self._compile(['(?:^%s$)' % regex for regex in regexes],
+                                      re.IGNORECASE) + grouped
+
+    @classmethod
+    def get(cls, patterns):
+        """
+        Return the filter for given list of patterns, build it if necessary.
+        """
+        key = tuple(patterns)
+        host_filter = cls._cache.get(key)
+        if host_filter is None:
+            host_filter = cls(key)
+            if len(cls._cache) >= cls._cache_size:
+                cls._cache.clear()
+            cls._cache[key] = host_filter
+        return host_filter
+
+    @staticmethod
+    def _translate_glob(pattern):
+        regex = fnmatch.translate(pattern)
+        # Python 2 appends the flags to the end of the expression,
+        # they can't be in the middle of the combined one
+        if regex.endswith('(?ms)'):
+            regex = regex[:-len('(?ms)')]
+        return regex
+
+    @staticmethod
+    def _compile(alternatives, flags):
+        """
+        Compile the alternatives into as few regular expressions as
+        possible. Joining them might fail (e.g. too many groups), compile
+        them one by one in that case.
+        """
+        if not alternatives:
+            return []
+        try:
+            return [re.compile('|'.join(alternatives), flags)]
+        except (re.error, OverflowError, AssertionError):
+            return [re.compile(alternative, flags)
+                    for alternative in alternatives]
+
+    def match(self, host):
+        if host is None:
+            return False
+        lower = host.lower()
+        if lower in self._exact:
+            return True
+        for regex in self._globs:
+            if regex.match(lower):
+                return True
+        for regex in self._regexes:
+            if regex.match(host):
+                return True
+        return False
+
+    def __repr__(self):
+        return 'HostFilter({0.patterns!r})'.format(self)
+
+    def __reduce__(self):
+        return (_get_host_filter, (self.patterns,))
+
+
+def _get_host_filter(patterns):
+    # Unpickling helper, bound class methods can't be pickled
+    return HostFilter.get(patterns)
 
 
 class AbstractVirtReport(object):
     '''
     An abstract report from virt backend.
+
+    A report can be frozen, after that its content can't be changed and
+    it can be shared by several threads without copying. Only the `state`
+    can still be set, use a (shallow) copy of the report to have a state
+    of its own.
     '''
     # The report was just collected, but is not yet being reported
     STATE_CREATED = 1
@@ -158,6 +612,7 @@ class AbstractVirtReport(object):
     def __init__(self, config, state=STATE_CREATED):
         self._config = config
         self._state = state
+        self._frozen = False
 
     def __repr__(self):
         return '{1}({0.config!r}, {0.state!r})'.format(self, self.__class__.__name__)
@@ -178,6 +633,29 @@ class AbstractVirtReport(object):
     def hash(self):
         return hash(self)
 
+    def __getstate__(self):
+        # Unpickled copies are not frozen
+        state = self.__dict__.copy()
+        state['_frozen'] = False
+        return state
+
+    def __copy__(self):
+        # Shallow copy shares the (frozen) content, but not the state
+        report = self.__class__.__new__(self.__class__)
+        report.__dict__.update(self.__dict__)
+        return report
+
+    @property
+    def frozen(self):
+        return self._frozen
+
+    def freeze(self):
+        """
+        Make the content of the report immutable. The cached values (like
+        the hash) are computed beforehand.
+        """
+        self._frozen = True
+
 
 class ErrorReport(AbstractVirtReport):
     '''
@@ -194,6 +672,7 @@ class DomainListReport(AbstractVirtReport):
         super(DomainListReport, self).__init__(config, state)
         self._guests = guests
         self._hypervisor_id = hypervisor_id
+        self._hash = None
 
     def __repr__(self):
         return 'DomainListReport({0.config!r}, {0.guests!r}, {0.hypervisor_id!r}, {0.state!r})'.format(self)
@@ -208,22 +687,37 @@ class DomainListReport(AbstractVirtReport):
 
     @property
     def hash(self):
-        return hashlib.sha256(
-            json.dumps(
-                sorted([g.toDict() for g in self.guests], key=itemgetter('guestId')),
-                sort_keys=True) +
-            str(self.hypervisor_id)
-        ).hexdigest()
+        if self._hash is None:
+            self._hash = ReportHasher.guests_digest(self.guests, self.hypervisor_id)
+        return self._hash
+
+    def freeze(self):
+        if not self._frozen:
+            self._guests = tuple(self._guests)
+            self.hash
+        super(DomainListReport, self).freeze()
 
 
 class HostGuestAssociationReport(AbstractVirtReport):
     '''
     Report from virt backend about host/guest association on given hypervisor.
+
+    The filtered association is computed on first access and cached (as
+    is the hash), changing `exclude_hosts` or `filter_hosts` drops the
+    cached values. Call `invalidate` after modifying the hypervisors in
+    place. `association_computations` counts how many times the filtered
+    view was built for this report.
+
+    When the `partition_reports` option is enabled, the filtered
+    hypervisors are also split by their `partition` (cluster or parent)
+    and each partition has its own hash, see `partitions` and
+    `partition_hashes`.
     '''
     def __init__(self, config, assoc, state=AbstractVirtReport.STATE_CREATED,
                  exclude_hosts=None, filter_hosts=None):
         super(HostGuestAssociationReport, self).__init__(config, state)
         self._assoc = assoc
+        self.association_computations = 0
         if exclude_hosts is None:
             try:
                 exclude_hosts = self._config.exclude_hosts
@@ -242,33 +736,73 @@ class HostGuestAssociationReport(AbstractVirtReport):
     def __repr__(self):
         return 'HostGuestAssociationReport({0.config!r}, {0._assoc!r}, {0.state!r})'.format(self)
 
-    def _filter(self, host, filterlist):
-        for i in filterlist:
-            if fnmatch.fnmatch(host.lower(), i.lower()):
-                # match is found
-                return True
-            try:
-                if re.match("^" + i + "$", host, re.IGNORECASE):
-                    # match is found
-                    return True
-            except:
-                pass
-        # no match
-        return False
+    @property
+    def exclude_hosts(self):
+        return self._exclude_hosts
+
+    @exclude_hosts.setter
+    def exclude_hosts(self, value):
+        self._check_not_frozen()
+        self._exclude_hosts = value
+        self._filters = None
+        self.invalidate()
+
+    @property
+    def filter_hosts(self):
+        return self._filter_hosts
+
+    @filter_hosts.setter
+    def filter_hosts(self, value):
+        self._check_not_frozen()
+        self._filter_hosts = value
+        self._filters = None
+        self.invalidate()
+
+    def _check_not_frozen(self):
+        if self._frozen:
+            raise AttributeError("Report is frozen, it can't be changed")
+
+    def invalidate(self):
+        """
+        Drop the cached association and hash, they will be computed again
+        on next access.
+        """
+        self._check_not_frozen()
+        self._association = None
+        self._hash = None
+        self._partitions = None
+        self._partition_hashes = None
+
+    def _get_filters(self):
+        """
+        Return (exclude, include) HostFilter pair, None means no filtering.
+        """
+        if self._filters is None:
+            self._filters = tuple(
+                HostFilter.get(patterns) if patterns is not None else None
+                for patterns in (self._exclude_hosts, self._filter_hosts))
+        return self._filters
 
     @property
     def association(self):
+        if self._association is None:
+            self._association = self._filter_association()
+            self.association_computations += 1
+        return self._association
+
+    def _filter_association(self):
         # Apply filter
         logger = logging.getLogger("virtwho")
         assoc = []
+        exclude_filter, include_filter = self._get_filters()
         for host in self._assoc['hypervisors']:
-            if self.exclude_hosts is not None and self._filter(
-                    host.hypervisorId, self.exclude_hosts):
+            if exclude_filter is not None and \
+                    exclude_filter.match(host.hypervisorId):
                 logger.debug("Skipping host '%s' because its uuid is excluded", host.hypervisorId)
                 continue
 
-            if self.filter_hosts is not None and not self._filter(
-                    host.hypervisorId,self.filter_hosts):
+            if include_filter is not None and \
+                    not include_filter.match(host.hypervisorId):
                 logger.debug("Skipping host '%s' because its uuid is not included", host.hypervisorId)
                 continue
 
@@ -283,7 +817,429 @@ class HostGuestAssociationReport(AbstractVirtReport):
 
     @property
     def hash(self):
-        return hashlib.sha256(json.dumps(self.serializedAssociation, sort_keys=True)).hexdigest()
+        """
+        Hash of the filtered association.
+
+        It's computed from the (cached) digests of the hypervisors, so
+        hashing a report whose hypervisors were already hashed doesn't
+        serialize the guests again. The result is cached as well and is
+        pickled together with the report.
+        """
+        if self._hash is None:
+            self._hash = self._combine_hashes(self.association['hypervisors'])
+        return self._hash
+
+    @staticmethod
+    def _combine_hashes(hypervisors):
+        digest = hashlib.sha256()
+        for hypervisor in sorted(hypervisors, key=attrgetter('hypervisorId')):
+            digest.update(hypervisor.getHash())
+        return digest.hexdigest()
+
+    @property
+    def partitioned(self):
+        """
+        True if the report should be handled partition by partition.
+        """
+        try:
+            # Only a real boolean option counts, not a truthy placeholder
+            return self._config.partition_reports is True
+        except AttributeError:
+            # We do not have a config with this attribute
+            return False
+
+    @property
+    def partitions(self):
+        """
+        Dict of partition (cluster or parent) to list of filtered hypervisors
+        in that partition. Hypervisors without partition are under None.
+        """
+        if self._partitions is None:
+            partitions = {}
+            for hypervisor in self.association['hypervisors']:
+                partitions.setdefault(hypervisor.partition, []).append(hypervisor)
+            self._partitions = partitions
+        return self._partitions
+
+    @property
+    def partition_hashes(self):
+        """
+        Dict of partition to hash of hypervisors in that partition.
+        """
+        if self._partition_hashes is None:
+            self._partition_hashes = dict(
+                (partition, self._combine_hashes(hypervisors))
+                for partition, hypervisors in self.partitions.iteritems())
+        return self._partition_hashes
+
+    def freeze(self):
+        """
+        Freeze the report and all its hypervisors. The filtered association,
+        hash and partition hashes are computed beforehand, hypervisor lists
+        become tuples.
+        """
+        if not self._frozen:
+            hypervisors = tuple(self._assoc['hypervisors'])
+            for hypervisor in hypervisors:
+                hypervisor.freeze()
+            self._assoc = dict(self._assoc, hypervisors=hypervisors)
+            self._association = {
+                'hypervisors': tuple(self.association['hypervisors'])}
+            self.hash
+            if self.partitioned:
+                self._partitions = dict(
+                    (partition, tuple(partition_hypervisors))
+                    for partition, partition_hypervisors
+                    in self.partitions.iteritems())
+                self.partition_hashes
+        super(HostGuestAssociationReport, self).freeze()
+
+
+class SnapshotReport(HostGuestAssociationReport):
+    '''
+    HostGuestAssociationReport whose filtered association is kept only as
+    canonical JSON (as written by `ReportSerializer`) in a memory-mapped
+    snapshot, see the `mmap` mode of `Datastore`.
+
+    The hash (and the partition hashes) are known upfront, so checking
+    whether the report changed doesn't touch the snapshot at all. The
+    hypervisors are decoded on first access of `association`.
+    '''
+    def __init__(self, config, snapshot, hash, partition_of=None,
+                 partition_hashes=None, state=AbstractVirtReport.STATE_CREATED):
+        """
+        @param snapshot: Buffer with the serialized association
+        @type snapshot: mmap.mmap
+
+        @param hash: Hash of the association
+        @type hash: str
+
+        @param partition_of: Dict of hypervisorId to its partition, for
+        partitioned reports
+        @type partition_of: dict
+
+        @param partition_hashes: Dict of partition to its hash, for
+        partitioned reports
+        @type partition_hashes: dict
+        """
+        # The snapshot is already filtered
+        super(SnapshotReport, self).__init__(config, None, state,
+                                             exclude_hosts=[], filter_hosts=[])
+        self._snapshot = snapshot
+        self._partition_of = partition_of or {}
+        self._hash = hash
+        self._partition_hashes = partition_hashes
+
+    def __repr__(self):
+        return 'SnapshotReport({0.config!r}, {0.hash!r}, {0.state!r})'.format(self)
+
+    def __getstate__(self):
+        # The mmap can't be pickled, pickle the decoded hypervisors instead
+        self.association
+        state = super(SnapshotReport, self).__getstate__()
+        state['_snapshot'] = None
+        return state
+
+    def _filter_association(self):
+        if self._snapshot is None:
+            return {'hypervisors': list(self._assoc['hypervisors'])}
+        data = json.loads(self._snapshot[:])
+        hypervisors = [
+            Hypervisor.fromDict(hypervisor, self._partition_of.get(
+                hypervisor['hypervisorId']['hypervisorId']))
+            for hypervisor in data['hypervisors']]
+        self._assoc = {'hypervisors': hypervisors}
+        return {'hypervisors': hypervisors}
+
+    def freeze(self):
+        if not self._frozen:
+            self.association
+        super(SnapshotReport, self).freeze()
+
+
+class HypervisorDiff(object):
+    """
+    Changes of one hypervisor between two reports.
+
+    `added_guests` and `removed_guests` are lists of `Guest` instances,
+    `changed_guests` is a list of (previous, current) `Guest` pairs for
+    guests which changed their state. All lists are sorted by guest uuid.
+    """
+    def __init__(self, previous, current):
+        self.previous = previous
+        self.current = current
+        previous_guests = dict((guest.uuid, guest) for guest in previous.guestIds)
+        current_guests = dict((guest.uuid, guest) for guest in current.guestIds)
+        self.added_guests = [current_guests[uuid] for uuid in sorted(current_guests)
+                             if uuid not in previous_guests]
+        self.removed_guests = [previous_guests[uuid] for uuid in sorted(previous_guests)
+                               if uuid not in current_guests]
+        self.changed_guests = [
+            (previous_guests[uuid], current_guests[uuid])
+            for uuid in sorted(current_guests)
+            if uuid in previous_guests and
+            previous_guests[uuid].state != current_guests[uuid].state]
+
+    @property
+    def hypervisorId(self):
+        return self.current.hypervisorId
+
+    def __repr__(self):
+        return 'HypervisorDiff({0.hypervisorId!r}, added={0.added_guests!r}, ' \
+            'removed={0.removed_guests!r}, changed={0.changed_guests!r})'.format(self)
+
+
+class ReportDiff(object):
+    """
+    Structural difference between two consecutive HostGuestAssociationReports
+    from the same source.
+
+    `added_hypervisors` and `removed_hypervisors` are lists of `Hypervisor`
+    instances, `changed_hypervisors` is a list of `HypervisorDiff`. Only the
+    filtered associations are compared. Hypervisors are matched by their
+    hypervisorId; those with the same hash are skipped without looking at
+    their guests.
+
+    `moved_guests` is a list of (guest uuid, previous hypervisorId, current
+    hypervisorId) tuples for guests that changed the hypervisor they run on.
+    Moved guests are also listed as removed and added in the hypervisor
+    changes.
+
+    Either of the reports can be None, meaning no report.
+    """
+    def __init__(self, previous, current):
+        previous_hypervisors = self._hypervisors(previous)
+        current_hypervisors = self._hypervisors(current)
+
+        self.added_hypervisors = []
+        self.removed_hypervisors = []
+        self.changed_hypervisors = []
+        for hypervisorId in sorted(current_hypervisors):
+            hypervisor = current_hypervisors[hypervisorId]
+            previous_hypervisor = previous_hypervisors.get(hypervisorId)
+            if previous_hypervisor is None:
+                self.added_hypervisors.append(hypervisor)
+            elif previous_hypervisor.getHash() != hypervisor.getHash():
+                self.changed_hypervisors.append(
+                    HypervisorDiff(previous_hypervisor, hypervisor))
+        for hypervisorId in sorted(previous_hypervisors):
+            if hypervisorId not in current_hypervisors:
+                self.removed_hypervisors.append(previous_hypervisors[hypervisorId])
+
+        self.moved_guests = self._moved_guests()
+
+    @staticmethod
+    def _hypervisors(report):
+        if report is None:
+            return {}
+        return dict((hypervisor.hypervisorId, hypervisor)
+                    for hypervisor in report.association['hypervisors'])
+
+    def _moved_guests(self):
+        removed = {}
+        for hypervisor in self.removed_hypervisors:
+            for guest in hypervisor.guestIds:
+                removed[guest.uuid] = hypervisor.hypervisorId
+        for change in self.changed_hypervisors:
+            for guest in change.removed_guests:
+                removed[guest.uuid] = change.hypervisorId
+        if not removed:
+            return []
+
+        moved = []
+        for hypervisor in self.added_hypervisors:
+            for guest in hypervisor.guestIds:
+                if guest.uuid in removed:
+                    moved.append((guest.uuid, removed[guest.uuid], hypervisor.hypervisorId))
+        for change in self.changed_hypervisors:
+            for guest in change.added_guests:
+                if guest.uuid in removed:
+                    moved.append((guest.uuid, removed[guest.uuid], change.hypervisorId))
+        return sorted(moved)
+
+    def __nonzero__(self):
+        return bool(self.added_hypervisors or self.removed_hypervisors or
+                    self.changed_hypervisors)
+
+    def summary(self):
+        """
+        Return one line description of the changes, suitable for logging.
+        """
+        if not self:
+            return 'no changes'
+        return ('hypervisors: {0} added, {1} removed, {2} changed; '
+                'guests: {3} added, {4} removed, {5} moved, {6} changed state').format(
+            len(self.added_hypervisors),
+            len(self.removed_hypervisors),
+            len(self.changed_hypervisors),
+            sum(len(h.guestIds) for h in self.added_hypervisors) +
+            sum(len(c.added_guests) for c in self.changed_hypervisors),
+            sum(len(h.guestIds) for h in self.removed_hypervisors) +
+            sum(len(c.removed_guests) for c in self.changed_hypervisors),
+            len(self.moved_guests),
+            sum(len(c.changed_guests) for c in self.changed_hypervisors))
+
+    def __repr__(self):
+        return 'ReportDiff(added={0.added_hypervisors!r}, removed={0.removed_hypervisors!r}, ' \
+            'changed={0.changed_hypervisors!r})'.format(self)
+
+
+class ChangeEvent(object):
+    """
+    One change recorded in the ChangeJournal.
+
+    `previous` and `current` depend on the kind of the event: hypervisorIds
+    for moved guests, states for guests that changed state, number of
+    guests for added or removed hypervisors.
+    """
+    __slots__ = ('timestamp', 'kind', 'hypervisorId', 'guestId',
+                 'previous', 'current')
+
+    def __init__(self, timestamp, kind, hypervisorId, guestId=None,
+                 previous=None, current=None):
+        self.timestamp = timestamp
+        self.kind = kind
+        self.hypervisorId = hypervisorId
+        self.guestId = guestId
+        self.previous = previous
+        self.current = current
+
+    def __repr__(self):
+        return 'ChangeEvent({0.timestamp!r}, {0.kind!r}, {0.hypervisorId!r}, ' \
+            '{0.guestId!r}, {0.previous!r}, {0.current!r})'.format(self)
+
+    def toDict(self):
+        d = OrderedDict((
+            ('timestamp', self.timestamp),
+            ('type', self.kind),
+            ('hypervisorId', self.hypervisorId),
+        ))
+        if self.guestId is not None:
+            d['guestId'] = self.guestId
+        if self.previous is not None:
+            d['previous'] = self.previous
+        if self.current is not None:
+            d['current'] = self.current
+        return d
+
+
+class ChangeJournal(object):
+    """
+    Bounded in-memory log of recent changes reported by one source (config).
+
+    Events are derived from the ReportDiff of consecutive reports, only the
+    identifiers of what changed are kept (not the hypervisors or guests),
+    and only the last `size` events are remembered, so memory grows with
+    the number of changes, not with the size of the inventory.
+
+    Use `ChangeJournal.get(source)` to obtain the journal of a source and
+    `ChangeJournal.dump()` for JSON representation of all of them.
+    """
+    HYPERVISOR_ADDED = 'hypervisor_added'
+    HYPERVISOR_REMOVED = 'hypervisor_removed'
+    GUEST_ADDED = 'guest_added'
+    GUEST_REMOVED = 'guest_removed'
+    GUEST_MOVED = 'guest_moved'
+    GUEST_STATE_CHANGED = 'guest_state_changed'
+
+    DEFAULT_SIZE = 1000
+
+    _journals = {}
+    _lock = Lock()
+
+    def __init__(self, source, size=DEFAULT_SIZE):
+        self.source = source
+        self._events = deque(maxlen=size)
+
+    @classmethod
+    def get(cls, source, size=DEFAULT_SIZE):
+        """
+        Return the journal for given source, create it if necessary.
+        Changing the `size` of existing journal keeps the newest events.
+        """
+        with cls._lock:
+            journal = cls._journals.get(source)
+            if journal is None:
+                journal = cls._journals[source] = cls(source, size)
+            elif journal.size != size:
+                journal._events = deque(journal._events, maxlen=size)
+            return journal
+
+    @classmethod
+    def sources(cls):
+        with cls._lock:
+            return sorted(cls._journals)
+
+    @classmethod
+    def dump(cls, sources=None):
+        """
+        Return JSON with the events of given sources (all by default).
+        """
+        with cls._lock:
+            journals = dict(cls._journals)
+        if sources is None:
+            sources = sorted(journals)
+        return json.dumps({
+            'sources': OrderedDict(
+                (source, [event.toDict() for event in journals[source].events()])
+                for source in sources if source in journals)
+        })
+
+    @property
+    def size(self):
+        return self._events.maxlen
+
+    def __len__(self):
+        return len(self._events)
+
+    def events(self, since=None):
+        """
+        Return list of events, oldest first. If `since` is given, only the
+        events with timestamp greater than `since` are returned.
+        """
+        events = list(self._events)
+        if since is not None:
+            events = [event for event in events if event.timestamp > since]
+        return events
+
+    def clear(self):
+        self._events.clear()
+
+    def record(self, diff, timestamp=None):
+        """
+        Add events for the changes in given ReportDiff.
+        @return: number of recorded events
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        moved = set(uuid for uuid, _, _ in diff.moved_guests)
+        events = []
+        for hypervisor in diff.added_hypervisors:
+            events.append(ChangeEvent(timestamp, self.HYPERVISOR_ADDED,
+                                      hypervisor.hypervisorId,
+                                      current=len(hypervisor.guestIds)))
+        for hypervisor in diff.removed_hypervisors:
+            events.append(ChangeEvent(timestamp, self.HYPERVISOR_REMOVED,
+                                      hypervisor.hypervisorId,
+                                      previous=len(hypervisor.guestIds)))
+        for uuid, previous_id, current_id in diff.moved_guests:
+            events.append(ChangeEvent(timestamp, self.GUEST_MOVED, current_id,
+                                      uuid, previous_id, current_id))
+        for change in diff.changed_hypervisors:
+            for guest in change.added_guests:
+                if guest.uuid not in moved:
+                    events.append(ChangeEvent(timestamp, self.GUEST_ADDED,
+                                              change.hypervisorId, guest.uuid))
+            for guest in change.removed_guests:
+                if guest.uuid not in moved:
+                    events.append(ChangeEvent(timestamp, self.GUEST_REMOVED,
+                                              change.hypervisorId, guest.uuid))
+            for previous, current in change.changed_guests:
+                events.append(ChangeEvent(timestamp, self.GUEST_STATE_CHANGED,
+                                          change.hypervisorId, current.uuid,
+                                          previous.state, current.state))
+        self._events.extend(events)
+        return len(events)
 
 
 class IntervalThread(Thread):
@@ -293,20 +1249,74 @@ class IntervalThread(Thread):
         self.config = config
         self.source = source
         self.dest = dest
-        self._internal_terminate_event = Event()
+        self._internal_terminate_event = WakeupEvent()
         self.terminate_event = terminate_event or self._internal_terminate_event
         self.interval = interval or config.interval or DefaultInterval
         self._oneshot = oneshot
+        # Used by run_scheduled, prepare is called again after an error
+        self._prepared = False
+        # Maximal random change of each interval in seconds
+        self.interval_jitter = 0
+        # The first run is delayed by a part of this (see `start_delay`)
+        self.start_stagger = 0
         super(IntervalThread, self).__init__()
 
     def wait(self, wait_time):
         '''
         Wait `wait_time` seconds, could be interrupted by setting _terminate_event or _internal_terminate_event.
         '''
-        for i in range(wait_time):
-            if self.is_terminated():
-                break
-            time.sleep(1)
+        wait_for(self.is_terminated, self.wakeup_sources, wait_time)
+
+    def next_interval(self):
+        """
+        Return the time until the next run: the interval changed by random
+        jitter of at most `interval_jitter` seconds (and at most half of
+        the interval), so the threads don't run all at the same moment.
+        """
+        interval = self.current_interval
+        try:
+            jitter = min(float(self.interval_jitter), interval / 2.0)
+        except (TypeError, ValueError):
+            jitter = 0
+        if jitter <= 0 or self._oneshot:
+            return interval
+        return interval + round(random.uniform(-jitter, jitter), 1)
+
+    @property
+    def current_interval(self):
+        """
+        The interval currently used between two runs (without jitter).
+        """
+        return self.interval
+
+    def start_delay(self):
+        """
+        Return how long to delay the first run. Each thread gets its own
+        phase within `start_stagger` seconds, derived from the config
+        name, so it stays the same across restarts and the threads are
+        spread evenly.
+        """
+        try:
+            stagger = float(self.start_stagger)
+        except (TypeError, ValueError):
+            stagger = 0
+        if stagger <= 0 or self._oneshot:
+            return 0
+        name = self.config.name
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        digest = hashlib.sha256(str(name)).hexdigest()
+        return int(digest[:8], 16) / float(0x100000000) * stagger
+
+    @property
+    def wakeup_sources(self):
+        """
+        Events that wake up the waiting thread when it's terminated. Plain
+        threading.Event (as terminate_event) is checked every second.
+        """
+        if self.terminate_event is self._internal_terminate_event:
+            return [self._internal_terminate_event]
+        return [self._internal_terminate_event, self.terminate_event]
 
     def is_terminated(self):
         """
@@ -342,9 +1352,9 @@ class IntervalThread(Thread):
             # for python2.6, 2.7 has total_seconds method
             delta_seconds = ((
                              delta.days * 86400 + delta.seconds) * 10 ** 6 +
-                             delta.microseconds) / 10 ** 6
+                             delta.microseconds) / float(10 ** 6)
 
-            wait_time = self.interval - int(delta_seconds)
+            wait_time = self.next_interval() - delta_seconds
 
             if wait_time < 0:
                 self.logger.debug(
@@ -352,7 +1362,14 @@ class IntervalThread(Thread):
                     "interval. Trying again immediately.")
                 continue
 
-            self.wait(wait_time)
+            self._wait_for_next_run(wait_time)
+
+    def _wait_for_next_run(self, wait_time):
+        """
+        Wait between two runs of `_run` loop, subclasses can wake up
+        earlier if there is something to do.
+        """
+        self.wait(wait_time)
 
     def _get_data(self):
         """
@@ -373,6 +1390,11 @@ class IntervalThread(Thread):
         '''
         self.logger.debug("Thread '%s' started", self.config.name)
         try:
+            delay = self.start_delay()
+            if delay:
+                self.logger.debug("Delaying start of thread '%s' by %.1f seconds",
+                                  self.config.name, delay)
+                self.wait(delay)
             while not self.is_terminated():
                 has_error = False
                 try:
@@ -402,9 +1424,10 @@ class IntervalThread(Thread):
                     self._internal_terminate_event.set()
                     return
 
+                wait_time = self.next_interval()
                 self.logger.info("Waiting %s seconds before performing action"
-                                 " again '%s'", self.interval, self.config.name)
-                self.wait(self.interval)
+                                 " again '%s'", wait_time, self.config.name)
+                self.wait(wait_time)
         except KeyboardInterrupt:
             self.logger.debug("Thread '%s' interrupted", self.config.name)
             self.cleanup()
@@ -423,6 +1446,111 @@ class IntervalThread(Thread):
         """
         pass
 
+    def run_scheduled(self):
+        """
+        Run one iteration of the `_run` loop with the error handling of
+        `run`. It's used instead of starting the thread when the loop is
+        driven by virtwho.scheduler.Scheduler.
+
+        @return: Seconds to wait before the next iteration or None if the
+        thread is terminated
+        """
+        if self.is_terminated():
+            return None
+        start_time = time.time()
+        has_error = False
+        try:
+            if not self._prepared:
+                self.prepare()
+                self._prepared = True
+            self._send_data(self._get_data())
+        except SystemExit:
+            # Virt._send_data exits when the thread is terminated
+            self._internal_terminate_event.set()
+        except VirtError as e:
+            if not self.is_terminated():
+                self.logger.error("Thread '%s' fails with error: %s",
+                                  self.config.name, str(e))
+                has_error = True
+        except Exception:
+            if not self.is_terminated():
+                self.logger.exception("Thread '%s' fails with "
+                                      "exception:", self.config.name)
+                has_error = True
+
+        if self.is_terminated():
+            self.logger.debug("Thread '%s' terminated", self.config.name)
+            self._internal_terminate_event.set()
+            return None
+
+        if self._oneshot:
+            if has_error:
+                self._send_data(ErrorReport(self.config))
+            self.logger.debug("Thread '%s' stopped after running once",
+                              self.config.name)
+            self._internal_terminate_event.set()
+            return None
+
+        wait_time = self.next_interval()
+        if has_error:
+            self._prepared = False
+            self.logger.info("Waiting %s seconds before performing action"
+                             " again '%s'", wait_time, self.config.name)
+            return wait_time
+        return max(0, wait_time - (time.time() - start_time))
+
+
+class CheckInJob(object):
+    """
+    Asynchronous hypervisor check-in (of one chunk) that the destination
+    has not seen finished yet.
+    """
+    __slots__ = ('report', 'sources', 'delay', 'backoff', 'next_check', 'reserved')
+
+    def __init__(self, report, sources, backoff):
+        """
+        @param report: The batch report that was checked in
+        @type report: HostGuestAssociationReport
+
+        @param sources: Source keys with hypervisors in the report
+        @type sources: list
+
+        @param backoff: Seconds to wait before the first check of the state
+        @type backoff: float
+        """
+        self.report = report
+        self.sources = sources
+        self.delay = 0
+        self.backoff = backoff
+        self.next_check = time.time()
+        # The next check has its call to the server reserved already
+        # (see `virtwho.ratelimit`)
+        self.reserved = False
+
+
+class CheckInBatch(object):
+    """
+    Host/guest reports checked in together, possibly split into several
+    chunks, and the jobs of the chunks that are not finished yet.
+    """
+    __slots__ = ('reports', 'versions', 'jobs', 'pending', 'failed')
+
+    def __init__(self, reports, versions):
+        """
+        @param reports: Dict of source key to the report of that source
+        @type reports: dict
+
+        @param versions: Dict of source key to datastore version of the report
+        @type versions: dict
+        """
+        self.reports = reports
+        self.versions = versions
+        self.jobs = []
+        # Source key to number of chunks with its hypervisors not done yet
+        self.pending = dict.fromkeys(reports, 0)
+        # Sources with a chunk that didn't finish successfully
+        self.failed = set()
+
 
 class DestinationThread(IntervalThread):
     """
@@ -431,11 +1559,24 @@ class DestinationThread(IntervalThread):
     object.
 
     This class should work so long as the destination is a Manager object.
+
+    When the check-in is processed asynchronously, the state of the job is
+    checked between the runs with exponential backoff (from
+    JOB_POLL_DELAY up to polling_interval). New host/guest reports are not
+    checked in while the job is running, they wait in the source for the
+    next check-in.
+
+    With `checkin_batch_size` option set, the hypervisors are checked in
+    in chunks of at most that many hypervisors, `checkin_concurrency` of
+    them at once. A source is considered sent when all chunks with its
+    hypervisors finished.
     """
+    # Seconds to wait before the first check of the async job state
+    JOB_POLL_DELAY = 5
 
     def __init__(self, logger, config, source_keys=None, options=None,
                  source=None, dest=None, terminate_event=None, interval=None,
-                 oneshot=False):
+                 oneshot=False, state=None, state_key=None):
         """
         @param source_keys: A list of keys to be used to retrieve info from
         the source
@@ -446,11 +1587,35 @@ class DestinationThread(IntervalThread):
 
         @param dest: The destination object to use to actually send the data
         @type dest: Manager
+
+        @param state: Persistent state to store the hashes of sent reports
+        to, the reports sent before are not sent again (not in oneshot mode)
+        @type state: virtwho.state.SentState
+
+        @param state_key: Identifier of this destination in the state
+        @type state_key: str
         """
         if not isinstance(source_keys, list):
             raise ValueError("Source keys must be a list")
         self.source_keys = source_keys
-        self.last_report_for_source = {}  # Source_key to hash of last report
+        # Source_key to hash of last report, or to dict of partition to hash
+        # for partitioned HostGuestAssociationReports
+        self.last_report_for_source = {}
+        # Source_key to datastore version of the last report dealt with and
+        # of the reports being sent now
+        self._source_versions = {}
+        self._pending_versions = {}
+        # Datastore version at the time of last _get_data
+        self._data_version = 0
+        self.state = state
+        self.state_key = state_key
+        # Hashes to be saved to the state, written at once after each run
+        self._unsaved_state = {}
+        if state is not None and not oneshot:
+            self.last_report_for_source.update(
+                (source_key, value) for source_key, value
+                in state.get(state_key).iteritems()
+                if source_key in source_keys)
         self.options = options
         self.reports_to_print = []  # A list of reports we would send but are
         #  going to print instead, to be used by the owner of the thread
@@ -472,6 +1637,8 @@ class DestinationThread(IntervalThread):
         # EX when we get a 429 back from the server, this value will be the
         # value of the retry_after header.
         self.interval_modifier = 0
+        # Check-in that is not finished yet
+        self._batch = None
 
     def _get_data(self):
         """
@@ -479,46 +1646,412 @@ class DestinationThread(IntervalThread):
         @return: dict
         """
         reports = {}
+        versioned = isinstance(self.source, Datastore)
+        if versioned:
+            self._data_version = self.source.version
         for source_key in self.source_keys:
-            report = self.source.get(source_key, NotSetSentinel)
+            version = None
+            if versioned:
+                # Don't even load reports that were already dealt with
+                changed = self.source.get_if_changed(
+                    source_key, self._source_versions.get(source_key, 0))
+                if changed is None:
+                    self.logger.debug("No new report available for source: %s" %
+                                      source_key)
+                    continue
+                version, report = changed
+            else:
+                report = self.source.get(source_key, NotSetSentinel)
 
             if report is None or report is NotSetSentinel:
                 self.logger.debug("No report available for source: %s" %
                                   source_key)
                 continue
-            if report.hash == self.last_report_for_source.get(source_key, None):
+            if not self._has_new_data(source_key, report):
                 self.logger.debug('Duplicate report found, ignoring')
+                if version is not None:
+                    self._source_versions[source_key] = version
                 continue
+            if version is not None:
+                self._pending_versions[source_key] = version
             reports[source_key] = report
         return reports
 
+    def _wait_for_next_run(self, wait_time):
+        """
+        Wait for the next run, but wake up as soon as any of the sources
+        puts a new report to the datastore.
+        """
+        if self._batch is not None and self._batch.jobs:
+            next_check = min(job.next_check for job in self._batch.jobs)
+            wait_time = min(wait_time, max(0, next_check - time.time()))
+        if not isinstance(self.source, Datastore):
+            return self.wait(wait_time)
+        changed = wait_for(
+            lambda: self.is_terminated() or self.source.changed_keys(
+                self.source_keys, self._data_version),
+            [self.source] + self.wakeup_sources, wait_time)
+        if changed and not self.is_terminated():
+            self.logger.debug('New report available, not waiting for '
+                              'the interval to pass')
+
+    @staticmethod
+    def _is_partitioned(report):
+        return isinstance(report, HostGuestAssociationReport) and \
+            report.partitioned
+
+    def _changed_partitions(self, source_key, report):
+        """
+        Get partitions of the report that differ from the last report sent
+        for the source.
+        @return: list of partitions, sorted
+        """
+        last = self.last_report_for_source.get(source_key, None)
+        if not isinstance(last, dict):
+            last = {}
+        return sorted(partition for partition, partition_hash
+                      in report.partition_hashes.iteritems()
+                      if last.get(partition) != partition_hash)
+
+    def _has_new_data(self, source_key, report):
+        """
+        Check if the report differs from the last one sent for the source.
+        Partitioned reports differ only if some of their partitions were
+        added or changed.
+        """
+        last = self.last_report_for_source.get(source_key, None)
+        if not self._is_partitioned(report):
+            return report.hash != last
+        if not isinstance(last, dict):
+            return True
+        if self._changed_partitions(source_key, report):
+            return True
+        if set(last) != set(report.partition_hashes):
+            # Some partitions are gone, there is nothing to send for them
+            self.logger.debug('Partitions removed from source %s: %s',
+                              source_key,
+                              ', '.join(str(partition) for partition in
+                                        sorted(set(last) - set(report.partition_hashes))))
+            self._update_last_report(source_key, report)
+        return False
+
+    def _update_last_report(self, source_key, report, version=None):
+        """
+        Remember the report as the last one sent for the source.
+
+        @param version: Datastore version of the report, the version from
+        the last _get_data by default
+        """
+        if self._is_partitioned(report):
+            self.last_report_for_source[source_key] = dict(report.partition_hashes)
+        else:
+            self.last_report_for_source[source_key] = report.hash
+        if version is None:
+            version = self._pending_versions.pop(source_key, None)
+        if version is not None:
+            self._source_versions[source_key] = version
+        if self.state is not None:
+            self._unsaved_state[source_key] = self.last_report_for_source[source_key]
+
+    def _save_state(self):
+        """
+        Write the hashes of the reports sent since the last call to the
+        state, all of them at once.
+        """
+        if self.state is not None and self._unsaved_state:
+            self.state.update(self.state_key, self._unsaved_state)
+            self._unsaved_state = {}
+
+    def _option(self, name, default):
+        value = getattr(self.options, name, default)
+        if not isinstance(value, (int, long)) or value <= 0:
+            return default
+        return value
+
+    def _wait_for_server(self, delay):
+        """
+        Wait `delay` seconds (see `virtwho.ratelimit.reserve`) before
+        calling the server that is throttled.
+        """
+        if delay > 0:
+            self.logger.debug("Server is throttled, waiting %.1f seconds", delay)
+            self.wait(wait_time=delay)
+
+    def _check_in(self, report):
+        """
+        Check in the batch report, retrying while the server is throttling.
+
+        @return: tuple (success, result of hypervisorCheckIn)
+        """
+        server = self.dest.server(report)
+        delay = ratelimit.reserve(server)
+        while True:
+            self._wait_for_server(delay)
+            try:
+                return True, self.dest.hypervisorCheckIn(report,
+                                                         options=self.options)
+            except ManagerThrottleError as e:
+                self.logger.debug("429 encountered while performing "
+                                  "hypervisor check in.\n"
+                                  "Trying again in "
+                                  "%s" % e.retry_after)
+                delay = ratelimit.throttle(server, e.retry_after)
+            except (ManagerError, ManagerFatalError):
+                self.logger.exception("Error during hypervisor "
+                                      "checkin: ")
+                return False, None
+
+    def _check_in_chunks(self, reports):
+        """
+        Check in the batch reports, at most `checkin_concurrency` at once.
+
+        @return: list of results of `_check_in`, in order of the reports
+        """
+        concurrency = min(self._option('checkin_concurrency', 1), len(reports))
+        if concurrency <= 1:
+            return [self._check_in(report) for report in reports]
+        results = [None] * len(reports)
+        queue = Queue()
+        for index in range(len(reports)):
+            queue.put(index)
+
+        def work():
+            while True:
+                try:
+                    index = queue.get_nowait()
+                except Empty:
+                    return
+                try:
+                    results[index] = self._check_in(reports[index])
+                except Exception:
+                    # Nobody would see the exception of the worker thread,
+                    # the chunk is just not sent
+                    self.logger.exception("Error during hypervisor checkin: ")
+                    results[index] = (False, None)
+
+        threads = [Thread(target=work, name='%s-checkin-%d' % (self.getName(), i))
+                   for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def _chunk_done(self, sources, finished):
+        """
+        Mark one chunk with hypervisors of the sources as done. Sources whose
+        chunks all finished are marked as sent.
+
+        @return: list of source keys that have all their chunks done
+        """
+        batch = self._batch
+        done = []
+        for source_key in sources:
+            batch.pending[source_key] -= 1
+            if not finished:
+                batch.failed.add(source_key)
+            if batch.pending[source_key] > 0:
+                continue
+            done.append(source_key)
+            if source_key not in batch.failed:
+                # Update the hash of the info last sent for the source
+                self._update_last_report(source_key, batch.reports[source_key],
+                                         batch.versions.get(source_key))
+        if not batch.jobs and not any(batch.pending.values()):
+            self._batch = None
+        return done
+
+    def _check_job(self, job):
+        """
+        Check the state of the async check-in job once and plan the next
+        check if it's still running.
+
+        @return: list of source keys that have all their chunks done
+        """
+        server = self.dest.server(job.report)
+        if not job.reserved:
+            delay = ratelimit.reserve(server)
+            if delay > 0:
+                # Another caller got throttled by the server, check later
+                job.delay = delay
+                job.next_check = time.time() + delay
+                job.reserved = True
+                return []
+        job.reserved = False
+        try:
+            self.dest.check_report_state(job.report)
+        except ManagerThrottleError as e:
+            self.logger.debug('429 encountered while checking job '
+                              'state, checking again later')
+            job.delay = ratelimit.throttle(server, e.retry_after)
+            job.next_check = time.time() + job.delay
+            job.reserved = True
+            return []
+        except (ManagerError, ManagerFatalError):
+            self.logger.exception("Error during job check: ")
+            self._batch.jobs.remove(job)
+            return self._chunk_done(job.sources, False)
+        state = job.report.state
+        if state == AbstractVirtReport.STATE_FINISHED:
+            self._batch.jobs.remove(job)
+            return self._chunk_done(job.sources, True)
+        if state in (AbstractVirtReport.STATE_CANCELED,
+                     AbstractVirtReport.STATE_FAILED):
+            # The reports are not marked as sent, so they are sent again
+            self.logger.warning('Check-in job of sources %s did not finish',
+                                ', '.join(job.sources))
+            self._batch.jobs.remove(job)
+            return self._chunk_done(job.sources, False)
+        job.delay = job.backoff
+        job.backoff = min(job.backoff * 2, max(self.polling_interval, job.backoff))
+        job.next_check = time.time() + job.delay
+        return []
+
+    def _check_jobs(self, first=None):
+        """
+        Check the state of the jobs that are due (and of `first` job).
+
+        @return: list of source keys that have all their chunks done
+        """
+        now = time.time()
+        done = []
+        for job in list(self._batch.jobs):
+            if job is first or job.next_check <= now:
+                done.extend(self._check_job(job))
+        return done
+
+    def _send_batch(self, data_to_send, sources, hypervisors):
+        """
+        Check in the hypervisors of host/guest association reports, in
+        chunks if `checkin_batch_size` is set.
+
+        @param sources: Source keys of the reports
+        @type sources: list
+
+        @param hypervisors: list of tuples (source key, hypervisor)
+        @type hypervisors: list
+
+        @return: list of source keys that have all their chunks done
+        """
+        self._batch = CheckInBatch(
+            dict((source_key, data_to_send[source_key]) for source_key in sources),
+            dict((source_key, self._pending_versions.pop(source_key))
+                 for source_key in sources if source_key in self._pending_versions))
+        size = self._option('checkin_batch_size', len(hypervisors))
+        chunks = [hypervisors[i:i + size] for i in range(0, len(hypervisors), size)]
+        if len(chunks) > 1:
+            self.logger.info('Checking in %d hypervisors in %d chunks',
+                             len(hypervisors), len(chunks))
+        reports = []
+        chunk_sources = []
+        for chunk in chunks:
+            # Modify the batched dict to be in the form expected for
+            # HostGuestAssociationReports
+            reports.append(HostGuestAssociationReport(self.config, {
+                'hypervisors': [hypervisor for _, hypervisor in chunk]}))
+            keys = set(source_key for source_key, _ in chunk)
+            if not chunk_sources:
+                # Sources without hypervisors are sent with the first chunk
+                keys.update(set(sources) - set(key for key, _ in hypervisors))
+            keys = sorted(keys)
+            chunk_sources.append(keys)
+            for source_key in keys:
+                self._batch.pending[source_key] += 1
+
+        done = []
+        try:
+            for report, keys, (success, result) in zip(
+                    reports, chunk_sources, self._check_in_chunks(reports)):
+                if success and result and report.state not in [
+                        AbstractVirtReport.STATE_CANCELED,
+                        AbstractVirtReport.STATE_FAILED,
+                        AbstractVirtReport.STATE_FINISHED]:
+                    # Async result, track the job instead of waiting for it
+                    self._batch.jobs.append(CheckInJob(
+                        report, keys, min(self.JOB_POLL_DELAY, self.polling_interval)))
+                else:
+                    # If the batch report did not reach the finished state
+                    # we do not want to update which report we last sent (as
+                    # we might want to try to send the same report again next
+                    # time)
+                    finished = success and \
+                        report.state == AbstractVirtReport.STATE_FINISHED
+                    done.extend(self._chunk_done(keys, finished))
+        finally:
+            if self._batch is not None and not self._batch.jobs:
+                # The check-in failed unexpectedly, there is nothing to wait
+                # for and the reports are sent again with the next check-in
+                self._batch = None
+        if self._batch is not None:
+            done.extend(self._check_jobs(*self._batch.jobs[:1]))
+        if self._oneshot:
+            # There is no next run, wait for the jobs here (until the thread
+            # is stopped or virt-who terminates)
+            while self._batch is not None and not self.is_terminated():
+                job = min(self._batch.jobs, key=attrgetter('next_check'))
+                if job.next_check > time.time():
+                    self.wait(wait_time=job.delay)
+                    if self.is_terminated():
+                        break
+                done.extend(self._check_jobs(job))
+        return done
+
     def _send_data(self, data_to_send):
         """
         Processes the data_to_send and sends it using the dest object.
         @param data_to_send: A dict of source_keys, report
         @type: dict
         """
-        if not data_to_send:
+        if not data_to_send and self._batch is None:
             self.logger.debug('No data to send, waiting for next interval')
+            # Partitions removed from the reports are still remembered
+            self._save_state()
             return
         if isinstance(data_to_send, ErrorReport):
             self.logger.info('Error report received, shutting down')
             self.stop()
             return
-        all_hypervisors = [] # All the Host-guest mappings together
+        all_hypervisors = []  # All the Host-guest mappings together
         domain_list_reports = []  # Source_keys of DomainListReports
         reports_batched = []  # Source_keys of reports to be sent as one
         sources_sent = []  # Sources we have dealt with this run
         sources_erred = []
-        # Reports of different types are handled differently
-        for source_key, report in data_to_send.iteritems():
+        if self._batch is not None:
+            sources_sent.extend(self._check_jobs())
+        # Reports of different types are handled differently, sorted so
+        # the check-in chunks are always the same
+        for source_key, report in sorted(data_to_send.iteritems(),
+                                         key=itemgetter(0)):
             if isinstance(report, DomainListReport):
                 # These are sent one at a time to the destination
                 domain_list_reports.append(source_key)
                 continue
             if isinstance(report, HostGuestAssociationReport):
+                if self._batch is not None:
+                    # The source keeps the report, it will be in the next
+                    # check-in
+                    self.logger.debug('Check-in job still running, report for '
+                                      'source %s waits for the next check-in',
+                                      source_key)
+                    continue
+                if not self._has_new_data(source_key, report):
+                    # The report was part of the job that just finished
+                    continue
                 # These reports are put into one report to send at once
-                all_hypervisors.extend(report.association['hypervisors'])
+                if report.partitioned:
+                    # Only the partitions that changed need to be sent
+                    changed = self._changed_partitions(source_key, report)
+                    self.logger.info('Partitions changed for source %s: %s',
+                                     source_key,
+                                     ', '.join(str(partition) for partition in changed))
+                    for partition in changed:
+                        all_hypervisors.extend(
+                            (source_key, hypervisor)
+                            for hypervisor in report.partitions[partition])
+                else:
+                    all_hypervisors.extend(
+                        (source_key, hypervisor)
+                        for hypervisor in report.association['hypervisors'])
                 # Keep track of those reports that we have
                 reports_batched.append(source_key)
                 continue
@@ -534,94 +2067,34 @@ class DestinationThread(IntervalThread):
                     sources_erred.append(source_key)
 
         if all_hypervisors:
-            # Modify the batched dict to be in the form expected for
-            # HostGuestAssociationReports
-            all_hypervisors = {'hypervisors': all_hypervisors}
-            batch_host_guest_report = HostGuestAssociationReport(self.config,
-                                                                 all_hypervisors)
-            result = None
-            # Try to actually do the checkin whilst being mindful of the
-            # rate limit (retrying where necessary)
-            while result is None:
-                try:
-                    result = self.dest.hypervisorCheckIn(
-                            batch_host_guest_report,
-                            options=self.options)
-                    break
-                except ManagerThrottleError as e:
-                    self.logger.debug("429 encountered while performing "
-                                      "hypervisor check in.\n"
-                                      "Trying again in "
-                                      "%s" % e.retry_after)
-                    self.interval_modifier = e.retry_after
-                except (ManagerError, ManagerFatalError):
-                    self.logger.exception("Error during hypervisor "
-                                        "checkin: ")
-                    if self._oneshot:
-                        sources_erred.extend(reports_batched)
-                    break
-                self.wait(wait_time=self.interval_modifier)
-                self.interval_modifier = 0
-            initial_job_check = True
-            # Poll for async results if async (retrying where necessary)
-            while result and batch_host_guest_report.state not in [
-                AbstractVirtReport.STATE_CANCELED,
-                AbstractVirtReport.STATE_FAILED,
-                AbstractVirtReport.STATE_FINISHED]:
-                if self.interval_modifier != 0:
-                    wait_time = self.interval_modifier
-                    self.interval_modifier = 0
-                else:
-                    wait_time = self.polling_interval
-                if not initial_job_check:
-                    self.wait(wait_time=wait_time)
-                try:
-                    self.dest.check_report_state(batch_host_guest_report)
-                except ManagerThrottleError as e:
-                    self.logger.debug('429 encountered while checking job '
-                                      'state, checking again later')
-                    self.interval_modifier = e.retry_after
-                except (ManagerError, ManagerFatalError):
-                    self.logger.exception("Error during job check: ")
-                    if self._oneshot:
-                        sources_sent.extend(reports_batched)
-                    break
-                initial_job_check = False
-
-            # If the batch report did not reach the finished state
-            # we do not want to update which report we last sent (as we
-            # might want to try to send the same report again next time)
-            if batch_host_guest_report.state == \
-                    AbstractVirtReport.STATE_FINISHED:
-                # Update the hash of the info last sent for each source
-                # included in the successful report
-                for source_key in reports_batched:
-                    self.last_report_for_source[source_key] = data_to_send[
-                        source_key].hash
-                    sources_sent.append(source_key)
+            sources_sent.extend(self._send_batch(data_to_send, reports_batched,
+                                                 all_hypervisors))
         # Send each Domain Guest List Report if necessary
         for source_key in domain_list_reports:
             report = data_to_send[source_key]
             if not self.options.print_:
                 retry = True
+                server = self.dest.server(report)
+                delay = ratelimit.reserve(server)
                 while retry:  # Retry if we encounter a 429
+                    self._wait_for_server(delay)
                     try:
                         self.dest.sendVirtGuests(report, options=self.options)
                         sources_sent.append(source_key)
-                        self.last_report_for_source[source_key] = data_to_send[
-                            source_key].hash
+                        self._update_last_report(source_key, report)
                         retry = False
                     except ManagerThrottleError as e:
                         self.logger.debug('429 encountered when sending virt '
                                           'guests.'
                                           'Retrying after: %s' % e.retry_after)
-                        self.wait(wait_time=e.retry_after)
+                        delay = ratelimit.throttle(server, e.retry_after)
                     except (ManagerError, ManagerFatalError):
                         self.logger.exception("Fatal error during send virt "
                                               "guests: ")
                         if self._oneshot:
                             sources_erred.append(source_key)
                         retry = False  # Only retry on 429
+        self._save_state()
 
         # Terminate this thread if we have sent one report for each source
         if all((source_key in sources_sent or source_key in sources_erred)
@@ -651,6 +2124,7 @@ class Satellite5DestinationThread(DestinationThread):
         """
         if not data_to_send:
             self.logger.debug('No data to send, waiting for next interval')
+            self._save_state()
             return
         if isinstance(data_to_send, ErrorReport):
             self.logger.info('Error report received, shutting down')
@@ -683,7 +2157,7 @@ class Satellite5DestinationThread(DestinationThread):
                         result = self.dest.hypervisorCheckIn(
                                 report,
                                 options=self.options)
-                        self.last_report_for_source[source_key] = report.hash
+                        self._update_last_report(source_key, report)
                         sources_sent.append(source_key)
                         break
                     except ManagerThrottleError as e:
@@ -707,6 +2181,7 @@ class Satellite5DestinationThread(DestinationThread):
                 if self._oneshot:
                     # Consider this source dealt with if we are in oneshot mode
                     sources_sent.append(source_key)
+        self._save_state()
 
         # Terminate this thread if we have sent one report for each source
         if all(source_key in sources_sent for source_key in self.source_keys)\
@@ -742,6 +2217,15 @@ class Virt(IntervalThread):
         super(Virt, self).__init__(logger, config, dest=dest,
                                    terminate_event=terminate_event,
                                    interval=interval, oneshot=oneshot)
+        # Last report, used to record changes into the ChangeJournal
+        self._previous_report = None
+        self._guest_cache = GuestCache()
+        # Adaptive interval bounds, see `_adapt_interval`. It's disabled
+        # unless max_interval is greater than the interval.
+        self.min_interval = MinimumSendInterval
+        self.max_interval = 0
+        self._adaptive_interval = None
+        self._previous_hash = None
 
     @classmethod
     def from_config(cls, logger, config, dest,
@@ -766,6 +2250,53 @@ class Virt(IntervalThread):
                               interval=interval, oneshot=oneshot)
         raise KeyError("Invalid config type: %s" % config.type)
 
+    @property
+    def schedulable(self):
+        """
+        True if the backend only polls its source (it doesn't reimplement
+        `_run`), so it can be run by virtwho.scheduler.Scheduler instead of
+        having a thread of its own.
+        """
+        return type(self)._run.im_func is Virt._run.im_func
+
+    @property
+    def adaptive(self):
+        """
+        True if the interval adapts to how often the reports change.
+        """
+        try:
+            return not self._oneshot and self.max_interval > self.interval
+        except TypeError:
+            return False
+
+    @property
+    def current_interval(self):
+        if self._adaptive_interval is None or not self.adaptive:
+            return self.interval
+        return self._adaptive_interval
+
+    def _adapt_interval(self, report_hash):
+        """
+        Halve the interval (down to `min_interval`) when the report differs
+        from the previous one and double it (up to `max_interval`) when
+        it's the same, so changes are picked up quickly and quiet sources
+        are polled rarely.
+        """
+        if not self.adaptive:
+            return
+        previous_hash, self._previous_hash = self._previous_hash, report_hash
+        if previous_hash is None:
+            return
+        current = self.current_interval
+        if report_hash != previous_hash:
+            interval = max(min(self.min_interval, self.interval), current // 2)
+        else:
+            interval = min(self.max_interval, current * 2)
+        if interval != current:
+            self.logger.debug('Interval of config "%s" changed to %d seconds',
+                              self.config.name, interval)
+        self._adaptive_interval = interval
+
     def start_sync(self):
         '''
         This method is same as `start()` but runs synchronously, it does NOT
@@ -796,8 +2327,48 @@ class Virt(IntervalThread):
             sys.exit(0)
         self.logger.info('Report for config "%s" gathered, placing in '
                           'datastore', data_to_send.config.name)
+        # The hash is cached on the report and stored together with it,
+        # compute it here so destinations don't have to
+        self._adapt_interval(data_to_send.hash)
+        if isinstance(data_to_send, HostGuestAssociationReport) and \
+                data_to_send.partitioned:
+            data_to_send.partition_hashes
+        self._record_changes(data_to_send)
+        # Guests that weren't part of this report can be dropped from cache
+        self._guest_cache.rotate()
         self.dest.put(self.config.name, data_to_send)
 
+    def _record_changes(self, report):
+        """
+        Record changes since the previous report into the ChangeJournal
+        of this source. The journal keeps the previous report alive, so
+        it's enabled only when `journal_size` option is set.
+        """
+        if not isinstance(report, HostGuestAssociationReport):
+            return
+        try:
+            size = int(self.config.journal_size)
+        except (AttributeError, TypeError, ValueError):
+            size = 0
+        if size <= 0:
+            self._previous_report = None
+            return
+        journal = ChangeJournal.get(self.config.name, size)
+        if self._previous_report is not None:
+            diff = ReportDiff(self._previous_report, report)
+            if diff:
+                journal.record(diff)
+                self.logger.debug('Changes in report for config "%s": %s',
+                                  self.config.name, diff.summary())
+        self._previous_report = report
+
+    def sharedGuest(self, uuid, state):
+        """
+        Return Guest of this backend with given uuid and state, reusing the
+        instance from previous report if it didn't change.
+        """
+        return self._guest_cache.get(uuid, self, state)
+
     def isHypervisor(self):
         """
         Return True if the virt instance represents hypervisor environment
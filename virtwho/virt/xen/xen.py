@@ -108,7 +108,7 @@ class Xen(virt.Virt):
                 else:
                     state = virt.Guest.STATE_UNKNOWN
 
-                guests.append(virt.Guest(uuid=uuid, virt=self, state=state))
+                guests.append(self.sharedGuest(uuid, state))
 
             facts = {}
             sockets = record.get('cpu_info', {}).get('socket_count')
@@ -191,7 +191,7 @@ class Xen(virt.Virt):
             if initial or len(events) > 0 or delta > 0:
                 assoc = self.getHostGuestMapping()
                 self._send_data(virt.HostGuestAssociationReport(self.config, assoc))
-                next_update = time() + self.interval
+                next_update = time() + self.next_interval()
                 initial = False
 
             if self._oneshot:
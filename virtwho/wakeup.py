@@ -0,0 +1,237 @@
+"""
+Waiting primitives for the threads of virt-who, part of virt-who
+
+Copyright (C) 2017 Red Hat, Inc.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+import time
+import heapq
+import itertools
+from threading import Lock, Condition, Thread, current_thread
+
+# How often to check sources that can't wake the waiter up themselves
+# (like plain threading.Event)
+POLL_INTERVAL = 1.0
+
+
+class Waiter(object):
+    """
+    One blocked thread, it's woken up by whatever comes first: one of the
+    sources it's registered to or its timeout (see `WakeupTimer`).
+    """
+    __slots__ = ('_lock', '_woken')
+
+    _woken_lock = Lock()
+
+    def __init__(self):
+        self._lock = Lock()
+        self._lock.acquire()
+        self._woken = False
+
+    def wake(self):
+        with self._woken_lock:
+            if self._woken:
+                return
+            self._woken = True
+        self._lock.release()
+
+    def block(self):
+        self._lock.acquire()
+
+
+class WakeupTimer(object):
+    """
+    Wakes up the waiters when their timeout expires.
+
+    Waiting with a timeout on threading primitives is done in short
+    sleeps on python 2, so every waiting thread would wake up many times
+    a second. Instead the waiters block without timeout and only the
+    single daemon thread of the timer waits with one.
+    """
+    def __init__(self):
+        self._cond = Condition(Lock())
+        self._heap = []
+        self._counter = itertools.count()
+        self._cancelled = 0
+        self._thread = None
+
+    def schedule(self, deadline, waiter):
+        """
+        Wake the waiter up at `deadline` (as returned by time.time()).
+
+        @return: entry that can be passed to `cancel`
+        """
+        entry = [deadline, next(self._counter), waiter]
+        with self._cond:
+            heapq.heappush(self._heap, entry)
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='virt-who-wakeup')
+                self._thread.daemon = True
+                self._thread.start()
+            elif self._heap[0] is entry:
+                # The timer sleeps longer than this deadline
+                self._cond.notify()
+        return entry
+
+    def cancel(self, entry):
+        with self._cond:
+            if entry[2] is None:
+                return
+            entry[2] = None
+            self._cancelled += 1
+            # Don't keep too many cancelled entries around
+            if self._cancelled > 64 and self._cancelled > len(self._heap) // 2:
+                self._heap = [item for item in self._heap if item[2] is not None]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+
+    def _run(self):
+        with self._cond:
+            while True:
+                now = time.time()
+                while self._heap and self._heap[0][0] <= now:
+                    entry = heapq.heappop(self._heap)
+                    if entry[2] is None:
+                        self._cancelled -= 1
+                    else:
+                        entry[2].wake()
+                        entry[2] = None
+                if self._heap:
+                    self._cond.wait(self._heap[0][0] - now)
+                else:
+                    self._cond.wait()
+
+
+_timer = WakeupTimer()
+
+
+class WakeupSource(object):
+    """
+    Base class for objects that wake up the waiters registered to them
+    when their state changes (see `wait_for`).
+    """
+    def __init__(self):
+        self._waiters = set()
+        self._waiters_lock = Lock()
+
+    def add_waiter(self, waiter):
+        with self._waiters_lock:
+            self._waiters.add(waiter)
+
+    def remove_waiter(self, waiter):
+        with self._waiters_lock:
+            self._waiters.discard(waiter)
+
+    def wake_waiters(self):
+        with self._waiters_lock:
+            waiters = list(self._waiters)
+        for waiter in waiters:
+            waiter.wake()
+
+
+class WakeupEvent(WakeupSource):
+    """
+    Event that wakes up `wait_for` immediately when it's set.
+
+    It has the same interface as threading.Event.
+    """
+    def __init__(self):
+        super(WakeupEvent, self).__init__()
+        self._flag = False
+
+    def is_set(self):
+        return self._flag
+
+    isSet = is_set
+
+    def set(self):
+        self._flag = True
+        self.wake_waiters()
+
+    def clear(self):
+        self._flag = False
+
+    def wait(self, timeout=None):
+        """
+        Block until the event is set or the timeout expires.
+
+        @return: True if the event is set
+        """
+        return wait_for(self.is_set, [self], timeout)
+
+
+def wait_for(predicate, sources, timeout=None):
+    """
+    Block until `predicate()` returns true value or the timeout expires.
+
+    The predicate is checked again each time one of the `sources` wakes
+    the thread up. Sources that are not WakeupSource instances (plain
+    threading.Event, for example) can't do that, they are checked every
+    POLL_INTERVAL seconds.
+
+    Signal handlers don't run while the main thread is blocked on a lock
+    (on python 2), so the main thread wakes up every POLL_INTERVAL
+    seconds as well.
+
+    @param predicate: Function without arguments
+    @param sources: Objects whose change can make the predicate true
+    @type sources: list
+
+    @param timeout: Maximal time to wait in seconds, None means forever
+    @type timeout: float
+
+    @return: The last result of the predicate
+    """
+    end_time = None if timeout is None else time.time() + timeout
+    wakeup_sources = []
+    seen = set()
+    poll = current_thread().name == 'MainThread'
+    for source in sources:
+        if not isinstance(source, WakeupSource):
+            poll = True
+        elif id(source) not in seen:
+            seen.add(id(source))
+            wakeup_sources.append(source)
+    while True:
+        result = predicate()
+        if result:
+            return result
+        deadline = end_time
+        if poll:
+            next_poll = time.time() + POLL_INTERVAL
+            deadline = next_poll if end_time is None else min(end_time, next_poll)
+        if deadline is not None and deadline <= time.time():
+            return result
+        waiter = Waiter()
+        for source in wakeup_sources:
+            source.add_waiter(waiter)
+        entry = None
+        try:
+            # The change could come before the waiter was registered
+            result = predicate()
+            if result:
+                return result
+            if deadline is not None:
+                entry = _timer.schedule(deadline, waiter)
+            waiter.block()
+        finally:
+            for source in wakeup_sources:
+                source.remove_waiter(waiter)
+            if entry is not None:
+                _timer.cancel(entry)
+        if end_time is not None and time.time() >= end_time:
+            return predicate()